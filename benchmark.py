@@ -0,0 +1,273 @@
+'''
+Benchmarks for the bikeshare.py pipeline. Generates synthetic Chicago, New York
+and Washington shaped datasets of the requested sizes and times each stage of
+the pipeline (parse, derive, cache, filter, each statistic and display)
+separately. Results are written as JSON so runs of different versions can be
+compared with --compare.
+
+Example:
+    python benchmark.py --sizes 10000 1000000 --output results.json
+    python benchmark.py --sizes 10000 1000000 --compare results.json
+'''
+
+## import all necessary packages and functions
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+import bikeshare
+
+## Synthetic dataset shapes
+# Number of distinct stations and whether the file has the Gender and Birth
+# Year columns (Washington does not, and records durations to the millisecond).
+CITY_SHAPES = {'chicago': {'stations': 585, 'demographics': True, 'float_duration': False},
+               'new york city': {'stations': 800, 'demographics': True, 'float_duration': False},
+               'washington': {'stations': 480, 'demographics': False, 'float_duration': True}}
+
+# Rows are generated and written this many at a time so that even the largest
+# files are created with flat memory use.
+GENERATE_CHUNKSIZE = 1000000
+
+STREETS = ['Clark', 'State', 'Wabash', 'Michigan', 'Lake Shore', 'Halsted', 'Canal', 'Wells',
+           'Broadway', 'Madison', 'Lexington', 'Park', 'Amsterdam', 'Columbus', 'Bedford',
+           'Massachusetts', 'Connecticut', 'Wisconsin', 'Pennsylvania', 'Rhode Island',
+           'Adams', 'Jackson', 'Monroe', 'Lincoln', 'Grand', 'Division', 'Ashland', 'Damen']
+SUFFIXES = ['St', 'Ave', 'Blvd', 'Dr', 'Pl', 'Sq']
+
+def station_names(n_stations):
+    '''Returns n_stations distinct station names like "Clark St & 1 St".'''
+    names = []
+    i = 0
+    while len(names) < n_stations:
+        street = '{} {}'.format(STREETS[i % len(STREETS)], SUFFIXES[(i // len(STREETS)) % len(SUFFIXES)])
+        names.append('{} & {} {}'.format(street, i // 3 + 1, SUFFIXES[i % len(SUFFIXES)]))
+        i += 1
+    return np.array(names, dtype=object)
+
+def generate_city(path, city, n_rows, seed=0):
+    '''Writes a synthetic city .csv file with the columns and layout of the real
+    datasets: trips in January to June 2017 with busier commuting hours, a few
+    very popular stations and some missing user types, genders and birth years.
+
+    Args:
+        (str) path - file to write
+        (str) city - key of CITY_SHAPES
+        (int) n_rows - number of trips
+        (int) seed - random seed
+    Returns:
+        none.
+    '''
+    shape = CITY_SHAPES[city]
+    rng = np.random.default_rng(seed)
+    names = station_names(shape['stations'])
+
+    # station popularity follows a long tail
+    popularity = 1.0 / np.arange(1, len(names) + 1) ** 0.8
+    popularity /= popularity.sum()
+
+    # more trips at commuting times
+    hour_weights = np.array([1, 1, 1, 1, 1, 2, 4, 8, 9, 5, 4, 5, 6, 6, 5, 6, 8, 10, 8, 5, 4, 3, 2, 1],
+                            dtype=float)
+    hour_weights /= hour_weights.sum()
+    first_day = np.datetime64('2017-01-01T00:00:00')
+    n_days = 181
+
+    with open(path, 'w', newline='') as f:
+        written = 0
+        while written < n_rows:
+            n = min(GENERATE_CHUNKSIZE, n_rows - written)
+            seconds = (rng.integers(0, n_days, n) * 86400
+                       + rng.choice(24, n, p=hour_weights) * 3600
+                       + rng.integers(0, 3600, n))
+            start = first_day + seconds.astype('timedelta64[s]')
+            duration = np.clip(rng.lognormal(6.5, 0.8, n), 60, 86400)
+            if not shape['float_duration']:
+                duration = duration.astype('int64')
+            end = start + duration.astype('int64').astype('timedelta64[s]')
+
+            columns = {'Start Time': start, 'End Time': end, 'Trip Duration': duration,
+                       'Start Station': names[rng.choice(len(names), n, p=popularity)],
+                       'End Station': names[rng.choice(len(names), n, p=popularity)],
+                       'User Type': np.array(['Subscriber', 'Customer', 'Dependent', None],
+                                             dtype=object)[rng.choice(4, n, p=[.78, .2, .0001, .0199])]}
+            if shape['demographics']:
+                columns['Gender'] = np.array(['Male', 'Female', None], dtype=object)[
+                    rng.choice(3, n, p=[.6, .2, .2])]
+                birth_year = np.clip(rng.normal(1981, 11, n).round(), 1899, 2002)
+                birth_year[rng.random(n) < .2] = np.nan
+                columns['Birth Year'] = birth_year
+
+            chunk = pd.DataFrame(columns, index=np.arange(written, written + n))
+            chunk.to_csv(f, header=written == 0, date_format='%Y-%m-%d %H:%M:%S')
+            written += n
+    return None
+
+def timed(results, stage, repeat, function, *args):
+    '''Runs function(*args) repeat times and records the median and fastest
+    wall time of the stage.
+
+    Args:
+        (list) results - list to append the stage's timing record to
+        (str) stage - name of the stage
+        (int) repeat - number of runs
+        function - the stage to time
+    Returns:
+        the value returned by the last run
+    '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = function(*args)
+        times.append(time.perf_counter() - start)
+    results.append({'stage': stage, 'median': statistics.median(times), 'min': min(times),
+                    'repeat': repeat})
+    return value
+
+def benchmark_city(city_file, repeat):
+    '''Times each stage of the pipeline on one city file.
+
+    Args:
+        (str) city_file - path to the city's .csv dataset
+        (int) repeat - number of runs per stage
+    Returns:
+        (list) one timing record per stage
+    '''
+    results = []
+    raw = timed(results, 'parse', repeat, bikeshare.read_city_csv, city_file)
+    df = timed(results, 'derive', repeat, lambda: bikeshare.convert_city_data(raw.copy()))
+
+    fingerprint = bikeshare.file_fingerprint(city_file)
+    cache_dir = bikeshare.cache_path(city_file)
+    timed(results, 'cache_write', repeat, bikeshare.write_cache, df, cache_dir, fingerprint)
+    timed(results, 'cache_read', repeat, bikeshare.read_cache, cache_dir, fingerprint)
+
+    index = timed(results, 'calendar_index', repeat, bikeshare.build_calendar_index, df)
+    for month, day in (('March', 'all'), ('all', 'Friday'), ('March', 'Friday')):
+        rows = bikeshare.calendar_rows(index, *bikeshare.calendar_filter(month, day))
+        timed(results, 'filter {}/{}'.format(month, day), repeat, lambda: df.iloc[rows])
+
+    for stats in (bikeshare.time_stats, bikeshare.trip_stats, bikeshare.user_stats):
+        timed(results, stats.__name__, repeat, stats, df)
+    cube = timed(results, 'cube_build', repeat,
+                 lambda: bikeshare.cube_add(bikeshare.new_cube(df.columns), df))
+    timed(results, 'cube_stats', repeat, lambda: (bikeshare.cube_time_stats(cube, 3, 4),
+                                                  bikeshare.cube_user_stats(cube, 3, 4)))
+    durations = timed(results, 'duration_build', repeat,
+                      lambda: bikeshare.duration_histogram_add(bikeshare.new_duration_histogram(), df))
+    timed(results, 'duration_stats', repeat, bikeshare.duration_stats, durations, 3, 4)
+
+    # display renders the first five pages of raw rows as text
+    timed(results, 'display', repeat,
+          lambda: [str(page.drop(bikeshare.DERIVED_COLUMNS, axis=1))
+                   for _, page in zip(range(5), bikeshare.iter_pages([df]))])
+    return results
+
+def cold_start(city, city_file, repeat):
+    '''Times fresh Python processes: importing bikeshare, and answering a
+    query with bikeshare.py from its report cache (the first, untimed run
+    fills the cache).
+
+    Args:
+        (str) city - key of CITY_SHAPES
+        (str) city_file - path to the city's .csv dataset
+        (int) repeat - number of runs per stage
+    Returns:
+        (list) one timing record per stage
+    '''
+    results = []
+    script = os.path.abspath(bikeshare.__file__)
+
+    def run(args, answers=''):
+        subprocess.run([sys.executable] + args, input=answers, text=True, check=True,
+                       cwd=os.path.dirname(city_file), stdout=subprocess.DEVNULL)
+
+    timed(results, 'cold_import', repeat, run,
+          ['-c', 'import sys; sys.path.insert(0, {!r}); import bikeshare'.format(os.path.dirname(script))])
+
+    # city (the prompt calls New York City "new york"), no time filter, no
+    # raw rows, no restart
+    answers = '{}\nnone\nno\nno\n'.format('new york' if city == 'new york city' else city)
+    run([script], answers)
+    timed(results, 'cold_cached_query', repeat, run, [script], answers)
+    return results
+
+def compare(results, baseline):
+    '''Prints how much slower (> 1) or faster (< 1) each stage ran than in a
+    baseline run.
+
+    Args:
+        (dict) results - results of this run
+        (dict) baseline - results of an earlier run (eg. of another version)
+    Returns:
+        none.
+    '''
+    old = {(run['city'], run['rows'], record['stage']): record['median']
+           for run in baseline['runs'] for record in run['stages']}
+    print('\n{:<16}{:>10}  {:<24}{:>10}{:>10}{:>8}'.format(
+        'City', 'Rows', 'Stage', 'Before', 'After', 'Ratio'))
+    for run in results['runs']:
+        for record in run['stages']:
+            before = old.get((run['city'], run['rows'], record['stage']))
+            if before:
+                print('{:<16}{:>10,}  {:<24}{:>10.4f}{:>10.4f}{:>8.2f}'.format(
+                    run['city'], run['rows'], record['stage'], before, record['median'],
+                    record['median'] / before))
+    return None
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the bikeshare.py pipeline on synthetic data.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000],
+                        help='numbers of rows to generate (default: %(default)s)')
+    parser.add_argument('--cities', nargs='+', choices=list(CITY_SHAPES), default=list(CITY_SHAPES),
+                        help='dataset shapes to generate (default: all)')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per stage (default: %(default)s)')
+    parser.add_argument('--data-dir', help='directory for the generated files '
+                                           '(default: a temporary directory, removed afterwards)')
+    parser.add_argument('--output', help='write the results to this .json file')
+    parser.add_argument('--compare', help='print the change against the results in this .json file')
+    args = parser.parse_args()
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='bikeshare_benchmark_')
+    os.makedirs(data_dir, exist_ok=True)
+    results = {'python': platform.python_version(), 'pandas': pd.__version__,
+               'numpy': np.__version__, 'platform': platform.platform(), 'runs': []}
+    try:
+        for city in args.cities:
+            for n_rows in args.sizes:
+                # the files keep the real names so that the city's parse
+                # schema applies
+                path = os.path.join(data_dir, str(n_rows), bikeshare.CITY_DATA[city])
+                if not os.path.exists(path):
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    start = time.perf_counter()
+                    generate_city(path, city, n_rows)
+                    print('Generated {} ({:,} rows) in {:.1f} seconds'.format(
+                        path, n_rows, time.perf_counter() - start), file=sys.stderr)
+                stages = benchmark_city(path, args.repeat) + cold_start(city, path, args.repeat)
+                results['runs'].append({'city': city, 'rows': n_rows, 'stages': stages})
+                for record in stages:
+                    print('{:<16}{:>12,}  {:<24}{:>10.4f} s'.format(
+                        city, n_rows, record['stage'], record['median']))
+    finally:
+        if not args.data_dir:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+if __name__ == "__main__":
+    main()
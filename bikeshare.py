@@ -6,15 +6,1160 @@ Please see accompanying readme.txt file for resource references.
 
 ## import all necessary packages and functions
 import time
-import pandas as pd
-import numpy as np
+# cold start is measured from here (see main)
+script_start_time = time.perf_counter()
+import sys
+import math
+import importlib
+import os
+import json
+import shutil
+import csv
+import argparse
+import io
+import mmap
+import threading
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
 import datetime
+# cProfile, tracemalloc, concurrent.futures and http.server are only imported
+# where they are used (the profiling options at the bottom of the script,
+# parallel_report, multi_city_reports and serve): together they take longer to
+# import than the rest of the script.
+
+## Lazy imports
+# Importing pandas and numpy takes most of the script's startup time, so they
+# are only imported when data is first needed. Prompting for a query and
+# printing a report from the report cache never touch them.
+class LazyModule(object):
+    '''Stands in for a module, importing it the first time one of its
+    attributes is used.'''
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attribute):
+        # only called for attributes the proxy itself does not have
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attribute)
+
+pd = LazyModule('pandas')
+np = LazyModule('numpy')
+# only needed when a cache file is written
+tempfile = LazyModule('tempfile')
 
 ## Filenames
 CITY_DATA = { 'chicago': 'chicago.csv',
               'new york city': 'new_york_city.csv',
               'washington': 'washington.csv' }
 
+## Stage instrumentation
+# Every stage of a report (reading the .csv or the cache, parsing timestamps,
+# filtering and each statistic) runs inside stage(), which times it with
+# time.perf_counter and, when tracemalloc is tracing, records the peak memory
+# allocated during the stage. main() prints its runtime info from these records.
+# When stage_log is an open file (see --profile-log) every record is also
+# written to it as one line of JSON so that runs can be analysed afterwards.
+stage_log = None
+stage_log_lock = threading.Lock()
+# peak traced memory of each open stage, per thread (stages nest, eg. parsing
+# the .csv happens inside loading the data). tracemalloc's peak covers every
+# thread, so stages running side by side share their peaks.
+stage_threads = threading.local()
+
+@contextmanager
+def stage(name, **fields):
+    '''Times the body of a with statement as one pipeline stage.
+
+    Args:
+        (str) name - name of the stage
+        fields - extra values to record with the stage (eg. city, month, day)
+    Returns:
+        (dict) the stage's record; 'seconds' and 'peak_memory' (bytes, only
+        when tracemalloc is tracing) are filled in when the stage ends
+    '''
+    record = {'stage': name}
+    record.update(fields)
+    stage_peaks = stage_threads.__dict__.setdefault('peaks', [])
+    # nothing can be tracing before main imports tracemalloc for --trace-memory
+    tracemalloc = sys.modules.get('tracemalloc')
+    tracing = tracemalloc is not None and tracemalloc.is_tracing()
+    if tracing:
+        # hand the peak so far to the enclosing stage before resetting it
+        if stage_peaks:
+            stage_peaks[-1] = max(stage_peaks[-1], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        stage_peaks.append(0)
+    start_time = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['seconds'] = time.perf_counter() - start_time
+        if tracing:
+            peak = max(stage_peaks.pop(), tracemalloc.get_traced_memory()[1])
+            if stage_peaks:
+                stage_peaks[-1] = max(stage_peaks[-1], peak)
+            record['peak_memory'] = peak
+        log_stage(record)
+
+def log_stage(record):
+    '''Writes a stage's record to the stage log, if there is one.
+
+    Args:
+        (dict) record - the stage's record (see stage)
+    Returns:
+        none.
+    '''
+    if stage_log is not None:
+        record['time'] = time.time()
+        with stage_log_lock:
+            stage_log.write(json.dumps(record, default=str) + '\n')
+            stage_log.flush()
+    return None
+
+## Atomic writes
+# Every cache file and directory is first written under a temporary name next
+# to its final path and then moved into place with os.replace, so that a reader
+# never sees it half-written. The temporary names come from tempfile and are
+# unique, so threads of the query service and other processes writing the same
+# file never write into each other's temporary files.
+@contextmanager
+def atomic_file(path, suffix=''):
+    '''Yields a temporary file name to write to, and moves the file to path
+    once the block finishes without an error.
+
+    Args:
+        (str) path - the file to write
+        (str) suffix - ending the temporary name needs (eg. ".npz" for
+        np.savez, which adds it to names without it)
+    Returns:
+        (str) the temporary file name
+    '''
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    handle, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp' + suffix,
+                                        dir=directory)
+    os.close(handle)
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+@contextmanager
+def atomic_directory(path):
+    '''Yields a new temporary directory to write to, and puts it in place of
+    the directory at path once the block finishes without an error.
+
+    Args:
+        (str) path - the directory to write
+    Returns:
+        (str) the temporary directory
+    '''
+    parent = os.path.dirname(os.path.abspath(path))
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=os.path.basename(path) + '.', suffix='.tmp', dir=parent)
+    try:
+        yield tmp_dir
+        # a directory can only be renamed over an empty one, so the old
+        # directory is moved aside first and removed afterwards
+        old_dir = tempfile.mkdtemp(prefix=os.path.basename(path) + '.', suffix='.old', dir=parent)
+        try:
+            os.replace(path, old_dir)
+        except FileNotFoundError:
+            pass
+        try:
+            os.replace(tmp_dir, path)
+        except OSError:
+            # another writer put its directory in place in the meantime
+            if not os.path.isdir(path):
+                raise
+        shutil.rmtree(old_dir, ignore_errors=True)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+## Converted dataset cache
+# Parsed city datasets are stored next to the .csv file in a hidden directory
+# with one .npy file per column. Bump CACHE_VERSION whenever the stored layout
+# or the derived columns change so that old caches are rebuilt.
+CACHE_DIR = '.bikeshare_cache'
+CACHE_VERSION = 7
+
+# Month names (January = 1) and day names in the order returned by pandas
+# .dt.dayofweek (Monday = 0). The city files cover January to June (MONTHS);
+# partitioned datasets (see partition_city) can hold any month of any year.
+CALENDAR_MONTHS = ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August',
+                   'September', 'October', 'November', 'December']
+MONTHS = CALENDAR_MONTHS[:6]
+DAYS_OF_WEEK = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+# Columns added by convert_city_data, which are left out when showing raw data.
+DERIVED_COLUMNS = ['month', 'day_of_week', 'start_hour']
+
+## Parse schemas
+# Column types applied by pd.read_csv, instead of letting it infer object
+# strings and float64 numbers. Text columns are parsed straight into
+# categoricals and birth years into float32, which convert_city_data then
+# turns into a nullable int16. Durations are parsed as float64, so that a trip
+# without one reads as NaN instead of failing the whole file, and
+# convert_city_data turns them into int32 when they are all whole seconds
+# (Washington records fractions of a second and keeps float64). Column types
+# for columns missing from a file are ignored.
+DEFAULT_SCHEMA = {'Unnamed: 0': 'int32',
+                  'Trip Duration': 'float64',
+                  'Start Station': 'category',
+                  'End Station': 'category',
+                  'User Type': 'category',
+                  'Gender': 'category',
+                  'Birth Year': 'float32'}
+CITY_SCHEMAS = {'chicago.csv': DEFAULT_SCHEMA,
+                'new_york_city.csv': DEFAULT_SCHEMA,
+                'washington.csv': DEFAULT_SCHEMA}
+
+def city_dtypes(city_file):
+    '''Returns the column names of a city file and the column types of its
+    schema that apply to them.
+
+    Args:
+        (str) city_file - path to the city's .csv dataset
+    Returns:
+        (list) column names as read by pd.read_csv and (dict) types by column
+    '''
+    schema = CITY_SCHEMAS.get(os.path.basename(city_file), DEFAULT_SCHEMA)
+    with open(city_file) as f:
+        header = list(pd.read_csv(f, nrows=0).columns)
+    return header, {column: dtype for column, dtype in schema.items() if column in header}
+
+def read_city_csv(city_file, **kwargs):
+    '''Reads a city .csv file with the column types of its schema.
+
+    Args:
+        (str) city_file - path to the city's .csv dataset
+        kwargs - other arguments for pd.read_csv (eg. chunksize)
+    Returns:
+        df - pandas DataFrame (or an iterator of chunks, as with pd.read_csv)
+    '''
+    return pd.read_csv(city_file, dtype=city_dtypes(city_file)[1], **kwargs)
+
+def file_fingerprint(city_file):
+    '''Returns the values used to decide whether a cached conversion of a city
+    file is still valid.
+
+    Args:
+        (str) city_file - path to the city's .csv dataset
+    Returns:
+        (dict) absolute path, size in bytes and modification time (ns) of the file
+    '''
+    stat = os.stat(city_file)
+    return {'path': os.path.abspath(city_file),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns}
+
+def cache_path(city_file):
+    '''Returns the directory holding the converted columns for a city file.
+
+    Args:
+        (str) city_file - path to the city's .csv dataset
+    Returns:
+        (str) path of the cache directory (which may not exist yet)
+    '''
+    city_file = os.path.abspath(city_file)
+    return os.path.join(os.path.dirname(city_file), CACHE_DIR,
+                        os.path.basename(city_file) + '.cols')
+
+def derived_path(city_file, suffix):
+    '''Returns the path of a file or directory derived from a city file (eg.
+    its aggregate cube). Derived data is kept next to the column cache rather
+    than inside it, because write_cache replaces the whole column directory.
+
+    Args:
+        (str) city_file - path to the city's .csv dataset
+        (str) suffix - ending added to the name of the .csv file
+    Returns:
+        (str) path in the cache directory (which may not exist yet)
+    '''
+    city_file = os.path.abspath(city_file)
+    return os.path.join(os.path.dirname(city_file), CACHE_DIR,
+                        os.path.basename(city_file) + suffix)
+
+## Timestamp decoding
+# Every timestamp in the city files has the fixed layout "YYYY-MM-DD HH:MM:SS".
+# Rather than have pd.to_datetime work out the format of every string, the
+# digits are read straight out of a byte array in one vectorised pass, which
+# also gives the month, day of week and hour without further passes.
+TIMESTAMP_LAYOUT = b'0000-00-00 00:00:00'
+# days in each month of a common year; February gains a day in leap years
+DAYS_IN_MONTH = [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
+
+def decode_timestamps(column):
+    '''Decodes a column of "YYYY-MM-DD HH:MM:SS" strings.
+
+    Args:
+        column - pandas Series of timestamp strings
+    Returns:
+        (dict) 'time' - numpy datetime64[ns] array (seconds since the epoch
+        scaled to ns), 'month' (1-12), 'weekday' (Monday = 0) and 'hour' - int8
+        numpy arrays, or None if any value does not have the layout
+    '''
+    try:
+        # One extra byte catches strings longer than the layout. Missing
+        # values come through as b'nan' and fail the layout check.
+        width = len(TIMESTAMP_LAYOUT) + 1
+        raw = np.asarray(column.array, dtype='S{}'.format(width))
+    except (UnicodeEncodeError, ValueError):
+        return None
+    chars = raw.view('uint8').reshape(len(raw), width)
+
+    # check the separators, the digits and that nothing follows the seconds
+    layout = np.frombuffer(TIMESTAMP_LAYOUT, dtype='uint8')
+    is_digit = layout == ord('0')
+    digits = chars[:, np.flatnonzero(is_digit)] - np.uint8(ord('0'))
+    if len(chars) and not ((chars[:, len(layout)] == 0).all()
+                           and (chars[:, np.flatnonzero(~is_digit)] == layout[~is_digit]).all()
+                           and (digits <= 9).all()):
+        return None
+
+    # Each field is a weighted sum of its digits, so all six fields come out
+    # of one matrix product (exact in float32 for numbers this size).
+    weights = np.zeros((digits.shape[1], 6), dtype='float32')
+    start = 0
+    for field, width in enumerate((4, 2, 2, 2, 2, 2)):
+        weights[start:start + width, field] = 10.0 ** np.arange(width - 1, -1, -1)
+        start += width
+    fields = (digits.astype('float32') @ weights).astype('int64')
+    year, month, day, hour, minute, second = fields.T
+    if not ((month >= 1) & (month <= 12) & (hour <= 23) & (minute <= 59) & (second <= 59)).all():
+        return None
+
+    # the day must exist in its month (eg. no 2017-02-30), counting 29
+    # February in leap years; anything else is left to pd.to_datetime to reject
+    leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    days_in_month = np.asarray(DAYS_IN_MONTH, dtype='int64')[month - 1] + (leap & (month == 2))
+    if not ((day >= 1) & (day <= days_in_month)).all():
+        return None
+
+    # days since 1970-01-01 for a proleptic Gregorian date, counting years
+    # from March so that the leap day comes last
+    y = year - (month <= 2)
+    era = y // 400
+    year_of_era = y - era * 400
+    day_of_year = (153 * ((month + 9) % 12) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    days = era * 146097 + day_of_era - 719468
+
+    seconds = days * 86400 + hour * 3600 + minute * 60 + second
+    return {'time': (seconds * 10 ** 9).view('datetime64[ns]'),
+            'month': month.astype('int8'),
+            # 1970-01-01 was a Thursday (day 3)
+            'weekday': ((days + 3) % 7).astype('int8'),
+            'hour': hour.astype('int8')}
+
+def convert_city_data(df):
+    '''Converts a freshly read city dataset into typed columns and adds the
+    derived month, day_of_week and start_hour columns.
+
+    Args:
+        df - pandas DataFrame as returned by pd.read_csv on a city file
+    Returns:
+        df - the same data with parsed timestamps, categorical text columns and
+        compact integer columns
+    '''
+    # convert the Start Time column to datetime and extract month, day of week
+    # and hour from it to create new columns, in one pass when the timestamps
+    # have the usual layout. The day name is stored as a categorical so the
+    # codes follow DAYS_OF_WEEK.
+    with stage('parse Start Time', rows=len(df)):
+        start = decode_timestamps(df['Start Time'])
+        if start is None:
+            # any other layout is left to pandas to work out
+            start_time = pd.to_datetime(df['Start Time'])
+            start = {'time': start_time,
+                     'month': start_time.dt.month.astype('int8').to_numpy(),
+                     'weekday': start_time.dt.dayofweek.astype('int8').to_numpy(),
+                     'hour': start_time.dt.hour.astype('int8').to_numpy()}
+    df['Start Time'] = start['time']
+    df['month'] = start['month']
+    df['day_of_week'] = pd.Categorical.from_codes(start['weekday'], categories=DAYS_OF_WEEK)
+    df['start_hour'] = start['hour']
+
+    if 'End Time' in df.columns:
+        with stage('parse End Time', rows=len(df)):
+            end = decode_timestamps(df['End Time'])
+            df['End Time'] = end['time'] if end is not None else pd.to_datetime(df['End Time'])
+
+    # keep the trips in Start Time order (see build_calendar_index)
+    df = df.sort_values('Start Time', kind='mergesort').reset_index(drop=True)
+
+    # Trip durations are whole seconds in most files, so they fit in an int32.
+    # Washington records fractions of a second, and a file with missing
+    # durations needs NaN for them, so those keep the float column.
+    duration = df['Trip Duration']
+    if (duration.dtype.kind == 'f' and duration.notnull().all() and (duration % 1 == 0).all()
+            and duration.max() <= np.iinfo('int32').max):
+        df['Trip Duration'] = duration.astype('int32')
+
+    # Birth years are whole numbers with gaps, so they are kept as nullable
+    # 16 bit integers (missing values stay missing).
+    if 'Birth Year' in df.columns and df['Birth Year'].dtype.kind == 'f':
+        birth_year = df['Birth Year']
+        if (birth_year.dropna() % 1 == 0).all():
+            df['Birth Year'] = birth_year.astype('Int16')
+
+    # Station names, user types and genders repeat heavily, so store them
+    # as categoricals (integer codes plus one copy of each name). Both station
+    # columns share one sorted station dictionary so that a station has the
+    # same code whether a trip starts or ends there (see station_codes).
+    stations = pd.Index(df['Start Station'].dropna().unique()).union(
+        pd.Index(df['End Station'].dropna().unique()))
+    for column in ('Start Station', 'End Station'):
+        df[column] = pd.Categorical(df[column], categories=stations)
+    for column in ('User Type', 'Gender'):
+        if column in df.columns:
+            df[column] = df[column].astype('category')
+    return df
+
+def memory_report(city_file):
+    '''Prints the memory used by each column of a city dataset when read with
+    pd.read_csv type inference and when read with the city's schema and
+    converted (see read_city_csv and convert_city_data).
+
+    Args:
+        (str) city_file - path to the city's .csv dataset
+    Returns:
+        (dict) total bytes 'before' and 'after'
+    '''
+    before = pd.read_csv(city_file).memory_usage(deep=True, index=False)
+    after = convert_city_data(read_city_csv(city_file)).memory_usage(deep=True, index=False)
+
+    print('\nMemory used by {} (MB):'.format(city_file))
+    print('{:<20}{:>12}{:>12}'.format('Column', 'Inferred', 'Schema'))
+    for column in after.index:
+        print('{:<20}{:>12}{:>12.1f}'.format(
+            column,
+            '{:.1f}'.format(before[column] / 1e6) if column in before.index else '-',
+            after[column] / 1e6))
+    print('{:<20}{:>12.1f}{:>12.1f}'.format('Total', before.sum() / 1e6, after.sum() / 1e6))
+    return {'before': int(before.sum()), 'after': int(after.sum())}
+
+def write_cache(df, cache_dir, fingerprint):
+    '''Writes a converted city dataset to disk as one .npy file per column.
+
+    Args:
+        df - converted city DataFrame (see convert_city_data)
+        (str) cache_dir - directory to write the columns to
+        (dict) fingerprint - file_fingerprint of the source .csv file
+    Returns:
+        none.
+    '''
+    # Write into a temporary directory first and move it into place at the
+    # end so that an interrupted write never leaves a half-built cache behind.
+    with atomic_directory(cache_dir) as tmp_dir:
+        columns = []
+        for i, name in enumerate(df.columns):
+            column = df[name]
+            if column.dtype == object or not (isinstance(column.dtype, (pd.CategoricalDtype, np.dtype))
+                                              or pd.api.types.is_integer_dtype(column.dtype)):
+                # any remaining text column is stored as a categorical as well
+                column = column.astype('category')
+
+            if isinstance(column.dtype, pd.CategoricalDtype):
+                np.save(os.path.join(tmp_dir, '{}.npy'.format(i)), column.cat.codes.to_numpy())
+                columns.append({'name': name, 'kind': 'category',
+                                'categories': column.cat.categories.tolist(),
+                                'ordered': bool(column.cat.ordered)})
+            elif isinstance(column.dtype, pd.api.extensions.ExtensionDtype):
+                # nullable integers (eg. Birth Year) are stored as their values
+                # plus a mask of the missing ones
+                np.save(os.path.join(tmp_dir, '{}.npy'.format(i)),
+                        column.to_numpy(dtype=column.dtype.numpy_dtype, na_value=0))
+                np.save(os.path.join(tmp_dir, '{}.mask.npy'.format(i)), column.isnull().to_numpy())
+                columns.append({'name': name, 'kind': 'masked'})
+            else:
+                np.save(os.path.join(tmp_dir, '{}.npy'.format(i)), column.to_numpy())
+                columns.append({'name': name, 'kind': 'array'})
+
+        meta = {'version': CACHE_VERSION, 'source': fingerprint,
+                'rows': len(df), 'columns': columns}
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+    return None
+
+def read_cache(cache_dir, fingerprint, columns=None, rows=None):
+    '''Reads a converted city dataset from disk if it matches the source file.
+
+    Args:
+        (str) cache_dir - directory the columns were written to
+        (dict) fingerprint - file_fingerprint of the source .csv file
+        (list) columns - names of the columns to read, or None for all of them
+        rows - slice or array of row positions to read, or None for every row.
+        When given, the column files are memory-mapped so only those rows are
+        read from disk.
+    Returns:
+        df - the cached DataFrame, or None if there is no valid cache
+    '''
+    try:
+        with open(os.path.join(cache_dir, 'meta.json')) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    # The cache is stale if the layout changed or the .csv file was replaced,
+    # appended to or touched since it was converted.
+    if meta.get('version') != CACHE_VERSION or meta.get('source') != fingerprint:
+        return None
+
+    data = {}
+    for i, column in enumerate(meta['columns']):
+        if columns is not None and column['name'] not in columns:
+            continue
+        files = ['{}.npy'.format(i)]
+        if column['kind'] == 'masked':
+            files.append('{}.mask.npy'.format(i))
+        if rows is None:
+            arrays = [np.load(os.path.join(cache_dir, name)) for name in files]
+        else:
+            arrays = [np.asarray(np.load(os.path.join(cache_dir, name), mmap_mode='r')[rows])
+                      for name in files]
+
+        values = arrays[0]
+        if column['kind'] == 'category':
+            values = pd.Categorical.from_codes(values, categories=column['categories'],
+                                               ordered=column['ordered'])
+        elif column['kind'] == 'masked':
+            values = pd.arrays.IntegerArray(values, arrays[1])
+        data[column['name']] = values
+    return pd.DataFrame(data, columns=list(data))
+
+def read_city_data(city_file):
+    '''Returns the full (unfiltered) converted dataset for a city, using the
+    on-disk column cache when it is up to date and rebuilding it otherwise.
+
+    Args:
+        (str) city_file - path to the city's .csv dataset
+    Returns:
+        df - pandas DataFrame containing all of the city's data
+    '''
+    fingerprint = file_fingerprint(city_file)
+    cache_dir = cache_path(city_file)
+
+    with stage('read cache', city=city_file):
+        df = read_cache(cache_dir, fingerprint)
+    if df is None:
+        # load data file into a dataframe and convert it for next time
+        with stage('read csv', city=city_file):
+            df = read_city_csv(city_file)
+        with stage('convert', city=city_file):
+            df = convert_city_data(df)
+        try:
+            with stage('write cache', city=city_file):
+                write_cache(df, cache_dir, fingerprint)
+        except OSError as error:
+            # a read-only data directory just means every load parses the .csv
+            print('Could not write dataset cache for {}: {}'.format(city_file, error))
+    return df
+
+## Row index
+# Paging, spot checks and month queries often need only a slice of a city file.
+# The row index is a small sidecar file, built in one scan, holding the byte
+# offset of every ROW_INDEX_STRIDE-th row, the first and last Start Time of
+# each block of ROW_INDEX_STRIDE rows and the number of rows. A window of rows
+# or the trips of a month are then read by memory-mapping the .csv and parsing
+# only the blocks that may hold them.
+ROW_INDEX_STRIDE = 1000
+# bytes of the .csv searched for line breaks at a time when building the index
+ROW_INDEX_SCAN_BYTES = 64 * 1024 ** 2
+# row indexes already loaded in this process, by absolute path of the .csv
+row_indexes = {}
+
+def row_index_path(city_file):
+    '''Returns the path of the row index file for a city file.
+
+    Args:
+        (str) city_file - path to the city's .csv dataset
+    Returns:
+        (str) path of the .npz row index (which may not exist yet)
+    '''
+    city_file = os.path.abspath(city_file)
+    return os.path.join(os.path.dirname(city_file), CACHE_DIR,
+                        os.path.basename(city_file) + '.rows.npz')
+
+def build_row_index(city_file, stride=ROW_INDEX_STRIDE):
+    '''Scans a city file for the byte offset of every stride-th row and the
+    range of start times in each block of stride rows.
+
+    Args:
+        (str) city_file - path to the city's .csv dataset
+        (int) stride - number of rows per block
+    Returns:
+        (dict) 'offsets' - int64 numpy array of the byte offset of the first
+        row of each block, followed by the file size, 'first' and 'last' -
+        datetime64[ns] numpy arrays of the earliest and latest Start Time of
+        each block, 'stride' and 'rows' (number of rows); or None if the file
+        cannot be indexed (eg. a quoted value spans several lines)
+    '''
+    offsets = []
+    newlines = 0
+    with open(city_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        size = len(data)
+        ends_with_newline = data[size - 1:] == b'\n'
+        # the header is line 0, so the n-th line break (from 0) starts row n
+        for pos in range(0, size, ROW_INDEX_SCAN_BYTES):
+            window = np.frombuffer(data, dtype='uint8', count=min(ROW_INDEX_SCAN_BYTES, size - pos),
+                                   offset=pos)
+            breaks = np.flatnonzero(window == ord('\n'))
+            del window
+            offsets.append(breaks[(-newlines) % stride::stride] + pos + 1)
+            newlines += len(breaks)
+    rows = newlines - 1 if ends_with_newline else newlines
+    offsets = np.concatenate(offsets + [np.array([size])]).astype('int64')
+    if ends_with_newline and len(offsets) > 1 and offsets[-2] == size:
+        # the last line break starts no row
+        offsets = np.delete(offsets, -2)
+
+    # start times are read a whole number of blocks at a time
+    first, last = [], []
+    parsed = 0
+    for chunk in pd.read_csv(city_file, usecols=['Start Time'], dtype=str,
+                             chunksize=stride * 100):
+        if len(chunk) == 0:
+            continue
+        decoded = decode_timestamps(chunk['Start Time'])
+        times = decoded['time'] if decoded is not None else pd.to_datetime(
+            chunk['Start Time']).to_numpy()
+        times = times.view('int64')
+        blocks = np.arange(0, len(times), stride)
+        first.append(np.minimum.reduceat(times, blocks))
+        last.append(np.maximum.reduceat(times, blocks))
+        parsed += len(times)
+    if parsed != rows:
+        return None
+    first = np.concatenate(first or [np.array([], dtype='int64')]).view('datetime64[ns]')
+    last = np.concatenate(last or [np.array([], dtype='int64')]).view('datetime64[ns]')
+    return {'offsets': offsets, 'first': first, 'last': last, 'stride': stride, 'rows': rows}
+
+def get_row_index(city_file):
+    '''Returns the row index of a city file, loading it from disk or building
+    (and saving) it when there is no up to date one.
+
+    Args:
+        (str) city_file - path to the city's .csv dataset
+    Returns:
+        (dict) row index (see build_row_index), or None if the file cannot be
+        indexed
+    '''
+    key = os.path.abspath(city_file)
+    fingerprint = file_fingerprint(city_file)
+    if key in row_indexes and row_indexes[key][0] == fingerprint:
+        return row_indexes[key][1]
+
+    with city_lock(city_file):
+        # another thread may have built it while this one waited
+        if key in row_indexes and row_indexes[key][0] == fingerprint:
+            return row_indexes[key][1]
+
+        path = row_index_path(city_file)
+        index = None
+        try:
+            with np.load(path) as saved:
+                meta = json.loads(str(saved['meta']))
+                if meta.get('version') == CACHE_VERSION and meta.get('source') == fingerprint:
+                    index = {'offsets': saved['offsets'], 'first': saved['first'],
+                             'last': saved['last'], 'stride': meta['stride'], 'rows': meta['rows']}
+        except (OSError, ValueError, KeyError):
+            pass
+
+        if index is None:
+            index = build_row_index(city_file)
+            if index is not None:
+                meta = {'version': CACHE_VERSION, 'source': fingerprint,
+                        'stride': index['stride'], 'rows': index['rows']}
+                try:
+                    with atomic_file(path, '.npz') as tmp_path:
+                        np.savez(tmp_path, offsets=index['offsets'], first=index['first'],
+                                 last=index['last'], meta=np.array(json.dumps(meta)))
+                except OSError:
+                    # the index is rebuilt on the next run instead
+                    pass
+        row_indexes[key] = (fingerprint, index)
+    return index
+
+def read_blocks(city_file, index, first_block, last_block):
+    '''Reads the rows of a run of blocks of a city file.
+
+    Args:
+        (str) city_file - path to the city's .csv dataset
+        (dict) index - row index of the file (see build_row_index)
+        (int) first_block - number of the first block to read
+        (int) last_block - number of the block after the last one to read
+    Returns:
+        df - pandas DataFrame as returned by read_city_csv, indexed by row
+        number in the file
+    '''
+    header, dtypes = city_dtypes(city_file)
+    offsets = index['offsets']
+    first_block = min(first_block, len(offsets) - 1)
+    with open(city_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        text = data[offsets[first_block]:offsets[min(last_block, len(offsets) - 1)]]
+    df = pd.read_csv(io.BytesIO(text), header=None, names=header, dtype=dtypes)
+    start = first_block * index['stride']
+    df.index = pd.RangeIndex(start, start + len(df))
+    return df
+
+def read_rows(city_file, start, stop):
+    '''Reads rows start to stop (not included) of a city file, parsing only
+    the blocks that hold them.
+
+    Args:
+        (str) city_file - path to the city's .csv dataset
+        (int) start - number of the first row (0 is the row after the header)
+        (int) stop - number of the row after the last one
+    Returns:
+        df - pandas DataFrame as returned by read_city_csv, indexed by row
+        number in the file
+    '''
+    index = get_row_index(city_file)
+    start, stop = max(start, 0), max(start, 0, stop)
+    if index is None:
+        # files that cannot be indexed are read up to the last row needed
+        df = read_city_csv(city_file, nrows=stop)
+        return df.iloc[start:stop]
+
+    stride = index['stride']
+    df = read_blocks(city_file, index, start // stride, -(-stop // stride))
+    return df.loc[start:stop - 1]
+
+def month_blocks(index, month):
+    '''Finds the blocks of a row index that may hold trips in a month (of any
+    year).
+
+    Args:
+        (dict) index - row index (see build_row_index)
+        (int) month - month number (1-12)
+    Returns:
+        boolean numpy array, one value per block
+    '''
+    # months counted from January 1970 (numpy's datetime64[M] epoch), so that
+    # a block spans the months lo to hi; January 1970 is month 0, so a month
+    # count m is calendar month m % 12 + 1
+    lo = index['first'].astype('datetime64[M]').astype('int64')
+    hi = index['last'].astype('datetime64[M]').astype('int64')
+    return (hi - lo >= 11) | ((month - 1 - lo) % 12 <= hi - lo)
+
+def read_block_runs(city_file, index, selected, chunksize):
+    '''Reads the selected blocks of a city file, a run of neighbouring blocks
+    at a time.
+
+    Args:
+        (str) city_file - path to the city's .csv dataset
+        (dict) index - row index (see build_row_index)
+        selected - boolean numpy array, one value per block
+        (int) chunksize - most rows to read at a time
+    Returns:
+        generator of DataFrames as returned by read_city_csv
+    '''
+    blocks_per_chunk = max(1, chunksize // index['stride'])
+    # starts and ends of the runs of selected blocks
+    edges = np.flatnonzero(np.diff(np.concatenate([[0], selected.astype('int8'), [0]])))
+    for run_start, run_end in zip(edges[::2], edges[1::2]):
+        for block in range(run_start, run_end, blocks_per_chunk):
+            yield read_blocks(city_file, index, block, min(block + blocks_per_chunk, run_end))
+
+## Partitioned storage
+# For histories too large for one in-memory file, partition_city splits a city
+# file into city/year=YYYY/month=MM/part-NNNNN directories, each holding the
+# converted trips of one month as per-column .npy files (see write_cache). A
+# catalogue.json at the root lists every part with its row count, first and
+# last Start Time and trips per day of week, so a query picks the parts it
+# needs from the catalogue alone and reads only those.
+PARTITION_ROOT = 'partitions'
+PARTITION_CATALOGUE = 'catalogue.json'
+# rows of the .csv file converted at a time; each chunk adds at most one part
+# to every month it covers
+PARTITION_CHUNKSIZE = 1000000
+
+def partition_name(city_file):
+    '''Returns the name of a city's directory in the partitioned layout.
+
+    Args:
+        (str) city_file - path to the city's .csv dataset
+    Returns:
+        (str) file name without the extension (eg. "new_york_city")
+    '''
+    return os.path.splitext(os.path.basename(city_file))[0]
+
+def load_catalogue(root):
+    '''Reads the catalogue of a partitioned dataset.
+
+    Args:
+        (str) root - root directory of the partitioned dataset
+    Returns:
+        (dict) catalogue entry of each city by partition_name, empty if there
+        is no valid catalogue
+    '''
+    try:
+        with open(os.path.join(root, PARTITION_CATALOGUE)) as f:
+            catalogue = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if catalogue.get('version') != CACHE_VERSION:
+        return {}
+    return catalogue['cities']
+
+def partition_city(city_file, root=PARTITION_ROOT, chunksize=PARTITION_CHUNKSIZE):
+    '''Converts a city file into partitions by year and month and records them
+    in the catalogue, replacing any earlier partitions of the city. The file
+    is read in chunks, so it does not need to fit in memory.
+
+    Args:
+        (str) city_file - path to the city's .csv dataset
+        (str) root - root directory of the partitioned dataset
+        (int) chunksize - number of .csv rows converted at a time
+    Returns:
+        (dict) the city's catalogue entry: 'source' - file_fingerprint of the
+        .csv file and 'parts' - path, year, month, rows, first and last Start
+        Time and trips per day of week of each part
+    '''
+    fingerprint = file_fingerprint(city_file)
+    city_dir = os.path.join(root, partition_name(city_file))
+
+    parts = []
+    with atomic_directory(city_dir) as tmp_dir:
+        for n, chunk in enumerate(read_city_csv(city_file, chunksize=chunksize)):
+            with stage('partition', city=city_file, chunk=n, rows=len(chunk)):
+                # converted chunks are in Start Time order, so each month's
+                # trips are one run of rows
+                chunk = convert_city_data(chunk)
+                keys = chunk['Start Time'].dt.year.to_numpy() * 100 + chunk['month'].to_numpy()
+                edges = np.concatenate([[0], np.flatnonzero(np.diff(keys)) + 1, [len(chunk)]])
+                for first, last in zip(edges[:-1], edges[1:]):
+                    part = chunk.iloc[first:last].reset_index(drop=True)
+                    year, month = divmod(int(keys[first]), 100)
+                    path = os.path.join('year={}'.format(year), 'month={:02d}'.format(month),
+                                        'part-{:05d}'.format(n))
+                    write_cache(part, os.path.join(tmp_dir, path), fingerprint)
+                    weekdays = np.bincount(part['day_of_week'].cat.codes.to_numpy(), minlength=7)
+                    parts.append({'path': path, 'year': year, 'month': month, 'rows': len(part),
+                                  'first': str(part['Start Time'].iloc[0]),
+                                  'last': str(part['Start Time'].iloc[-1]),
+                                  'weekdays': weekdays.tolist()})
+
+    # the catalogue is written last, so it never lists parts that are not there
+    catalogue = load_catalogue(root)
+    catalogue[partition_name(city_file)] = {'source': fingerprint, 'parts': parts}
+    with atomic_file(os.path.join(root, PARTITION_CATALOGUE)) as tmp_path:
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': CACHE_VERSION, 'cities': catalogue}, f)
+    return catalogue[partition_name(city_file)]
+
+def select_partitions(parts, start=None, end=None, month=None, weekday=None):
+    '''Picks the parts that may hold trips in a time range, month and day of
+    week, from their catalogue statistics alone.
+
+    Args:
+        (list) parts - catalogue entries of the parts (see partition_city)
+        start - first Start Time to include (pandas Timestamp), or None
+        end - Start Time to stop before (pandas Timestamp), or None
+        (int) month - month number (1-12), or None for every month
+        (int) weekday - day of week number (Monday = 0), or None for every day
+    Returns:
+        (list) the catalogue entries of the parts to read
+    '''
+    selected = []
+    for part in parts:
+        if month is not None and part['month'] != month:
+            continue
+        if weekday is not None and not part['weekdays'][weekday]:
+            continue
+        if start is not None and pd.Timestamp(part['last']) < start:
+            continue
+        if end is not None and pd.Timestamp(part['first']) >= end:
+            continue
+        selected.append(part)
+    return selected
+
+def concat_partitions(frames):
+    '''Joins parts read from a partitioned dataset into one DataFrame. Each
+    part has its own categories, so categorical columns are recoded onto the
+    union of them, with both station columns sharing one station dictionary
+    as in convert_city_data.
+
+    Args:
+        frames - list of converted DataFrames with the same columns
+    Returns:
+        df - the joined DataFrame
+    '''
+    columns = frames[0].columns
+    categorical = [column for column in columns
+                   if isinstance(frames[0][column].dtype, pd.CategoricalDtype)]
+    df = pd.concat([frame.drop(columns=categorical) for frame in frames], ignore_index=True)
+
+    groups = [[column] for column in categorical if column not in ('Start Station', 'End Station')]
+    stations = [column for column in ('Start Station', 'End Station') if column in categorical]
+    if stations:
+        groups.append(stations)
+    for group in groups:
+        categories = [frame[column].cat.categories for frame in frames for column in group]
+        # eg. day_of_week keeps its calendar order, as every part has the same
+        # categories
+        union = categories[0]
+        for other in categories[1:]:
+            if not other.equals(union):
+                union = union.union(other)
+        for column in group:
+            codes = []
+            for frame in frames:
+                lookup = union.get_indexer(frame[column].cat.categories)
+                frame_codes = frame[column].cat.codes.to_numpy()
+                # missing values (-1) stay missing
+                codes.append(np.where(frame_codes >= 0, lookup[frame_codes], -1))
+            df[column] = pd.Categorical.from_codes(np.concatenate(codes), categories=union)
+    return df[list(columns)]
+
+def load_partitioned(city_file, month, day, start=None, end=None, root=PARTITION_ROOT):
+    '''Loads the trips of a city in a time range and month and/or day of week
+    from its partitions, reading only the parts the catalogue says may hold
+    any of them.
+
+    Args:
+        (str) city_file - path to the city's .csv dataset (only its name is
+        used, to find the city's partitions)
+        (str) month - name of the month to filter by, or "all"
+        (str) day - name of the day of week to filter by, or "all"
+        start - first Start Time to include (pandas Timestamp), or None
+        end - Start Time to stop before (pandas Timestamp), or None
+        (str) root - root directory of the partitioned dataset
+    Returns:
+        df - pandas DataFrame of the matching trips in Start Time order
+    '''
+    entry = load_catalogue(root).get(partition_name(city_file))
+    if not entry or not entry['parts']:
+        raise ValueError('{} has not been partitioned into {} (see --partition)'.format(city_file, root))
+    month_number, weekday = calendar_filter(month, day)
+    parts = select_partitions(entry['parts'], start, end, month_number, weekday)
+
+    city_dir = os.path.join(root, partition_name(city_file))
+    with stage('read partitions', city=city_file, parts=len(parts),
+               of=len(entry['parts'])) as record:
+        if parts:
+            frames = [read_cache(os.path.join(city_dir, part['path']), entry['source'])
+                      for part in parts]
+        else:
+            # an empty slice of any part still gives the columns and their types
+            frames = [read_cache(os.path.join(city_dir, entry['parts'][0]['path']), entry['source'],
+                                 rows=slice(0, 0))]
+        if any(frame is None for frame in frames):
+            raise ValueError('the partitions of {} are damaged, build them again with --partition'
+                             .format(city_file))
+        df = concat_partitions(frames) if len(frames) > 1 else frames[0]
+        record['rows'] = len(df)
+
+    # parts only group trips by month, so the filters are applied to the rows
+    keep = np.ones(len(df), dtype=bool)
+    if start is not None:
+        keep &= (df['Start Time'] >= start).to_numpy()
+    if end is not None:
+        keep &= (df['Start Time'] < end).to_numpy()
+    if month_number is not None:
+        keep &= df['month'].to_numpy() == month_number
+    if weekday is not None:
+        keep &= df['day_of_week'].cat.codes.to_numpy() == weekday
+    if not keep.all():
+        df = df[keep]
+    # parts from different chunks of an unsorted file may overlap in time
+    return df.sort_values('Start Time', kind='mergesort').reset_index(drop=True)
+
+## In-memory dataset registry
+# Converted city datasets are kept in memory between queries (eg. when the user
+# restarts main()) so that only the first query for a city pays for loading it.
+# The least recently used datasets are dropped once the registry holds more
+# than DATASET_MEMORY_BUDGET bytes. The most recent dataset is always kept.
+# Several cities can be loaded at once from different threads (see
+# multi_city_reports and serve), so the registry is only changed while holding
+# registry_lock. Datasets, and the indexes, cubes and other data built from
+# them, are loaded while holding only the city's own lock (see city_lock), so
+# each is built once however many threads ask for it, and different cities
+# still load at the same time.
+DATASET_MEMORY_BUDGET = 2 * 1024 ** 3
+dataset_registry = OrderedDict()
+registry_lock = threading.Lock()
+city_locks = {}
+
+def city_lock(city_file):
+    '''Returns the lock held while data of a city file is loaded or built.
+
+    Args:
+        (str) city_file - path to the city's .csv dataset
+    Returns:
+        threading.RLock of the city (the same one for every call)
+    '''
+    with registry_lock:
+        return city_locks.setdefault(os.path.abspath(city_file), threading.RLock())
+
+def get_registry_entry(city_file):
+    '''Returns the registry entry of a city, loading the dataset with
+    read_city_data if it is not held yet or the .csv file changed since it was
+    loaded.
+
+    Args:
+        (str) city_file - path to the city's .csv dataset
+    Returns:
+        (dict) 'fingerprint' of the file, 'df' - the converted dataset and
+        'nbytes' - memory held for the city, plus the 'index' and 'cube' once
+        they have been built
+    '''
+    fingerprint = file_fingerprint(city_file)
+    key = fingerprint['path']
+
+    with registry_lock:
+        entry = dataset_registry.get(key)
+        if entry is not None and entry['fingerprint'] == fingerprint:
+            # mark as most recently used
+            dataset_registry.move_to_end(key)
+            return entry
+
+    with city_lock(city_file):
+        # another thread may have loaded it while this one waited
+        with registry_lock:
+            entry = dataset_registry.get(key)
+        if entry is not None and entry['fingerprint'] == fingerprint:
+            return entry
+
+        df = read_city_data(city_file)
+        entry = {'fingerprint': fingerprint,
+                 'df': df,
+                 'nbytes': int(df.memory_usage(deep=True).sum())}
+        with registry_lock:
+            dataset_registry[key] = entry
+            dataset_registry.move_to_end(key)
+
+            # evict least recently used datasets until we are back under budget
+            while (len(dataset_registry) > 1 and
+                   sum(held['nbytes'] for held in dataset_registry.values()) > DATASET_MEMORY_BUDGET):
+                dataset_registry.popitem(last=False)
+    return entry
+
+def get_city_data(city_file):
+    '''Returns the full (unfiltered) converted dataset for a city from the
+    in-memory registry (see get_registry_entry).
+
+    The returned DataFrame is shared between queries, so callers must not
+    modify it in place (see load_data, which hands out shallow copies).
+
+    Args:
+        (str) city_file - path to the city's .csv dataset
+    Returns:
+        df - pandas DataFrame containing all of the city's data
+    '''
+    return get_registry_entry(city_file)['df']
+
+## Calendar partition index
+# Rows are kept sorted by Start Time. The index groups row positions by
+# (month, day of week) so any month/day selection is a handful of slices of a
+# precomputed array instead of a comparison against every row.
+def calendar_key(month, weekday):
+    '''Returns the calendar index key for a month number (1-12) and a day of
+    week number (Monday = 0).'''
+    return month * 7 + weekday
+
+def build_calendar_index(df):
+    '''Builds the calendar partition index for a converted city dataset.
+
+    Args:
+        df - converted city DataFrame (see convert_city_data)
+    Returns:
+        (dict) 'order' - row positions grouped by (month, day of week), in Start
+        Time order within each group, and 'offsets' - where each group starts in
+        'order' (group k is order[offsets[k]:offsets[k + 1]])
+    '''
+    keys = calendar_key(df['month'].to_numpy().astype('int16'),
+                        df['day_of_week'].cat.codes.to_numpy().astype('int16'))
+
+    # a stable sort keeps the Start Time order within each group
+    order = np.argsort(keys, kind='stable')
+    if len(df) < np.iinfo('int32').max:
+        order = order.astype('int32')
+    offsets = np.zeros(calendar_key(13, 0) + 1, dtype='int64')
+    offsets[1:] = np.cumsum(np.bincount(keys, minlength=calendar_key(13, 0)))
+    return {'order': order, 'offsets': offsets}
+
+def get_calendar_index(city_file):
+    '''Returns the calendar partition index for a city, building it the first
+    time it is needed for the dataset held in the registry.
+
+    Args:
+        (str) city_file - path to the city's .csv dataset
+    Returns:
+        (dict) calendar index (see build_calendar_index)
+    '''
+    entry = get_registry_entry(city_file)
+    with city_lock(city_file):
+        if entry.get('index') is None:
+            entry['index'] = build_calendar_index(entry['df'])
+            entry['nbytes'] += entry['index']['order'].nbytes
+    return entry['index']
+
+def calendar_rows(index, month=None, weekday=None):
+    '''Looks up the rows of a dataset that fall in a month and/or day of week.
+
+    Args:
+        (dict) index - calendar index (see build_calendar_index)
+        (int) month - month number (1-12), or None for every month
+        (int) weekday - day of week number (Monday = 0), or None for every day
+    Returns:
+        slice or array of row positions (in Start Time order), or None if no
+        filter applies
+    '''
+    order, offsets = index['order'], index['offsets']
+    if month is None and weekday is None:
+        return None
+
+    if month is not None and weekday is not None:
+        # one group, already in Start Time order
+        key = calendar_key(month, weekday)
+        return order[offsets[key]:offsets[key + 1]]
+
+    if month is not None:
+        # the seven day groups of the month sit next to each other
+        rows = order[offsets[calendar_key(month, 0)]:offsets[calendar_key(month + 1, 0)]]
+    else:
+        rows = np.concatenate([order[offsets[calendar_key(m, weekday)]:
+                                     offsets[calendar_key(m, weekday) + 1]]
+                               for m in range(1, 13)])
+    if len(rows) == 0:
+        return rows
+
+    # Rows sorted by Start Time put a single month of a single year in one
+    # contiguous block, which can be returned as a slice (a view of the data).
+    first, last = rows.min(), rows.max()
+    if last - first + 1 == len(rows):
+        return slice(int(first), int(last) + 1)
+    return np.sort(rows)
+
+def calendar_filter(month, day):
+    '''Turns the month and day chosen by the user into calendar index numbers.
+
+    Args:
+        (str) month - name of the month to filter by, or "all"
+        (str) day - name of the day of week to filter by, or "all"
+    Returns:
+        (int) month number (1-12) and (int) day of week number (Monday = 0),
+        each None for "all"
+    '''
+    # use the index of the months list to get the corresponding int
+    if month != 'all':
+        month = CALENDAR_MONTHS.index(month.title()) + 1
+    else:
+        month = None
+
+    # same for the day of week
+    if day != 'all':
+        day = DAYS_OF_WEEK.index(day.title())
+    else:
+        day = None
+    return month, day
+
 def load_data(city_file, month, day):
     """
     Loads data for the specified city and filters by month and day if applicable.
@@ -27,30 +1172,18 @@ def load_data(city_file, month, day):
         df - pandas DataFrame containing city data filtered by month and day
     """
 
-    # load data file into a dataframe
-    df = pd.read_csv(city_file)
-
-    # convert the Start Time column to datetime
-    df['Start Time'] = pd.to_datetime(df['Start Time'])
+    # get the converted data (parsed dates plus the month, day_of_week and
+    # start_hour columns) from the in-memory registry
+    df = get_city_data(city_file)
 
-    # extract month and day of week from Start Time to create new columns
-    df['month'] = df['Start Time'].dt.month
-    df['day_of_week'] = df['Start Time'].dt.weekday_name
-    df['start_hour'] = df['Start Time'].dt.hour
-
-    # filter by month if applicable
-    if month != 'all':
-        # use the index of the months list to get the corresponding int
-        months = ['January', 'February', 'March', 'April', 'May', 'June']
-        month = months.index(month) + 1
-
-       # filter by month to create the new dataframe
-        df = df[df['month'] == month]
-
-    # filter by day of week if applicable
-    if day != 'all':
-        # filter by day of week to create the new dataframe
-        df = df[df['day_of_week'] == day.title()]
+    # look up the matching rows in the calendar index rather than scanning
+    # the month and day_of_week columns. A shallow copy is returned so that
+    # columns added or replaced by the report functions do not leak into the
+    # shared dataset.
+    with stage('filter', city=city_file, month=month, day=day) as record:
+        rows = calendar_rows(get_calendar_index(city_file), *calendar_filter(month, day))
+        df = df.copy(deep=False) if rows is None else df.iloc[rows].copy(deep=False)
+        record['rows'] = len(df)
     return df
 
 
@@ -72,98 +1205,2217 @@ def get_city():
         else:
             break
 
-    # Allocate a filename based on valid city input
-    if city == "chicago":
-        city_file = CITY_DATA['chicago']
-    elif city == "new york":
-        city_file = CITY_DATA['new york city']
-    elif city == "washington":
-        city_file = CITY_DATA['washington']
-    return city_file
+    # Allocate a filename based on valid city input
+    if city == "chicago":
+        city_file = CITY_DATA['chicago']
+    elif city == "new york":
+        city_file = CITY_DATA['new york city']
+    elif city == "washington":
+        city_file = CITY_DATA['washington']
+    return city_file
+
+def get_time_period():
+    '''Asks the user for a time period and returns the specified filter.
+
+    Args:
+        none.
+    Returns:
+        (str) time period to filter the city's bikeshare dataset
+    '''
+    # Use a loop to determine if the time period input is valid.
+    while True:
+        input_time_period = input('\nWould you like to filter the data by month, day, both or not at'
+                        ' all? Type "none" for no time filter.\n')
+        time_period = input_time_period.lower()
+        if time_period not in ("month", "day", "both", "none"):
+            print(input_time_period + ' is not a valid time period, please try again.')
+        else:
+            break
+    return time_period
+
+def get_month(months=MONTHS):
+    '''Asks the user for a month and returns the specified month.
+
+    Args:
+        (list) months - names of the months to choose from
+    Returns:
+        (str) specified month to filter the city's bikeshare dataset
+    '''
+    # Use a loop to determine if the month specified is valid.
+    while True:
+        input_month = input('\nWhich month? ' + ', '.join(months[:-1]) + ', or ' + months[-1] + '?\n')
+        month = input_month.lower()
+        if month not in [name.lower() for name in months]:
+            print(input_month + ' is not a valid month, please try again.')
+        else:
+            break
+    return month.title()
+
+def get_year(years):
+    '''Asks the user for a year of a partitioned dataset (see partition_city).
+
+    Args:
+        (list) years - the years the dataset has trips in
+    Returns:
+        (int) specified year, or "all" for every year
+    '''
+    # Use a loop to determine if the year specified is valid.
+    while True:
+        input_year = input('\nWhich year? ' + ', '.join(str(year) for year in years) + ' or all?\n')
+        year = input_year.strip().lower()
+        if year == 'all':
+            return year
+        if year.isdigit() and int(year) in years:
+            return int(year)
+        print(input_year + ' is not a valid year, please try again.')
+
+def get_day():
+    '''Asks the user for a day and returns the specified day to filter the city's bikeshare dataset.
+
+    Args:
+        none.
+    Returns:
+        (str) specified day to filter the city's bikeshare dataset
+    '''
+    # Use a loop to determine if the day specified is valid.
+    days_of_week = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
+    while True:
+        input_day = input('\nWhich day? Please enter a day of the week (eg. Sunday).\n')
+        day = input_day.lower()
+        if day not in days_of_week:
+            print(input_day + ' is not a valid day, please try again.')
+        else:
+            break
+    return day.title()
+
+## Aggregation helpers
+# Each statistic needs the most common value of a column together with how
+# often it occurs. Rather than calling .mode() and then .value_counts() on the
+# same column, these helpers count every value once (with np.bincount on
+# integer codes where possible) and read both answers off the counts.
+def integer_counts(values):
+    '''Counts the occurrences of each value in an array of whole numbers.
+
+    Args:
+        values - numpy array of integers (or floats holding whole numbers)
+    Returns:
+        (int) smallest value and numpy array of counts, where counts[i] is the
+        number of times (smallest value + i) occurs. The counts are empty if
+        there are no values.
+    '''
+    if len(values) == 0:
+        return 0, np.zeros(0, dtype='int64')
+    values = values.astype('int64')
+    smallest = int(values.min())
+    return smallest, np.bincount(values - smallest)
+
+def numeric_values(column):
+    '''Returns the values of a numeric column as a numpy array. Nullable integer
+    columns (eg. Birth Year) become floats with NaN for missing values.
+
+    Args:
+        column - pandas Series
+    Returns:
+        numpy array, or None if the column is not numeric
+    '''
+    if isinstance(column.dtype, np.dtype):
+        return column.to_numpy()
+    if pd.api.types.is_numeric_dtype(column.dtype) and not isinstance(column.dtype, pd.CategoricalDtype):
+        return column.to_numpy(dtype='float64', na_value=np.nan)
+    return None
+
+def top_value(column):
+    '''Finds the most common value of a column and its count in a single
+    counting pass. Missing values are ignored and ties go to the smallest value,
+    as with .mode()[0].
+
+    Args:
+        column - pandas Series (categorical, integer, float or text)
+    Returns:
+        most common value (None if there are no values) and (int) its count
+    '''
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        # count the integer codes; -1 marks a missing value
+        codes = column.cat.codes.to_numpy()
+        counts = np.bincount(codes[codes >= 0], minlength=len(column.cat.categories))
+        if counts.sum() == 0:
+            return None, 0
+        top = int(counts.argmax())
+        return column.cat.categories[top], int(counts[top])
+
+    values = numeric_values(column)
+    if values is None or values.dtype.kind not in 'iuf':
+        values = None
+    elif values.dtype.kind == 'f':
+        values = values[~np.isnan(values)]
+        if not (values % 1 == 0).all():
+            values = None
+
+    if values is not None:
+        # whole numbers (eg. month, hour, birth year) are counted with bincount
+        smallest, counts = integer_counts(values)
+        if len(counts) == 0:
+            return None, 0
+        top = int(counts.argmax())
+        return smallest + top, int(counts[top])
+
+    # anything else falls back to a single hash-based count
+    counts = column.value_counts()
+    if len(counts) == 0:
+        return None, 0
+    top_count = counts.max()
+    return min(counts.index[counts == top_count]), int(top_count)
+
+def count_values(column, missing=None):
+    '''Counts how often each value of a column occurs in a single pass.
+
+    Args:
+        column - pandas Series (categorical or text)
+        (str) missing - label to count missing values under, or None to ignore them
+    Returns:
+        (dict) count for each value that occurs at least once
+    '''
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        codes = column.cat.codes.to_numpy()
+        counts = np.bincount(codes[codes >= 0], minlength=len(column.cat.categories))
+        totals = {value: int(count) for value, count in zip(column.cat.categories, counts) if count}
+        n_missing = int((codes < 0).sum())
+    else:
+        totals = {value: int(count) for value, count in column.value_counts().items()}
+        n_missing = int(column.isnull().sum())
+
+    if missing is not None and n_missing:
+        totals[missing] = totals.get(missing, 0) + n_missing
+    return totals
+
+## Station dictionary
+# Start -> end trips are counted as integer pairs (start id * number of stations
+# + end id) so no per-row text is built. Above this many possible pairs the
+# pairs are counted with np.unique instead of a dense np.bincount array.
+ROUTE_BINCOUNT_LIMIT = 2 ** 24
+
+def station_codes(df):
+    '''Returns integer station ids for the start and end of every trip, taken
+    from the shared station dictionary of the dataset.
+
+    Args:
+        df - city dataset containing Start Station and End Station data
+    Returns:
+        numpy arrays of start and end ids (-1 where the station is missing) and
+        the station names the ids refer to
+    '''
+    start, end = df['Start Station'], df['End Station']
+    if (isinstance(start.dtype, pd.CategoricalDtype) and isinstance(end.dtype, pd.CategoricalDtype)
+            and start.cat.categories.equals(end.cat.categories)):
+        return start.cat.codes.to_numpy(), end.cat.codes.to_numpy(), start.cat.categories
+
+    # the columns do not share a dictionary yet, so build one for both
+    codes, names = pd.factorize(pd.concat([start, end], ignore_index=True), sort=True)
+    return codes[:len(start)], codes[len(start):], names
+
+def top_route(df):
+    '''Finds the most common start -> end station combination and its count by
+    counting encoded station pairs. Only the winning pair is turned back into
+    names. Trips with a missing station are ignored and ties go to the
+    smallest pair, as with .mode()[0].
+
+    Args:
+        df - city dataset containing Start Station and End Station data
+    Returns:
+        (str) start station, (str) end station (both None if there are no
+        trips) and (int) the count of trips between them
+    '''
+    start, end, names = station_codes(df)
+    valid = (start >= 0) & (end >= 0)
+    n_stations = len(names)
+    pairs = start[valid].astype('int64') * n_stations + end[valid]
+    if len(pairs) == 0:
+        return None, None, 0
+
+    if n_stations * n_stations <= ROUTE_BINCOUNT_LIMIT:
+        counts = np.bincount(pairs)
+        top = int(counts.argmax())
+        top_count = counts[top]
+    else:
+        # np.unique returns the pairs in order, so argmax again picks the
+        # smallest of any tied pairs
+        pairs, counts = np.unique(pairs, return_counts=True)
+        top_count = counts.max()
+        top = int(pairs[counts.argmax()])
+    return names[top // n_stations], names[top % n_stations], int(top_count)
+
+## Report statistics
+# The statistics are first calculated into a report (a dict) and printed from
+# there, so the in-memory and the streaming paths share the printing code.
+def time_stats(df):
+    '''Calculates the most popular start month, day and hour of travel and
+    their trip counts from the filtered dataset.
+
+    Args:
+        df - filtered city dataset (see load_data)
+    Returns:
+        (dict) 'month' - (int) month number and count, 'day' - (str) day name
+        and count, 'hour' - (int) hour of day (0-23) and count
+    '''
+    return {'month': top_value(df['month']),
+            'day': top_value(df['day_of_week']),
+            'hour': top_value(df['start_hour'])}
+
+def trip_stats(df):
+    '''Calculates the trip duration and station statistics from the filtered
+    dataset.
+
+    Args:
+        df - filtered city dataset (see load_data)
+    Returns:
+        (dict) 'trip_count', 'duration_total' and 'duration_mean' (in seconds,
+        None if there are no durations), 'start_station' and 'end_station' -
+        name and count, 'route' - start name, end name and count
+    '''
+    duration = df['Trip Duration']
+    duration_count = int(duration.count())
+    duration_total = duration.sum().item()
+    return {'trip_count': len(df),
+            'duration_total': duration_total,
+            'duration_mean': duration_total / duration_count if duration_count else None,
+            'start_station': top_value(df['Start Station']),
+            'end_station': top_value(df['End Station']),
+            'route': top_route(df)}
+
+def demographic_counts(df):
+    '''Counts the trips of each combination of user type, gender and birth
+    year. Each column is encoded as integer codes once and the combinations
+    are counted with a single np.bincount; the DataFrame is not modified.
+
+    Args:
+        df - filtered city dataset (see load_data)
+    Returns:
+        numpy array of counts with a user type, gender and birth year axis
+        and (dict) the labels along each axis (see encode_labels), None for a
+        column the dataset does not have (its axis then has length 1)
+    '''
+    codes, labels = [], {}
+    for axis, column in CUBE_COLUMNS.items():
+        if column in df.columns:
+            labels[axis] = []
+            codes.append(encode_labels(df[column], labels[axis]))
+        else:
+            labels[axis] = None
+            codes.append(np.zeros(len(df), dtype='int64'))
+    shape = tuple(1 if labels[axis] is None else len(labels[axis]) for axis in CUBE_COLUMNS)
+    counts = np.bincount(np.ravel_multi_index(codes, shape), minlength=int(np.prod(shape)))
+    return counts.reshape(shape), labels
+
+def merge_demographic_counts(parts):
+    '''Adds up demographic counts of different rows (eg. chunks, partitions
+    or cities). Each part labels its axes in the order it first saw the
+    values, so the counts are placed by label rather than by position. A part
+    without a column that others have counts its trips as missing values.
+
+    Args:
+        (list) parts - (counts, labels) of each part (see demographic_counts)
+    Returns:
+        numpy array of counts and (dict) the labels along each axis, as
+        demographic_counts gives for the rows of all the parts together
+    '''
+    labels = {}
+    for axis in CUBE_COLUMNS:
+        if all(part_labels[axis] is None for _, part_labels in parts):
+            labels[axis] = None
+            continue
+        labels[axis] = []
+        for _, part_labels in parts:
+            labels[axis] += [label for label in part_labels[axis] or [None]
+                             if label not in labels[axis]]
+
+    shape = tuple(1 if labels[axis] is None else len(labels[axis]) for axis in CUBE_COLUMNS)
+    counts = np.zeros(shape, dtype='int64')
+    for part_counts, part_labels in parts:
+        positions = [[0] if labels[axis] is None
+                     else [labels[axis].index(label) for label in part_labels[axis] or [None]]
+                     for axis in CUBE_COLUMNS]
+        counts[np.ix_(*positions)] += part_counts
+    return counts, labels
+
+def label_totals(counts, labels):
+    '''Adds up counts by label, counting missing values (the None label) as
+    "Unknown". Labels with no trips are left out.'''
+    totals = {}
+    for label, count in zip(labels, counts):
+        if count:
+            label = 'Unknown' if label is None else label
+            totals[label] = totals.get(label, 0) + int(count)
+    return totals
+
+def demographic_crosstab(counts, labels):
+    '''Adds up the trips of each user type, gender and birth decade.
+
+    Args:
+        counts - numpy array of counts (see demographic_counts)
+        (dict) labels - the labels along each axis of counts
+    Returns:
+        (dict) 'user_types', 'genders' and 'decades' - the names along each
+        axis ('genders' and 'decades' are None if the dataset does not have
+        the column) and 'counts' - nested lists of trip counts
+    '''
+    groups, names = [], {}
+    for axis, key in (('user_type', 'user_types'), ('gender', 'genders'), ('birth_year', 'decades')):
+        if labels[axis] is None:
+            names[key] = None
+            groups.append(np.zeros(1, dtype='int64'))
+            continue
+        if axis == 'birth_year':
+            display = ['Unknown' if year is None else '{}s'.format(year // 10 * 10)
+                       for year in labels[axis]]
+        else:
+            display = ['Unknown' if label is None else str(label) for label in labels[axis]]
+        axis_names, group = np.unique(display, return_inverse=True)
+        names[key] = axis_names.tolist()
+        groups.append(group.ravel())
+
+    crosstab = np.zeros(tuple(int(group.max()) + 1 for group in groups), dtype='int64')
+    np.add.at(crosstab, np.ix_(*groups), counts)
+
+    # leave out the names no trip has (eg. outside the filters)
+    for i, key in enumerate(('user_types', 'genders', 'decades')):
+        if names[key] is not None:
+            keep = crosstab.sum(axis=tuple(j for j in range(3) if j != i)) > 0
+            crosstab = np.compress(keep, crosstab, axis=i)
+            names[key] = [name for name, kept in zip(names[key], keep) if kept]
+    names['counts'] = crosstab.tolist()
+    return names
+
+def demographic_stats(counts, labels):
+    '''Calculates the user type, gender and birth year statistics from the
+    trip counts of each combination of them (see demographic_counts).
+
+    Args:
+        counts - numpy array of counts with a user type, gender and birth
+        year axis
+        (dict) labels - the labels along each axis of counts
+    Returns:
+        (dict) 'user_types' and 'genders' - count of each value, 'birth_years' -
+        youngest, oldest, most common and its count, and 'demographics' - the
+        user type by gender by birth decade cross-tab (see
+        demographic_crosstab). 'genders' and 'birth_years' are None if the
+        dataset does not have the column.
+    '''
+    report = {'user_types': label_totals(counts.sum(axis=(1, 2)), labels['user_type']),
+              'genders': None,
+              'birth_years': None}
+    if labels['gender'] is not None:
+        report['genders'] = label_totals(counts.sum(axis=(0, 2)), labels['gender'])
+    if labels['birth_year'] is not None:
+        report['birth_years'] = {}
+        year_counts = counts.sum(axis=(0, 1))
+        known = np.array([year is not None for year in labels['birth_year']], dtype=bool)
+        if (known & (year_counts > 0)).any():
+            years = np.array([year for year in labels['birth_year'] if year is not None], dtype='int64')
+            year_counts = year_counts[known]
+            # in year order, argmax settles ties on the earliest year, as
+            # with .mode()[0]
+            order = np.argsort(years)
+            years, year_counts = years[order], year_counts[order]
+            seen = years[year_counts > 0]
+            top = int(year_counts.argmax())
+            report['birth_years'] = {'youngest': int(seen.max()),
+                                     'oldest': int(seen.min()),
+                                     'most_common': int(years[top]),
+                                     'most_common_count': int(year_counts[top])}
+    report['demographics'] = demographic_crosstab(counts, labels)
+    return report
+
+def user_stats(df):
+    '''Calculates the user type, gender and birth year statistics from the
+    filtered dataset. Missing user types and genders are counted as "Unknown".
+
+    Args:
+        df - filtered city dataset (see load_data)
+    Returns:
+        (dict) statistics (see demographic_stats)
+    '''
+    return demographic_stats(*demographic_counts(df))
+
+def compute_report(df):
+    '''Calculates every statistic in the report from the filtered dataset.
+
+    Args:
+        df - filtered city dataset (see load_data)
+    Returns:
+        (dict) report combining time_stats, trip_stats and user_stats
+    '''
+    report = time_stats(df)
+    report.update(trip_stats(df))
+    report.update(user_stats(df))
+    return report
+
+## Approximate top stations and routes
+# Exact station and route counts need one entry per distinct value, and on
+# years of data the number of distinct start -> end routes runs into millions.
+# The approximate mode keeps a heavy-hitters sketch instead: at most capacity
+# counters, kept in the mergeable form of Space-Saving (Misra-Gries with
+# weighted, mergeable updates). Whenever there are more counters than fit, the
+# (capacity + 1)-th largest count is taken off every counter and the counters
+# left at zero or below are dropped. Every count is then at most 'error' trips
+# short of the true count, and 'error' never exceeds total / (capacity + 1),
+# so any value seen in more than that many trips is still held. Sketches of
+# chunks or partitions merge the same way.
+APPROXIMATE_ERROR = 0.001
+TOP_N = 5
+
+def new_sketch(error=APPROXIMATE_ERROR, top=TOP_N):
+    '''Returns an empty heavy-hitters sketch.
+
+    Args:
+        (float) error - largest error allowed, as a fraction of the trips counted
+        (int) top - number of values listed in the report (see sketch_top)
+    Returns:
+        (dict) 'capacity' - most counters held, 'counts' - count of each value
+        held, 'error' - most that any count may be short by, 'total' - number
+        of trips counted and 'top'
+    '''
+    return {'capacity': max(int(np.ceil(1 / error)) - 1, top), 'counts': {}, 'error': 0,
+            'total': 0, 'top': top}
+
+def sketch_add(sketch, counts, error=0, total=None):
+    '''Adds counts (eg. the exact counts of a chunk, or another sketch's
+    counts) to a sketch, keeping at most its capacity of counters.
+
+    Args:
+        (dict) sketch - sketch (see new_sketch), updated in place
+        (dict) counts - count of each value to add
+        (int) error - most that the added counts may be short by
+        (int) total - number of trips the counts cover (default: their sum)
+    Returns:
+        (dict) the updated sketch
+    '''
+    merged = Counter(sketch['counts'])
+    merged.update(counts)
+    sketch['error'] += error
+    sketch['total'] += total if total is not None else sum(counts.values())
+
+    if len(merged) > sketch['capacity']:
+        values = np.fromiter(merged.values(), dtype='int64', count=len(merged))
+        cut = int(np.partition(values, len(values) - sketch['capacity'] - 1)
+                  [len(values) - sketch['capacity'] - 1])
+        merged = {value: count - cut for value, count in merged.items() if count > cut}
+        sketch['error'] += cut
+    sketch['counts'] = dict(merged)
+    return sketch
+
+def merge_sketches(sketch, other):
+    '''Adds one sketch to another (see sketch_add).'''
+    return sketch_add(sketch, other['counts'], other['error'], other['total'])
+
+def sketch_top(sketch):
+    '''Returns the sketch's most counted values, most counted first (ties go to
+    the smallest value).
+
+    Args:
+        (dict) sketch - sketch (see new_sketch)
+    Returns:
+        (list) (value, count) pairs, at most sketch['top'] of them; each true
+        count lies between count and count + sketch['error']
+    '''
+    items = sorted(sketch['counts'].items(), key=lambda item: (-item[1], item[0]))
+    return [(value, int(count)) for value, count in items[:sketch['top']]]
+
+## Streaming statistics
+# For city files too large to load at once, the .csv is read STREAM_CHUNKSIZE
+# rows at a time. Each chunk is filtered and folded into an accumulator of
+# counts and sums whose size does not depend on the number of rows, and which
+# can be merged with other accumulators.
+STREAM_CHUNKSIZE = 100000
+
+def integer_count_dict(values):
+    '''Returns the count of each whole number in an array as a dict (see
+    integer_counts).'''
+    smallest, counts = integer_counts(values)
+    return {smallest + i: int(count) for i, count in enumerate(counts) if count}
+
+def route_counts(df):
+    '''Counts the trips between each start -> end station pair in the dataset
+    (see top_route). Trips with a missing station are ignored.
+
+    Args:
+        df - city dataset containing Start Station and End Station data
+    Returns:
+        (dict) count for each (start station, end station) pair
+    '''
+    start, end, names = station_codes(df)
+    valid = (start >= 0) & (end >= 0)
+    n_stations = len(names)
+    pairs, counts = np.unique(start[valid].astype('int64') * n_stations + end[valid],
+                              return_counts=True)
+    return {(names[pair // n_stations], names[pair % n_stations]): int(count)
+            for pair, count in zip(pairs, counts)}
+
+def new_accumulator(error=None, top=TOP_N):
+    '''Returns an empty accumulator for the streaming statistics.
+
+    Args:
+        (float) error - count stations and routes approximately with this
+        error bound (see new_sketch) instead of exactly
+        (int) top - number of stations and routes listed in approximate reports
+    Returns:
+        (dict) trip count and duration sums plus a Counter for each counted
+        value (a sketch for stations and routes with an error bound).
+        'genders' and 'birth_years' stay None until a chunk with that column
+        is seen. 'demographics' holds the joint user type, gender and birth
+        year counts (see demographic_counts) once any trips are added.
+    '''
+    acc = {'trip_count': 0, 'duration_total': 0, 'duration_count': 0,
+           'month': Counter(), 'day': Counter(), 'hour': Counter(),
+           'start_station': Counter(), 'end_station': Counter(), 'route': Counter(),
+           'user_types': Counter(), 'genders': None, 'birth_years': None,
+           'demographics': None}
+    if error is not None:
+        for key in ('start_station', 'end_station', 'route'):
+            acc[key] = new_sketch(error, top)
+    return acc
+
+def accumulate(acc, df):
+    '''Adds the trips of a (filtered) chunk of city data to an accumulator.
+
+    Args:
+        (dict) acc - accumulator (see new_accumulator), updated in place
+        df - converted and filtered chunk of a city dataset
+    Returns:
+        (dict) the updated accumulator
+    '''
+    duration = df['Trip Duration']
+    acc['trip_count'] += len(df)
+    acc['duration_total'] += duration.sum().item()
+    acc['duration_count'] += int(duration.count())
+
+    # day of week is counted by its number so that ties are settled in
+    # calendar order, the same as top_value on the day_of_week column
+    acc['month'].update(integer_count_dict(df['month'].to_numpy()))
+    acc['day'].update(integer_count_dict(df['day_of_week'].cat.codes.to_numpy()))
+    acc['hour'].update(integer_count_dict(df['start_hour'].to_numpy()))
+
+    for key, counts in (('start_station', count_values(df['Start Station'])),
+                        ('end_station', count_values(df['End Station'])),
+                        ('route', route_counts(df))):
+        if isinstance(acc[key], Counter):
+            acc[key].update(counts)
+        else:
+            sketch_add(acc[key], counts)
+
+    acc['user_types'].update(count_values(df['User Type'], missing='Unknown'))
+    if 'Gender' in df.columns:
+        if acc['genders'] is None:
+            acc['genders'] = Counter()
+        acc['genders'].update(count_values(df['Gender'], missing='Unknown'))
+    if 'Birth Year' in df.columns:
+        if acc['birth_years'] is None:
+            acc['birth_years'] = Counter()
+        birth_years = numeric_values(df['Birth Year'])
+        acc['birth_years'].update(integer_count_dict(birth_years[~np.isnan(birth_years)]))
+    acc['demographics'] = merge_demographic_counts(
+        [part for part in (acc['demographics'], demographic_counts(df)) if part is not None])
+    return acc
+
+def merge_accumulators(acc, other):
+    '''Adds the counts and sums of one accumulator to another.
+
+    Args:
+        (dict) acc - accumulator to merge into, updated in place
+        (dict) other - accumulator to merge from
+    Returns:
+        (dict) the updated accumulator
+    '''
+    for key, value in other.items():
+        if value is None:
+            continue
+        if isinstance(value, Counter):
+            if acc[key] is None:
+                acc[key] = Counter()
+            acc[key].update(value)
+        elif isinstance(value, tuple):
+            # joint demographic counts (see demographic_counts)
+            acc[key] = merge_demographic_counts(
+                [part for part in (acc[key], value) if part is not None])
+        elif isinstance(value, dict):
+            merge_sketches(acc[key], value)
+        else:
+            acc[key] += value
+    return acc
+
+def counter_top(counter):
+    '''Returns the most common key of a Counter and its count, with ties going
+    to the smallest key (as with .mode()[0]), or (None, 0) if it is empty.'''
+    if not counter:
+        return None, 0
+    return min(counter.items(), key=lambda item: (-item[1], item[0]))
+
+def finalise_report(acc):
+    '''Turns an accumulator into a report with the same statistics as
+    compute_report gives for the same rows.
+
+    Args:
+        (dict) acc - accumulator (see new_accumulator)
+    Returns:
+        (dict) report (see compute_report)
+    '''
+    # stations and routes are either Counters or sketches (see new_sketch)
+    counts = {key: acc[key] if isinstance(acc[key], Counter) else acc[key]['counts']
+              for key in ('start_station', 'end_station', 'route')}
+    day, day_count = counter_top(acc['day'])
+    route, route_count = counter_top(counts['route'])
+    report = {'month': counter_top(acc['month']),
+              'day': (DAYS_OF_WEEK[day] if day is not None else None, day_count),
+              'hour': counter_top(acc['hour']),
+              'trip_count': acc['trip_count'],
+              'duration_total': acc['duration_total'],
+              'duration_mean': (acc['duration_total'] / acc['duration_count']
+                                if acc['duration_count'] else None),
+              'start_station': counter_top(counts['start_station']),
+              'end_station': counter_top(counts['end_station']),
+              'route': (route or (None, None)) + (route_count,),
+              'user_types': dict(acc['user_types']),
+              'genders': dict(acc['genders']) if acc['genders'] is not None else None,
+              'birth_years': None}
+
+    if acc['birth_years'] is not None:
+        report['birth_years'] = {}
+        if acc['birth_years']:
+            most_common, count = counter_top(acc['birth_years'])
+            report['birth_years'] = {'youngest': max(acc['birth_years']),
+                                     'oldest': min(acc['birth_years']),
+                                     'most_common': most_common,
+                                     'most_common_count': count}
+    # None if no rows at all were added, so there are no labels to list
+    report['demographics'] = (demographic_crosstab(*acc['demographics'])
+                              if acc['demographics'] is not None else None)
+
+    # approximate reports list the top stations and routes with the most that
+    # their counts may be short by
+    if not isinstance(acc['route'], Counter):
+        report['approximate'] = {key: {'top': sketch_top(acc[key]), 'error': acc[key]['error']}
+                                 for key in ('start_station', 'end_station', 'route')}
+    return report
+
+def stream_city_data(city_file, month, day, chunksize=STREAM_CHUNKSIZE):
+    '''Reads a city .csv file in chunks, yielding the converted rows of each
+    chunk that match the month and day filters.
+
+    Args:
+        (str) city_file - path to the city's .csv dataset
+        (str) month - name of the month to filter by, or "all"
+        (str) day - name of the day of week to filter by, or "all"
+        (int) chunksize - number of .csv rows to read at a time
+    Returns:
+        generator of converted (see convert_city_data) and filtered DataFrames
+    '''
+    month, weekday = calendar_filter(month, day)
+    index = get_row_index(city_file) if month is not None else None
+    if index is None:
+        chunks = read_city_csv(city_file, chunksize=chunksize)
+    else:
+        # only the blocks that may hold trips in the month are read
+        chunks = read_block_runs(city_file, index, month_blocks(index, month), chunksize)
+    for chunk in chunks:
+        chunk = convert_city_data(chunk)
+        mask = np.ones(len(chunk), dtype=bool)
+        if month is not None:
+            mask &= chunk['month'].to_numpy() == month
+        if weekday is not None:
+            mask &= chunk['day_of_week'].cat.codes.to_numpy() == weekday
+        yield chunk[mask]
+
+def stream_report(city_file, month, day, chunksize=STREAM_CHUNKSIZE, error=None, top=TOP_N):
+    '''Calculates the report for a city without loading the whole file, by
+    streaming it in chunks through an accumulator.
+
+    Args:
+        (str) city_file - path to the city's .csv dataset
+        (str) month - name of the month to filter by, or "all"
+        (str) day - name of the day of week to filter by, or "all"
+        (int) chunksize - number of .csv rows to read at a time
+        (float) error - count stations and routes approximately with this
+        error bound (see new_sketch), or None to count them exactly
+        (int) top - number of stations and routes listed when approximate
+    Returns:
+        (dict) report (see compute_report)
+    '''
+    acc = new_accumulator(error, top)
+    for chunk in stream_city_data(city_file, month, day, chunksize):
+        accumulate(acc, chunk)
+    return finalise_report(acc)
+
+## Parallel statistics
+# With several workers the filtered rows are split into one partition per
+# worker. Each worker process memory-maps the dataset's cached column files
+# (see write_cache), reads only the columns and rows of its partition, and
+# counts them into numpy arrays indexed by the cached integer codes: months,
+# days and hours by number, stations by their id in the shared station
+# dictionary and routes by their encoded station pair (see top_route). Every
+# partition is read from the same cache, so the arrays of all partitions line
+# up and the parent process merges them by adding them together. No copy of
+# the DataFrame is sent to workers and no per-value Python objects come back.
+REPORT_COLUMNS = ['Trip Duration', 'Start Station', 'End Station', 'User Type',
+                  'Gender', 'Birth Year', 'month', 'day_of_week', 'start_hour']
+
+def partition_rows(rows, n_rows, n_parts):
+    '''Splits a selection of rows into roughly equal partitions.
+
+    Args:
+        rows - slice or array of row positions (see calendar_rows), or None for
+        every row
+        (int) n_rows - number of rows in the dataset
+        (int) n_parts - number of partitions to make
+    Returns:
+        (list) slices or arrays of row positions, one per non-empty partition
+    '''
+    if rows is None:
+        rows = slice(0, n_rows)
+    if isinstance(rows, slice):
+        bounds = np.linspace(rows.start, rows.stop, n_parts + 1).astype('int64')
+        return [slice(int(start), int(stop))
+                for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+    return [part for part in np.array_split(rows, n_parts) if len(part)]
+
+def frame_counts(df, error=None, top=TOP_N):
+    '''Counts the trips of a (filtered) city dataset into numpy arrays.
+
+    Args:
+        df - converted city DataFrame with at least the REPORT_COLUMNS it has
+        (float) error - count stations and routes into sketches with this
+        error bound (see new_sketch), or None to count them exactly
+        (int) top - number of stations and routes listed when approximate
+    Returns:
+        (dict) 'trip_count', 'duration_total' and 'duration_count'; 'month',
+        'day' and 'hour' - numpy arrays of trips per month number, day of week
+        number and hour; 'stations' - the station names, 'start_station' and
+        'end_station' - trips per station id, 'route' - trips per encoded
+        station pair, as an array over every pair or, for too many stations
+        (see ROUTE_BINCOUNT_LIMIT), as the pairs seen and their counts; and
+        'demographics' - demographic_counts of the rows. With an error bound,
+        'start_station', 'end_station' and 'route' are sketches instead.
+    '''
+    duration = df['Trip Duration']
+    start, end, names = station_codes(df)
+    n_stations = len(names)
+    valid = (start >= 0) & (end >= 0)
+    pairs = start[valid].astype('int64') * n_stations + end[valid]
+    start_station = np.bincount(start[start >= 0], minlength=n_stations)
+    end_station = np.bincount(end[end >= 0], minlength=n_stations)
+    if error is not None:
+        # Stations take one counter each, but routes are counted a chunk of
+        # rows at a time and folded into a sketch, so no count of every pair
+        # is ever held (see new_sketch).
+        station = lambda i: names[i]
+        start_station = array_sketch(start_station, station, error, top)
+        end_station = array_sketch(end_station, station, error, top)
+        route = new_sketch(error, top)
+        for first in range(0, len(pairs), STREAM_CHUNKSIZE):
+            seen, counts = np.unique(pairs[first:first + STREAM_CHUNKSIZE], return_counts=True)
+            merge_sketches(route, array_sketch(counts, lambda i: (names[seen[i] // n_stations],
+                                                                  names[seen[i] % n_stations]),
+                                               error, top))
+    elif n_stations * n_stations <= ROUTE_BINCOUNT_LIMIT:
+        route = np.bincount(pairs, minlength=n_stations * n_stations)
+    else:
+        route = np.unique(pairs, return_counts=True)
+    return {'trip_count': len(df),
+            'duration_total': duration.sum().item(),
+            'duration_count': int(duration.count()),
+            'month': np.bincount(df['month'].to_numpy(), minlength=13),
+            'day': np.bincount(df['day_of_week'].cat.codes.to_numpy(), minlength=7),
+            'hour': np.bincount(df['start_hour'].to_numpy(), minlength=24),
+            'stations': names,
+            'start_station': start_station,
+            'end_station': end_station,
+            'route': route,
+            'demographics': demographic_counts(df)}
+
+def partition_counts(cache_dir, fingerprint, rows, error=None, top=TOP_N):
+    '''Worker process task: counts the trips of one partition of a cached city
+    dataset.
+
+    Args:
+        (str) cache_dir - cache directory of the city dataset (see cache_path)
+        (dict) fingerprint - file_fingerprint of the city's .csv file
+        rows - slice or array of row positions in the partition
+        (float) error, (int) top - see frame_counts
+    Returns:
+        (dict) counts of the partition (see frame_counts)
+    '''
+    df = read_cache(cache_dir, fingerprint, columns=REPORT_COLUMNS, rows=rows)
+    if df is None:
+        raise RuntimeError('The dataset cache {} changed during the query.'.format(cache_dir))
+    return frame_counts(df, error, top)
+
+def array_top(counts):
+    '''Returns the position of the largest count and the count, with ties
+    going to the smallest position, or (None, 0) if every count is 0.'''
+    if len(counts) == 0 or not counts.any():
+        return None, 0
+    top = int(counts.argmax())
+    return top, int(counts[top])
+
+def array_sketch(counts, label, error, top):
+    '''Builds a sketch (see new_sketch) of exact counts, as sketch_add would
+    from a dict of every non-zero count.
+
+    Args:
+        counts - numpy array of counts by position
+        label - function turning a position into the counted value
+        (float) error, (int) top - see new_sketch
+    Returns:
+        (dict) the sketch
+    '''
+    sketch = new_sketch(error, top)
+    seen = np.flatnonzero(counts)
+    if len(seen) > sketch['capacity'] + 1:
+        # only the capacity + 1 largest counts can decide what the sketch
+        # keeps, so the rest are never turned into dict entries
+        seen = seen[np.argpartition(counts[seen], len(seen) - sketch['capacity'] - 1)
+                    [len(seen) - sketch['capacity'] - 1:]]
+    return sketch_add(sketch, {label(i): int(counts[i]) for i in seen},
+                      total=int(counts.sum()))
+
+def finalise_counts(parts, error=None, top=TOP_N):
+    '''Merges the counts of every partition (see partition_counts) into a
+    report with the same statistics as compute_report gives for the same rows.
+
+    Args:
+        (list) parts - counts of each partition (see frame_counts)
+        (float) error - the error bound the stations and routes of the parts
+        were sketched with, or None if they were counted exactly
+        (int) top - number of stations and routes listed when approximate
+    Returns:
+        (dict) report (see compute_report)
+    '''
+    total = dict(parts[0])
+    for part in parts[1:]:
+        for key in ('trip_count', 'duration_total', 'duration_count', 'month', 'day', 'hour'):
+            total[key] = total[key] + part[key]
+
+    month, month_count = array_top(total['month'])
+    day, day_count = array_top(total['day'])
+    hour, hour_count = array_top(total['hour'])
+    report = {'month': (month, month_count),
+              'day': (DAYS_OF_WEEK[day] if day is not None else None, day_count),
+              'hour': (hour, hour_count),
+              'trip_count': total['trip_count'],
+              'duration_total': total['duration_total'],
+              'duration_mean': (total['duration_total'] / total['duration_count']
+                                if total['duration_count'] else None)}
+    stations = station_report(parts, error, top)
+    approximate = stations.pop('approximate', None)
+    report.update(stations)
+    report.update(demographic_stats(*merge_demographic_counts([part['demographics'] for part in parts])))
+    if approximate is not None:
+        report['approximate'] = approximate
+    return report
+
+def station_report(parts, error=None, top=TOP_N):
+    '''Merges the station and route counts of every partition into the
+    station and route statistics of the report (see finalise_counts).'''
+    if error is not None:
+        # the same statistics as finalise_report gives from sketches
+        sketches = {}
+        for key in ('start_station', 'end_station', 'route'):
+            sketches[key] = new_sketch(error, top)
+            for part in parts:
+                merge_sketches(sketches[key], part[key])
+        route, route_count = counter_top(sketches['route']['counts'])
+        return {'start_station': counter_top(sketches['start_station']['counts']),
+                'end_station': counter_top(sketches['end_station']['counts']),
+                'route': (route or (None, None)) + (route_count,),
+                'approximate': {key: {'top': sketch_top(sketch), 'error': sketch['error']}
+                                for key, sketch in sketches.items()}}
+
+    report = {}
+    names = parts[0]['stations']
+    n_stations = len(names)
+    for key in ('start_station', 'end_station'):
+        station, count = array_top(sum(part[key] for part in parts[1:]) + parts[0][key])
+        report[key] = (names[station] if station is not None else None, count)
+    if isinstance(parts[0]['route'], tuple):
+        # sparse route counts are added up by pair
+        pairs, inverse = np.unique(np.concatenate([part['route'][0] for part in parts]),
+                                   return_inverse=True)
+        route = np.bincount(inverse.ravel(), minlength=len(pairs),
+                            weights=np.concatenate([part['route'][1] for part in parts]))
+        route = route.astype('int64')
+        pair_of = lambda i: int(pairs[i])
+    else:
+        route = sum(part['route'] for part in parts[1:]) + parts[0]['route']
+        pair_of = int
+
+    pair, count = array_top(route)
+    if pair is None:
+        report['route'] = (None, None, 0)
+    else:
+        report['route'] = (names[pair_of(pair) // n_stations], names[pair_of(pair) % n_stations], count)
+    return report
+
+def parallel_report(city_file, month, day, workers, error=None, top=TOP_N):
+    '''Calculates the report for a city with a pool of worker processes, each
+    working on a partition of the filtered rows.
+
+    Args:
+        (str) city_file - path to the city's .csv dataset
+        (str) month - name of the month to filter by, or "all"
+        (str) day - name of the day of week to filter by, or "all"
+        (int) workers - number of worker processes (at most one per CPU is
+        started)
+        (float) error - count stations and routes approximately with this
+        error bound (see new_sketch), or None to count them exactly
+        (int) top - number of stations and routes listed when approximate
+    Returns:
+        (dict) report (see compute_report)
+    '''
+    # make sure the dataset and its column cache are up to date first
+    df = get_city_data(city_file)
+    fingerprint = file_fingerprint(city_file)
+    cache_dir = cache_path(city_file)
+    rows = calendar_rows(get_calendar_index(city_file), *calendar_filter(month, day))
+    # workers beyond the number of CPUs would only take turns on them
+    partitions = partition_rows(rows, len(df), min(workers, os.cpu_count() or 1))
+
+    if len(partitions) < 2 or read_cache(cache_dir, fingerprint, columns=[]) is None:
+        # nothing to split, or no usable column cache (eg. a read-only data
+        # directory), so work in this process instead
+        return finalise_counts([frame_counts(df if rows is None else df.iloc[rows], error, top)],
+                               error, top)
+
+    from concurrent.futures import ProcessPoolExecutor
+    n = len(partitions)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        parts = list(pool.map(partition_counts, [cache_dir] * n, [fingerprint] * n, partitions,
+                              [error] * n, [top] * n))
+    return finalise_counts(parts, error, top)
+
+## Aggregate cube
+# The popular times and user info statistics are all trip counts along month,
+# day of week, start hour, user type, gender or birth year. The cube holds the
+# trip count of every combination of those six values in one N-dimensional
+# array, built once per dataset and saved next to the column cache. Reports read
+# it by summing along axes instead of touching the rows. When rows are appended
+# to a city file, the incremental ingestion (see ingest_city) adds them to the
+# saved cube with cube_add, so the next get_cube does not rebuild it.
+#
+# The month, day and hour axes have a fixed size. The other axes grow with
+# their labels, which are kept in the order they were first seen. None is the
+# label for a missing value, and the whole axis label list is None when the
+# dataset does not have the column (eg. Gender in Washington).
+CUBE_AXES = ['month', 'day', 'hour', 'user_type', 'gender', 'birth_year']
+CUBE_COLUMNS = {'user_type': 'User Type', 'gender': 'Gender', 'birth_year': 'Birth Year'}
+CUBE_FILE = '.cube.npz'
+
+def new_cube(columns):
+    '''Returns an empty cube for a dataset.
+
+    Args:
+        columns - column names of the dataset
+    Returns:
+        (dict) 'counts' - numpy array of trip counts with one axis per entry of
+        CUBE_AXES and 'labels' - the labels along the user type, gender and birth
+        year axes
+    '''
+    labels = {axis: [] if column in columns else None for axis, column in CUBE_COLUMNS.items()}
+    shape = (12, 7, 24) + tuple(1 if labels[axis] is None else 0 for axis in CUBE_AXES[3:])
+    return {'counts': np.zeros(shape, dtype='int64'), 'labels': labels, 'marginals': None}
+
+def encode_labels(column, labels):
+    '''Encodes a column as positions in a list of labels, adding any value not
+    seen before to the end of the list.
+
+    Args:
+        column - pandas Series (categorical or other values)
+        (list) labels - labels seen so far, updated in place. None stands for a
+        missing value.
+    Returns:
+        numpy array holding the position in labels of each row's value
+    '''
+    if not isinstance(column.dtype, pd.CategoricalDtype):
+        column = column.astype('category')
+
+    lookup = []
+    for value in column.cat.categories.tolist() + [None]:
+        if isinstance(value, float):
+            # birth years are read as floats but counted as whole years
+            value = int(value)
+        if value not in labels:
+            labels.append(value)
+        lookup.append(labels.index(value))
+
+    # missing values have code -1, which picks the None label at the end
+    return np.asarray(lookup, dtype='int64')[column.cat.codes.to_numpy()]
+
+def cube_add(cube, df):
+    '''Adds the trips of a converted city dataset (or of newly appended rows)
+    to a cube.
+
+    Args:
+        (dict) cube - cube to add to (see new_cube), updated in place
+        df - converted city DataFrame
+    Returns:
+        (dict) the updated cube
+    '''
+    codes = [df['month'].to_numpy().astype('int64') - 1,
+             df['day_of_week'].cat.codes.to_numpy().astype('int64'),
+             df['start_hour'].to_numpy().astype('int64')]
+    for axis in CUBE_AXES[3:]:
+        if cube['labels'][axis] is None:
+            codes.append(np.zeros(len(df), dtype='int64'))
+        else:
+            codes.append(encode_labels(df[CUBE_COLUMNS[axis]], cube['labels'][axis]))
+
+    # grow the label axes to fit any new labels
+    counts = cube['counts']
+    padding = [(0, 0)] * 3 + [(0, len(cube['labels'][axis]) - counts.shape[i + 3])
+                               if cube['labels'][axis] is not None else (0, 0)
+                               for i, axis in enumerate(CUBE_AXES[3:])]
+    counts = np.pad(counts, padding, mode='constant')
+
+    flat = np.ravel_multi_index(codes, counts.shape)
+    counts += np.bincount(flat, minlength=counts.size).reshape(counts.shape)
+    cube['counts'] = counts
+    cube['marginals'] = None
+    cube['demographics'] = None
+    return cube
+
+def cube_marginal(cube, axis, month=None, weekday=None):
+    '''Returns the trip counts along one axis of the cube for a month and/or
+    day of week.
+
+    Args:
+        (dict) cube - cube (see new_cube)
+        (str) axis - one of CUBE_AXES
+        (int) month - month number (1-12), or None for every month
+        (int) weekday - day of week number (Monday = 0), or None for every day
+    Returns:
+        numpy array of trip counts, one per position along the axis
+    '''
+    # The counts of each axis against month and day of week are summed from
+    # the cube once, so later lookups only add up a few small arrays.
+    if cube['marginals'] is None:
+        cube['marginals'] = {}
+    key = 'hour' if axis in ('month', 'day') else axis
+    if key not in cube['marginals']:
+        position = CUBE_AXES.index(key)
+        cube['marginals'][key] = cube['counts'].sum(
+            axis=tuple(i for i in range(2, len(CUBE_AXES)) if i != position))
+    counts = cube['marginals'][key]
+
+    # zero the months and days that are filtered out, keeping the axes whole
+    # so positions along the month and day axes still match their numbers
+    if month is not None or weekday is not None:
+        selected = np.zeros(counts.shape[:2] + (1,), dtype=bool)
+        selected[slice(None) if month is None else month - 1,
+                 slice(None) if weekday is None else weekday] = True
+        counts = counts * selected
+    if axis == 'month':
+        return counts.sum(axis=(1, 2))
+    if axis == 'day':
+        return counts.sum(axis=(0, 2))
+    return counts.sum(axis=(0, 1))
+
+def cube_top(counts, labels):
+    '''Returns the label with the largest count and its count, with ties
+    going to the smallest label (as with .mode()[0]), or (None, 0) if every
+    count is zero. Missing values (the None label) are never picked.'''
+    best = (None, 0)
+    for label, count in zip(labels, counts):
+        if label is not None and count and (count > best[1] or
+                                            (count == best[1] and label < best[0])):
+            best = (label, int(count))
+    return best
+
+def cube_time_stats(cube, month=None, weekday=None):
+    '''Reads the most popular start month, day and hour and their trip counts
+    from a cube (see time_stats).
+
+    Args:
+        (dict) cube - cube (see new_cube)
+        (int) month - month number (1-12), or None for every month
+        (int) weekday - day of week number (Monday = 0), or None for every day
+    Returns:
+        (dict) 'month', 'day' and 'hour' statistics, as with time_stats
+    '''
+    day, day_count = cube_top(cube_marginal(cube, 'day', month, weekday), range(7))
+    return {'month': cube_top(cube_marginal(cube, 'month', month, weekday), range(1, 13)),
+            'day': (DAYS_OF_WEEK[day] if day is not None else None, day_count),
+            'hour': cube_top(cube_marginal(cube, 'hour', month, weekday), range(24))}
+
+def cube_user_stats(cube, month=None, weekday=None):
+    '''Reads the user type, gender and birth year statistics from a cube (see
+    user_stats).
+
+    Args:
+        (dict) cube - cube (see new_cube)
+        (int) month - month number (1-12), or None for every month
+        (int) weekday - day of week number (Monday = 0), or None for every day
+    Returns:
+        (dict) 'user_types', 'genders', 'birth_years' and 'demographics'
+        statistics, as with user_stats
+    '''
+    # the user type, gender and birth year counts of each month and day of
+    # week are summed over the hours once
+    if cube.get('demographics') is None:
+        cube['demographics'] = cube['counts'].sum(axis=2)
+    counts = cube['demographics']
+    counts = counts[slice(None) if month is None else month - 1,
+                    slice(None) if weekday is None else weekday]
+    counts = counts.reshape((-1,) + counts.shape[-3:]).sum(axis=0)
+    return demographic_stats(counts, cube['labels'])
+
+def save_cube(cube, path, fingerprint):
+    '''Saves a cube to a .npz file.
+
+    Args:
+        (dict) cube - cube (see new_cube)
+        (str) path - file to write
+        (dict) fingerprint - file_fingerprint of the city's .csv file
+    Returns:
+        none.
+    '''
+    meta = {'version': CACHE_VERSION, 'source': fingerprint, 'labels': cube['labels']}
+    with atomic_file(path, '.npz') as tmp_path:
+        np.savez(tmp_path, counts=cube['counts'], meta=np.array(json.dumps(meta)))
+    return None
+
+def load_cube(path, fingerprint=None):
+    '''Loads a cube saved by save_cube if it matches the source file.
+
+    Args:
+        (str) path - file the cube was saved to
+        (dict) fingerprint - file_fingerprint of the city's .csv file, or None
+        to load the cube whatever file it was built from
+    Returns:
+        (dict) the cube with 'source' - the fingerprint it was saved with, or
+        None if there is no valid saved cube
+    '''
+    try:
+        with np.load(path) as saved:
+            meta = json.loads(str(saved['meta']))
+            counts = saved['counts']
+    except (OSError, ValueError, KeyError):
+        return None
+    if meta.get('version') != CACHE_VERSION:
+        return None
+    if fingerprint is not None and meta.get('source') != fingerprint:
+        return None
+    return {'counts': counts, 'labels': meta['labels'], 'marginals': None,
+            'source': meta.get('source')}
+
+def get_cube(city_file):
+    '''Returns the aggregate cube for a city, loading it from the cache
+    directory or building (and saving) it the first time it is needed.
+
+    Args:
+        (str) city_file - path to the city's .csv dataset
+    Returns:
+        (dict) cube (see new_cube)
+    '''
+    entry = get_registry_entry(city_file)
+    df = entry['df']
+    with city_lock(city_file):
+        if entry.get('cube') is None:
+            fingerprint = entry['fingerprint']
+            path = derived_path(city_file, CUBE_FILE)
+            cube = load_cube(path, fingerprint)
+            if cube is None:
+                cube = cube_add(new_cube(df.columns), df)
+                cube['counts'] = cube['counts'].astype('int32' if len(df) < 2 ** 31 else 'int64')
+                try:
+                    save_cube(cube, path, fingerprint)
+                except OSError:
+                    # the cube is rebuilt on the next run instead
+                    pass
+            entry['cube'] = cube
+            entry['nbytes'] += cube['counts'].nbytes
+    return entry['cube']
+
+## Trip duration distribution
+# Duration percentiles come from log-scale histograms instead of sorting the
+# durations of every query. Bucket 0 holds trips shorter than a second and
+# bucket b > 0 holds durations from DURATION_GROWTH ** (b - 1) up to
+# DURATION_GROWTH ** b seconds, so a percentile read from the middle of its
+# bucket is within about 2.5% of the exact one. The histogram is kept for every
+# month x day of week x hour x user type cell, built in one pass with
+# np.bincount, so any filter or grouping is a sum over cells and histograms of
+# new rows are simply added on. It is saved next to the aggregate cube.
+DURATION_GROWTH = 1.05
+# enough buckets for trips of up to 100 days
+DURATION_BUCKETS = int(math.ceil(math.log(100 * 86400) / math.log(DURATION_GROWTH))) + 1
+DURATION_QUANTILES = [0.5, 0.9, 0.99]
+DURATION_FILE = '.durations.npz'
+
+def new_duration_histogram():
+    '''Returns an empty duration histogram.
+
+    Args:
+        none.
+    Returns:
+        (dict) 'counts' - numpy array of trip counts by month (0-11), day of
+        week, hour, user type and duration bucket, and 'labels' - the user type
+        of each position on the user type axis (None for a missing user type)
+    '''
+    return {'counts': np.zeros((12, 7, 24, 0, DURATION_BUCKETS), dtype='int64'), 'labels': []}
+
+def duration_buckets(durations):
+    '''Returns the histogram bucket of each duration (in seconds).'''
+    durations = np.asarray(durations, dtype='float64')
+    buckets = np.floor(np.log(np.maximum(durations, 1)) / np.log(DURATION_GROWTH)) + 1
+    buckets[durations < 1] = 0
+    return np.minimum(buckets, DURATION_BUCKETS - 1).astype('int64')
+
+def bucket_durations(buckets):
+    '''Returns the duration (in seconds) in the middle of each bucket.'''
+    buckets = np.asarray(buckets)
+    return np.where(buckets > 0, DURATION_GROWTH ** (buckets - 0.5), 0.5)
+
+def duration_histogram_add(hist, df):
+    '''Adds the trip durations of a converted city dataset (or of newly
+    appended rows) to a duration histogram. Trips without a duration are left
+    out.
+
+    Args:
+        (dict) hist - histogram to add to (see new_duration_histogram),
+        updated in place
+        df - converted city DataFrame
+    Returns:
+        (dict) the updated histogram
+    '''
+    durations = numeric_values(df['Trip Duration'])
+    known = ~np.isnan(durations)
+    codes = [df['month'].to_numpy().astype('int64')[known] - 1,
+             df['day_of_week'].cat.codes.to_numpy().astype('int64')[known],
+             df['start_hour'].to_numpy().astype('int64')[known],
+             encode_labels(df['User Type'], hist['labels'])[known],
+             duration_buckets(durations[known])]
+
+    # grow the user type axis to fit any new labels
+    counts = hist['counts']
+    counts = np.pad(counts, [(0, 0)] * 3 + [(0, len(hist['labels']) - counts.shape[3]), (0, 0)],
+                    mode='constant')
+    flat = np.ravel_multi_index(codes, counts.shape)
+    counts += np.bincount(flat, minlength=counts.size).reshape(counts.shape)
+    hist['counts'] = counts
+    return hist
+
+def histogram_quantiles(counts, quantiles=DURATION_QUANTILES):
+    '''Reads quantiles off histograms.
+
+    Args:
+        counts - numpy array of histograms, with the buckets on the last axis
+        (list) quantiles - quantiles to read (eg. 0.5 for the median)
+    Returns:
+        float numpy array of durations in seconds, with one value per quantile
+        on the last axis (NaN for empty histograms)
+    '''
+    cumulative = np.cumsum(counts, axis=-1)
+    totals = cumulative[..., -1:]
+    # the first bucket reaching each quantile's share of the trips
+    targets = np.asarray(quantiles) * totals
+    buckets = (cumulative[..., None, :] < np.ceil(targets)[..., None]).sum(axis=-1)
+    values = bucket_durations(np.minimum(buckets, DURATION_BUCKETS - 1))
+    return np.where(totals > 0, values, np.nan)
+
+def duration_stats(hist, month=None, weekday=None):
+    '''Summarises the trip durations of a month and/or day of week.
+
+    Args:
+        (dict) hist - histogram (see new_duration_histogram)
+        (int) month - month number (1-12), or None for every month
+        (int) weekday - day of week number (Monday = 0), or None for every day
+    Returns:
+        (dict) 'durations' - 'quantiles' (list of the DURATION_QUANTILES),
+        'all' and lists of the 'hour', 'user_type' and 'month' groups; each
+        group is (label, trip count, [duration at each quantile in seconds])
+    '''
+    counts = hist['counts']
+    if month is not None:
+        counts = counts[month - 1:month]
+    if weekday is not None:
+        counts = counts[:, weekday:weekday + 1]
+
+    def groups(by_group, labels):
+        quantiles = histogram_quantiles(by_group)
+        return [(label, int(total), [round(float(value), 1) for value in values])
+                for label, total, values in zip(labels, by_group.sum(axis=-1), quantiles) if total]
+
+    user_types = ['Unknown' if label is None else label for label in hist['labels']]
+    return {'durations': {
+        'quantiles': DURATION_QUANTILES,
+        'all': groups(counts.sum(axis=(0, 1, 2, 3))[None], ['all'])[0] if counts.any() else None,
+        'hour': groups(counts.sum(axis=(0, 1, 3)), list(range(24))),
+        'user_type': groups(counts.sum(axis=(0, 1, 2)), user_types),
+        'month': groups(counts.sum(axis=(1, 2, 3)),
+                        [month] if month is not None else list(range(1, 13)))}}
+
+def get_duration_histogram(city_file):
+    '''Returns the duration histogram for a city, loading it from the cache
+    directory or building (and saving) it the first time it is needed.
+
+    Args:
+        (str) city_file - path to the city's .csv dataset
+    Returns:
+        (dict) histogram (see new_duration_histogram)
+    '''
+    entry = get_registry_entry(city_file)
+    with city_lock(city_file):
+        if entry.get('durations') is None:
+            fingerprint = entry['fingerprint']
+            path = derived_path(city_file, DURATION_FILE)
+            hist = None
+            try:
+                with np.load(path) as saved:
+                    meta = json.loads(str(saved['meta']))
+                    if (meta.get('version') == CACHE_VERSION and meta.get('source') == fingerprint
+                            and meta.get('growth') == DURATION_GROWTH):
+                        hist = {'counts': saved['counts'], 'labels': meta['labels']}
+            except (OSError, ValueError, KeyError):
+                pass
+
+            if hist is None:
+                hist = duration_histogram_add(new_duration_histogram(), entry['df'])
+                hist['counts'] = hist['counts'].astype('int32' if len(entry['df']) < 2 ** 31 else 'int64')
+                meta = {'version': CACHE_VERSION, 'source': fingerprint,
+                        'growth': DURATION_GROWTH, 'labels': hist['labels']}
+                try:
+                    # most cells are empty, so the file compresses well
+                    with atomic_file(path, '.npz') as tmp_path:
+                        np.savez_compressed(tmp_path, counts=hist['counts'],
+                                            meta=np.array(json.dumps(meta)))
+                except OSError:
+                    # the histogram is rebuilt on the next run instead
+                    pass
+            entry['durations'] = hist
+            entry['nbytes'] += hist['counts'].nbytes
+    return entry['durations']
+
+## Station and route rollups
+# Hourly departures from and arrivals at every station, and daily trips on
+# every route, are kept as compressed sparse rows: the non-zero counts of
+# series i are counts[offsets[i]:offsets[i + 1]], at time buckets (hours or
+# days since the rollups' origin, the midnight before the first trip) in the
+# same positions of buckets. Each array is a .npy file in the rollup directory
+# next to the column cache, opened with np.load(mmap_mode='r'), so reading a
+# station's or route's series only touches that series' part of the files.
+ROLLUP_DIR = '.rollups'
+ROLLUP_SERIES = {'departures': 'h', 'arrivals': 'h', 'routes': 'D'}
+
+def rollup_path(city_file):
+    '''Returns the directory the rollups of a city file are stored in.
+
+    Args:
+        (str) city_file - path to the city's .csv dataset
+    Returns:
+        (str) path of the rollup directory
+    '''
+    return derived_path(city_file, ROLLUP_DIR)
+
+def rollup_series(ids, buckets, n_series):
+    '''Counts trips per (series id, time bucket) as compressed sparse rows.
+
+    Args:
+        ids - numpy array of the series id of each trip (-1 to leave it out)
+        buckets - numpy array of the time bucket of each trip (-1 to leave it out)
+        (int) n_series - number of series
+    Returns:
+        (dict) 'offsets' (n_series + 1 positions), 'buckets' and 'counts'
+    '''
+    valid = (ids >= 0) & (buckets >= 0)
+    n_buckets = int(buckets.max()) + 1 if valid.any() else 1
+    # sorting the combined keys orders the counts by series, then by time
+    keys, counts = np.unique(ids[valid].astype('int64') * n_buckets + buckets[valid],
+                             return_counts=True)
+    offsets = np.searchsorted(keys // n_buckets, np.arange(n_series + 1))
+    return {'offsets': offsets.astype('int64'),
+            'buckets': (keys % n_buckets).astype('int32'),
+            'counts': counts.astype('int32')}
+
+def time_buckets(column, origin, unit):
+    '''Returns the number of whole hours or days from origin to each timestamp.
+
+    Args:
+        column - pandas Series of timestamps
+        (numpy.datetime64) origin - time of bucket 0
+        (str) unit - 'h' or 'D'
+    Returns:
+        numpy array of buckets (-1 where the timestamp is missing)
+    '''
+    times = column.to_numpy(dtype='datetime64[s]')
+    buckets = (times.astype('datetime64[' + unit + ']') - origin.astype('datetime64[' + unit + ']'))
+    buckets = buckets.astype('int64')
+    buckets[np.isnat(times)] = -1
+    return buckets
+
+def build_rollups(df):
+    '''Builds the hourly station and daily route rollups of a city dataset.
+
+    Args:
+        df - city dataset containing Start Time, End Time, Start Station and
+        End Station data
+    Returns:
+        (dict) 'origin' (numpy.datetime64), 'stations' - station names by id,
+        'pairs' - sorted start id * number of stations + end id of each route,
+        and a sparse rollup (see rollup_series) for each of ROLLUP_SERIES
+    '''
+    start, end, names = station_codes(df)
+    n_stations = len(names)
+    first = df['Start Time'].min()
+    origin = (np.datetime64('1970-01-01') if pd.isna(first)
+              else np.datetime64(first.normalize().to_datetime64(), 's'))
+
+    rollups = {'origin': origin, 'stations': [str(name) for name in names]}
+    rollups['departures'] = rollup_series(start, time_buckets(df['Start Time'], origin, 'h'),
+                                          n_stations)
+    rollups['arrivals'] = rollup_series(end, time_buckets(df['End Time'], origin, 'h'), n_stations)
+
+    # only the routes that were ridden get an id
+    valid = (start >= 0) & (end >= 0)
+    pairs = np.where(valid, start.astype('int64') * n_stations + end, -1)
+    rollups['pairs'], route_ids = np.unique(pairs[valid], return_inverse=True)
+    routes = np.full(len(pairs), -1, dtype='int64')
+    routes[valid] = route_ids
+    rollups['routes'] = rollup_series(routes, time_buckets(df['Start Time'], origin, 'D'),
+                                      len(rollups['pairs']))
+    return rollups
+
+def save_rollups(rollups, directory, fingerprint):
+    '''Saves rollups as .npy files with a rollups.json description, replacing
+    any saved before.
+
+    Args:
+        (dict) rollups - rollups (see build_rollups)
+        (str) directory - rollup directory to write
+        (dict) fingerprint - file_fingerprint of the city's .csv file
+    Returns:
+        none.
+    '''
+    with atomic_directory(directory) as tmp_dir:
+        np.save(os.path.join(tmp_dir, 'pairs.npy'), rollups['pairs'])
+        for series in ROLLUP_SERIES:
+            for key in ('offsets', 'buckets', 'counts'):
+                np.save(os.path.join(tmp_dir, '{}.{}.npy'.format(series, key)), rollups[series][key])
+        meta = {'version': CACHE_VERSION, 'source': fingerprint, 'origin': str(rollups['origin']),
+                'stations': rollups['stations']}
+        with open(os.path.join(tmp_dir, 'rollups.json'), 'w') as f:
+            json.dump(meta, f)
+    return None
+
+def load_rollups(directory, fingerprint):
+    '''Opens rollups saved by save_rollups if they match the source file. The
+    arrays are memory-mapped, not read.
+
+    Args:
+        (str) directory - rollup directory
+        (dict) fingerprint - file_fingerprint of the city's .csv file
+    Returns:
+        (dict) rollups (see build_rollups), or None if there are no valid
+        saved rollups
+    '''
+    try:
+        with open(os.path.join(directory, 'rollups.json')) as f:
+            meta = json.load(f)
+        if meta.get('version') != CACHE_VERSION or meta.get('source') != fingerprint:
+            return None
+        rollups = {'origin': np.datetime64(meta['origin'], 's'), 'stations': meta['stations'],
+                   'pairs': np.load(os.path.join(directory, 'pairs.npy'), mmap_mode='r')}
+        for series in ROLLUP_SERIES:
+            rollups[series] = {key: np.load(os.path.join(directory, '{}.{}.npy'.format(series, key)),
+                                            mmap_mode='r')
+                               for key in ('offsets', 'buckets', 'counts')}
+    except (OSError, ValueError, KeyError):
+        return None
+    return rollups
+
+def get_rollups(city_file):
+    '''Returns the rollups of a city, opening them from the cache
+    directory or building (and saving) them the first time they are needed.
+
+    Args:
+        (str) city_file - path to the city's .csv dataset
+    Returns:
+        (dict) rollups (see build_rollups)
+    '''
+    entry = get_registry_entry(city_file)
+    with city_lock(city_file):
+        if entry.get('rollups') is None:
+            directory = rollup_path(city_file)
+            rollups = load_rollups(directory, entry['fingerprint'])
+            if rollups is None:
+                rollups = build_rollups(entry['df'])
+                try:
+                    save_rollups(rollups, directory, entry['fingerprint'])
+                    # serve the memory-mapped copy rather than holding the arrays
+                    rollups = load_rollups(directory, entry['fingerprint']) or rollups
+                except OSError:
+                    # the rollups are rebuilt on the next run instead
+                    pass
+            rollups['station_ids'] = {name: i for i, name in enumerate(rollups['stations'])}
+            entry['rollups'] = rollups
+    return entry['rollups']
+
+def read_series(rollups, series, i):
+    '''Reads one series of a rollup as a pandas Series of counts by time.
+
+    Args:
+        (dict) rollups - rollups (see build_rollups)
+        (str) series - one of ROLLUP_SERIES
+        (int) i - station id, or route id for 'routes'
+    Returns:
+        pandas Series of the non-zero counts, indexed by the start of the hour
+        or day
+    '''
+    rollup = rollups[series]
+    first, last = int(rollup['offsets'][i]), int(rollup['offsets'][i + 1])
+    unit = ROLLUP_SERIES[series]
+    times = rollups['origin'].astype('datetime64[' + unit + ']') + \
+        np.asarray(rollup['buckets'][first:last]).astype('timedelta64[' + unit + ']')
+    return pd.Series(np.asarray(rollup['counts'][first:last]),
+                     index=pd.DatetimeIndex(times.astype('datetime64[s]')), name=series)
+
+def station_series(rollups, station):
+    '''Returns the hourly departures from and arrivals at a station.
+
+    Args:
+        (dict) rollups - rollups (see get_rollups)
+        (str) station - station name
+    Returns:
+        pandas DataFrame of departures and arrivals for every hour with either,
+        or None if there is no such station
+    '''
+    i = rollups['station_ids'].get(station)
+    if i is None:
+        return None
+    frame = pd.concat([read_series(rollups, 'departures', i), read_series(rollups, 'arrivals', i)],
+                      axis=1, sort=True)
+    return frame.fillna(0).astype('int64')
+
+def route_series(rollups, start_station, end_station):
+    '''Returns the daily trips from one station to another.
+
+    Args:
+        (dict) rollups - rollups (see get_rollups)
+        (str) start_station - name of the start station
+        (str) end_station - name of the end station
+    Returns:
+        pandas Series of trips for every day with any, or None if either
+        station is unknown (an empty Series if the route was never ridden)
+    '''
+    start = rollups['station_ids'].get(start_station)
+    end = rollups['station_ids'].get(end_station)
+    if start is None or end is None:
+        return None
+    pair = start * len(rollups['stations']) + end
+    route = int(np.searchsorted(rollups['pairs'], pair))
+    if route == len(rollups['pairs']) or rollups['pairs'][route] != pair:
+        return pd.Series([], index=pd.DatetimeIndex([], dtype='datetime64[s]'), dtype='int32',
+                         name='routes')
+    return read_series(rollups, 'routes', route)
+
+## Incremental ingestion
+# City files grow as new trips are appended. Rather than re-read the whole
+# history, the incremental mode keeps trip counts for every (month, day of
+# week) cell in a state directory next to the column cache, together with the
+# byte offset and row count read so far. A refresh parses only the rows after
+# that offset and counts them into a new part file, which is added to the list
+# in the state's small header (INGEST_HEADER), so the counts already stored
+# are never read or written again; once there are INGEST_MAX_PARTS parts the
+# next refresh combines them into one. Reports add up the parts' counts for
+# the cells that match the filters. A file that was rewritten rather than
+# appended to (it got shorter or the bytes before the offset changed) is read
+# again from the start. Only complete lines are read, so a row still being
+# written is picked up by the next refresh.
+#
+# Each part is a .npz file. Trips, durations and start hours are kept as
+# arrays over every cell (indexed by calendar_key). Stations, routes and user
+# demographics are kept as tables: one row of integer codes per cell and
+# value seen (eg. cell, start id, end id) and a count for each row. The codes
+# refer to label lists in the header that only ever grow (see encode_labels),
+# so the codes in older parts stay valid.
+INGEST_DIR_SUFFIX = '.ingest'
+INGEST_HEADER = 'state.json'
+INGEST_MAX_PARTS = 16
+# bytes kept from just before the offset to check that the file was appended to
+INGEST_CHECK_BYTES = 256
+# number of cells, enough for the calendar_key of every month (1-12) and day
+INGEST_CELLS = 13 * 7
+INGEST_ARRAYS = ['trips', 'duration_count', 'duration_total', 'hours']
+# the tables and the number of code columns in each
+INGEST_TABLES = {'start_stations': 2, 'end_stations': 2, 'routes': 3, 'demographics': 4}
+# parts already read in this process, by path, with the modification time
+# they were read at
+ingest_parts = {}
+
+def ingest_path(city_file):
+    '''Returns the path of the incremental ingestion state of a city file.
+
+    Args:
+        (str) city_file - path to the city's .csv dataset
+    Returns:
+        (str) path of the state directory (which may not exist yet)
+    '''
+    city_file = os.path.abspath(city_file)
+    return os.path.join(os.path.dirname(city_file), CACHE_DIR,
+                        os.path.basename(city_file) + INGEST_DIR_SUFFIX)
+
+def count_table(codes, counts=None):
+    '''Adds up the counts of each distinct row of a table of codes.
+
+    Args:
+        codes - numpy array of non-negative integer codes, one column per
+        coded value
+        counts - numpy array of the count of each row, or None to count every
+        row once
+    Returns:
+        numpy arrays of the distinct rows of codes and of their total counts
+    '''
+    if len(codes) == 0:
+        return codes.astype('int64'), np.zeros(0, dtype='int64')
+    shape = tuple(int(size) for size in codes.max(axis=0) + 1)
+    keys, inverse = np.unique(np.ravel_multi_index(tuple(codes.T), shape), return_inverse=True)
+    totals = np.bincount(inverse.ravel(), weights=counts, minlength=len(keys))
+    return np.stack(np.unravel_index(keys, shape), axis=1), totals.astype('int64')
+
+def new_ingest_counts():
+    '''Returns the counts of a part with no trips (see combine_ingest_counts).'''
+    part = {'trips': np.zeros(INGEST_CELLS, dtype='int64'),
+            'duration_count': np.zeros(INGEST_CELLS, dtype='int64'),
+            'duration_total': np.zeros(INGEST_CELLS, dtype='int64'),
+            'hours': np.zeros((INGEST_CELLS, 24), dtype='int64')}
+    for key, columns in INGEST_TABLES.items():
+        part[key] = (np.zeros((0, columns), dtype='int64'), np.zeros(0, dtype='int64'))
+    return part
+
+def ingest_counts(df, labels):
+    '''Counts the trips of a converted chunk of city data by (month, day of
+    week) cell.
+
+    Args:
+        df - converted chunk of a city dataset
+        (dict) labels - the state's label lists (see load_ingest_state),
+        extended in place with any new values
+    Returns:
+        (dict) part counts (see combine_ingest_counts)
+    '''
+    cell = calendar_key(df['month'].to_numpy().astype('int64'),
+                        df['day_of_week'].cat.codes.to_numpy().astype('int64'))
+    durations = numeric_values(df['Trip Duration'])
+    known = ~np.isnan(durations) if durations.dtype.kind == 'f' else np.ones(len(df), dtype=bool)
+    duration_total = np.bincount(cell[known], weights=durations[known], minlength=INGEST_CELLS)
+    if durations.dtype.kind != 'f':
+        # whole-second durations add up to whole numbers, as in trip_stats
+        duration_total = np.round(duration_total).astype('int64')
+    part = {'trips': np.bincount(cell, minlength=INGEST_CELLS),
+            'duration_count': np.bincount(cell[known], minlength=INGEST_CELLS),
+            'duration_total': duration_total,
+            'hours': np.bincount(cell * 24 + df['start_hour'].to_numpy().astype('int64'),
+                                 minlength=INGEST_CELLS * 24).reshape(INGEST_CELLS, 24)}
+
+    # missing stations are encoded as the None label and left out
+    start = encode_labels(df['Start Station'], labels['stations'])
+    end = encode_labels(df['End Station'], labels['stations'])
+    missing = labels['stations'].index(None)
+    part['start_stations'] = count_table(np.stack([cell, start], axis=1)[start != missing])
+    part['end_stations'] = count_table(np.stack([cell, end], axis=1)[end != missing])
+    valid = (start != missing) & (end != missing)
+    part['routes'] = count_table(np.stack([cell, start, end], axis=1)[valid])
+
+    codes = [cell]
+    for axis, column in CUBE_COLUMNS.items():
+        if labels[axis] is None:
+            codes.append(np.zeros(len(df), dtype='int64'))
+        else:
+            codes.append(encode_labels(df[column], labels[axis]))
+    part['demographics'] = count_table(np.stack(codes, axis=1))
+    return part
+
+def combine_ingest_counts(parts):
+    '''Adds up the counts of several parts.
+
+    Args:
+        (list) parts - part counts: 'trips', 'duration_count' and
+        'duration_total' - numpy arrays by cell, 'hours' - numpy array of
+        trips by cell and start hour, and 'start_stations', 'end_stations',
+        'routes' and 'demographics' - tables of codes and counts (see
+        count_table) whose first column is the cell
+    Returns:
+        (dict) the part counts of all the parts together
+    '''
+    combined = {key: sum(part[key] for part in parts[1:]) + parts[0][key] for key in INGEST_ARRAYS}
+    for key in INGEST_TABLES:
+        combined[key] = count_table(np.concatenate([part[key][0] for part in parts]),
+                                    np.concatenate([part[key][1] for part in parts]))
+    return combined
+
+def ingest_part_path(city_file, name):
+    '''Returns the path of a part file of a city's ingestion state.'''
+    return os.path.join(ingest_path(city_file), name)
+
+def write_ingest_part(city_file, name, part):
+    '''Writes the counts of a part (see combine_ingest_counts) to a .npz file
+    in the city's ingestion state directory.'''
+    path = ingest_part_path(city_file, name)
+    arrays = {key: part[key] for key in INGEST_ARRAYS}
+    for key in INGEST_TABLES:
+        # codes and counts are stored in the smallest integer type that holds
+        # them (mostly 8 or 16 bits) and read back as int64
+        for array_key, array in zip((key, key + '_counts'), part[key]):
+            arrays[array_key] = array.astype(np.min_scalar_type(array.max() if len(array) else 0))
+    with atomic_file(path, '.npz') as tmp_path:
+        np.savez(tmp_path, **arrays)
+    return None
+
+def read_ingest_part(city_file, name):
+    '''Reads the counts of a part (see combine_ingest_counts), once per
+    process unless the file has been replaced since.'''
+    path = ingest_part_path(city_file, name)
+    mtime = os.stat(path).st_mtime_ns
+    if path not in ingest_parts or ingest_parts[path][0] != mtime:
+        with np.load(path) as data:
+            part = {key: data[key] for key in INGEST_ARRAYS}
+            for key in INGEST_TABLES:
+                part[key] = (data[key].astype('int64'), data[key + '_counts'].astype('int64'))
+        ingest_parts[path] = (mtime, part)
+    return ingest_parts[path][1]
+
+def load_ingest_state(city_file):
+    '''Reads the header of the incremental ingestion state of a city file. The
+    counts themselves stay in the part files until a report needs them.
+
+    Args:
+        (str) city_file - path to the city's .csv dataset
+    Returns:
+        (dict) 'offset' - bytes read so far, 'rows' - rows read so far,
+        'check' - the bytes just before the offset (hex), 'labels' - the
+        station names and the user type, gender and birth year labels the
+        codes refer to (None for a column the file does not have), 'parts' -
+        names of the part files and 'next_part' - number of the next part;
+        or None if there is no usable state
+    '''
+    try:
+        with open(os.path.join(ingest_path(city_file), INGEST_HEADER)) as f:
+            stored = json.load(f)
+        if stored.get('version') != CACHE_VERSION:
+            return None
+        for key in ('offset', 'rows', 'check', 'labels', 'parts', 'next_part'):
+            stored[key]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    return stored
+
+def save_ingest_state(city_file, state):
+    '''Writes the header of the incremental ingestion state of a city file
+    (see load_ingest_state).'''
+    with atomic_file(os.path.join(ingest_path(city_file), INGEST_HEADER)) as tmp_path:
+        with open(tmp_path, 'w') as f:
+            json.dump(dict(state, version=CACHE_VERSION), f)
+    return None
+
+def add_ingest_part(city_file, state, part):
+    '''Stores the counts of newly read rows as a new part of the ingestion
+    state and saves the state's header. Once there are INGEST_MAX_PARTS parts,
+    they are combined with the new counts into a single part.
+
+    Args:
+        (str) city_file - path to the city's .csv dataset
+        (dict) state - ingestion state (see load_ingest_state), updated in place
+        (dict) part - counts of the new rows (see combine_ingest_counts)
+    Returns:
+        none.
+    '''
+    old_parts = []
+    if len(state['parts']) >= INGEST_MAX_PARTS:
+        old_parts = state['parts']
+        part = combine_ingest_counts([read_ingest_part(city_file, name) for name in old_parts]
+                                     + [part])
+        state['parts'] = []
+    name = 'part-{:05d}.npz'.format(state['next_part'])
+    write_ingest_part(city_file, name, part)
+    state['parts'].append(name)
+    state['next_part'] += 1
+    # the header is written before the combined parts are removed, so it never
+    # lists a part that is not there
+    save_ingest_state(city_file, state)
+    for old_name in old_parts:
+        os.remove(ingest_part_path(city_file, old_name))
+    return None
+
+def ingest_city(city_file, chunksize=STREAM_CHUNKSIZE):
+    '''Brings the incremental ingestion state of a city file up to date by
+    reading the rows appended since the last refresh.
+
+    Args:
+        (str) city_file - path to the city's .csv dataset
+        (int) chunksize - about how many rows to parse at a time
+    Returns:
+        (dict) the updated state (see load_ingest_state) and (int) the number
+        of rows read
+    '''
+    header, dtypes = city_dtypes(city_file)
+    state = load_ingest_state(city_file)
+    fingerprint = file_fingerprint(city_file)
+    cube_file = derived_path(city_file, CUBE_FILE)
+
+    with open(city_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        if state is not None:
+            # start again if the file was rewritten rather than appended to
+            offset = state['offset']
+            check = bytes.fromhex(state['check'])
+            if len(data) < offset or data[offset - len(check):offset] != check:
+                state = None
+        header_end = data.find(b'\n') + 1
+        started = state is None
+        if started:
+            shutil.rmtree(ingest_path(city_file), ignore_errors=True)
+            labels = {axis: [] if column in header else None for axis, column in CUBE_COLUMNS.items()}
+            labels['stations'] = []
+            state = {'offset': header_end, 'rows': 0, 'labels': labels, 'parts': [], 'next_part': 0}
+        rows_before = state['rows']
+
+        # only complete lines are read, about chunksize rows at a time going by
+        # the length of the first row
+        end = data.rfind(b'\n') + 1
+        step = chunksize * max(data.find(b'\n', header_end) + 1 - header_end, 1)
+        parts = []
+
+        # a saved cube (see get_cube) of the file as it was up to the offset
+        # gets the new rows too, instead of being rebuilt by the next query
+        cube = None
+        if end > state['offset']:
+            cube = load_cube(cube_file)
+            if cube is not None and (cube['source']['path'] != fingerprint['path']
+                                     or cube['source']['size'] != state['offset']):
+                cube = None
+        with stage('ingest', city=city_file) as record:
+            start = state['offset']
+            while start < end:
+                stop = data.rfind(b'\n', start, min(start + step, end)) + 1 or end
+                chunk = pd.read_csv(io.BytesIO(data[start:stop]), header=None, names=header,
+                                    dtype=dtypes)
+                chunk = convert_city_data(chunk)
+                parts.append(ingest_counts(chunk, state['labels']))
+                if cube is not None:
+                    cube_add(cube, chunk)
+                state['rows'] += len(chunk)
+                start = stop
+            record['rows'] = state['rows'] - rows_before
+        state['offset'] = end
+        state['check'] = data[max(end - INGEST_CHECK_BYTES, 0):end].hex()
+
+    try:
+        if parts:
+            add_ingest_part(city_file, state, combine_ingest_counts(parts))
+        elif started:
+            save_ingest_state(city_file, state)
+        # the cube now covers the whole file only if it ends with a complete line
+        if cube is not None and end == fingerprint['size']:
+            save_cube(cube, cube_file, fingerprint)
+    except OSError as error:
+        print('Could not write ingestion state for {}: {}'.format(city_file, error))
+    return state, state['rows'] - rows_before
+
+def ingested_counts(city_file, state, month=None, weekday=None):
+    '''Adds up the stored counts of the cells that match a month and/or day of
+    week filter.
+
+    Args:
+        (str) city_file - path to the city's .csv dataset
+        (dict) state - ingestion state (see load_ingest_state)
+        (int) month - month number (1-12), or None for every month
+        (int) weekday - day of week number (Monday = 0), or None for every day
+    Returns:
+        (dict) counts of the matching trips (see frame_counts)
+    '''
+    part = combine_ingest_counts([new_ingest_counts()] +
+                                 [read_ingest_part(city_file, name) for name in state['parts']])
+    cells = np.arange(INGEST_CELLS)
+    keep = np.ones(INGEST_CELLS, dtype=bool)
+    if month is not None:
+        keep &= cells // 7 == month
+    if weekday is not None:
+        keep &= cells % 7 == weekday
+    trips = np.where(keep, part['trips'], 0)
+    counts = {'trip_count': int(trips.sum()),
+              'duration_total': part['duration_total'][keep].sum().item(),
+              'duration_count': int(part['duration_count'][keep].sum()),
+              'month': np.bincount(cells // 7, weights=trips, minlength=13).astype('int64'),
+              'day': np.bincount(cells % 7, weights=trips, minlength=7).astype('int64'),
+              'hour': part['hours'][keep].sum(axis=0)}
+
+    def table(key):
+        codes, table_counts = part[key]
+        matching = keep[codes[:, 0]]
+        return codes[matching, 1:], table_counts[matching]
+
+    # stations are numbered in name order, as in the converted dataset, so
+    # ties go to the same station as in compute_report
+    stations = state['labels']['stations']
+    names = sorted(name for name in stations if name is not None)
+    rank = np.asarray([names.index(name) if name is not None else -1 for name in stations],
+                      dtype='int64')
+    n_stations = len(names)
+    counts['stations'] = names
+    for key, table_key in (('start_station', 'start_stations'), ('end_station', 'end_stations')):
+        codes, table_counts = table(table_key)
+        counts[key] = np.bincount(rank[codes[:, 0]], weights=table_counts,
+                                  minlength=n_stations).astype('int64')
+    codes, table_counts = table('routes')
+    pairs = rank[codes[:, 0]] * n_stations + rank[codes[:, 1]]
+    if n_stations * n_stations <= ROUTE_BINCOUNT_LIMIT:
+        counts['route'] = np.bincount(pairs, weights=table_counts,
+                                      minlength=n_stations * n_stations).astype('int64')
+    else:
+        pairs, table_counts = count_table(pairs.reshape(-1, 1), table_counts)
+        counts['route'] = (pairs.ravel(), table_counts)
+
+    # labels are put in the order demographic_counts gives them: the values
+    # in order, then None
+    codes, table_counts = table('demographics')
+    labels, positions = {}, []
+    for i, axis in enumerate(CUBE_COLUMNS):
+        if state['labels'][axis] is None:
+            labels[axis] = None
+            positions.append(codes[:, i])
+            continue
+        labels[axis] = sorted(label for label in state['labels'][axis] if label is not None) + [None]
+        position = np.asarray([labels[axis].index(label) for label in state['labels'][axis]],
+                              dtype='int64')
+        positions.append(position[codes[:, i]])
+    shape = tuple(1 if labels[axis] is None else len(labels[axis]) for axis in CUBE_COLUMNS)
+    demographics = np.bincount(np.ravel_multi_index(positions, shape), weights=table_counts,
+                               minlength=int(np.prod(shape)))
+    counts['demographics'] = (demographics.astype('int64').reshape(shape), labels)
+    return counts
+
+def merge_cells(cells, month=None, weekday=None):
+    '''Merges the accumulators of the cells that match a month and/or day of
+    week filter.
+
+    Args:
+        (dict) cells - accumulators by (month, weekday)
+        (int) month - month number (1-12), or None for every month
+        (int) weekday - day of week number (Monday = 0), or None for every day
+    Returns:
+        (dict) merged accumulator
+    '''
+    acc = new_accumulator()
+    for (cell_month, cell_weekday), cell in cells.items():
+        if ((month is None or cell_month == month) and
+                (weekday is None or cell_weekday == weekday)):
+            merge_accumulators(acc, cell)
+    return acc
+
+def ingested_report(city_file, month, day):
+    '''Refreshes the incremental ingestion state of a city file and returns
+    the report for the month and day filters.
+
+    Args:
+        (str) city_file - path to the city's .csv dataset
+        (str) month - name of the month to filter by, or "all"
+        (str) day - name of the day of week to filter by, or "all"
+    Returns:
+        (dict) report (see compute_report)
+    '''
+    state, _ = ingest_city(city_file)
+    return finalise_counts([ingested_counts(city_file, state, *calendar_filter(month, day))])
+
+## Report cache
+# The same few queries (eg. chicago / June / all) are asked again and again, so
+# finished reports are kept in REPORT_CACHE_FILE in the data directory's cache
+# directory. Entries are keyed by the city file's fingerprint and the filters,
+# so editing a .csv file makes its old reports unreachable, and the least
+# recently used entries are dropped once the stored reports take up more than
+# REPORT_CACHE_BYTES. A hit only appends its key to a small log next to the
+# cache file (REPORT_CACHE_LOG), so the order of use survives between runs
+# without rewriting every stored report; the log is folded in whenever the
+# cache itself is saved, which also happens once the log reaches
+# REPORT_CACHE_LOG_LINES hits, so a run that only ever gets hits (eg. the query
+# service) does not grow it without end.
+REPORT_CACHE_FILE = 'reports.json'
+REPORT_CACHE_LOG = 'reports.used'
+REPORT_CACHE_BYTES = 8 * 1024 * 1024
+REPORT_CACHE_LOG_LINES = 10000
+# report caches already read in this process, by path of the cache file
+report_caches = {}
+# size in bytes of each stored report as JSON, by path of the cache file and key
+report_sizes = {}
+# number of hits in the log of each report cache, by path of the cache file
+report_log_lines = {}
+# the query service (see serve) reads and stores reports from several threads
+report_cache_lock = threading.RLock()
+
+def report_cache_path(city_file):
+    '''Returns the path of the report cache file for a city file.
+
+    Args:
+        (str) city_file - path to the city's .csv dataset
+    Returns:
+        (str) path of the .json report cache
+    '''
+    return os.path.join(os.path.dirname(os.path.abspath(city_file)), CACHE_DIR, REPORT_CACHE_FILE)
+
+def report_key(city_file, month, day):
+    '''Returns the report cache key of a query.
 
-def get_time_period():
-    '''Asks the user for a time period and returns the specified filter.
+    Args:
+        (str) city_file - path to the city's .csv dataset
+        (str) month - name of the month to filter by, or "all"
+        (str) day - name of the day of week to filter by, or "all"
+    Returns:
+        (str) key built from the file's fingerprint and the filters
+    '''
+    fingerprint = file_fingerprint(city_file)
+    return json.dumps([fingerprint['path'], fingerprint['size'], fingerprint['mtime'],
+                       month.title(), day.title()])
+
+def report_log_path(path):
+    '''Returns the path of the log of cache hits kept next to a report cache.
 
     Args:
-        none.
+        (str) path - path of the .json report cache
     Returns:
-        (str) time period to filter the city's bikeshare dataset
+        (str) path of the log, one report key per line
     '''
-    # Use a loop to determine if the time period input is valid.
-    while True:
-        input_time_period = input('\nWould you like to filter the data by month, day, both or not at'
-                        ' all? Type "none" for no time filter.\n')
-        time_period = input_time_period.lower()
-        if time_period not in ("month", "day", "both", "none"):
-            print(input_time_period + ' is not a valid time period, please try again.')
-        else:
-            break
-    return time_period
+    return os.path.join(os.path.dirname(path), REPORT_CACHE_LOG)
 
-def get_month():
-    '''Asks the user for a month and returns the specified month.
+def load_report_cache(path):
+    '''Returns the report cache stored at path, reading it once per process.
+    Keys found in the hit log are moved to the most recently used end in the
+    order they were used.
 
     Args:
-        none.
+        (str) path - path of the .json report cache
     Returns:
-        (str) specified month to filter the city's bikeshare dataset
+        (OrderedDict) reports by key, least recently used first
     '''
-    # Use a loop to determine if the month specified is valid.
-    while True:
-        input_month = input('\nWhich month? January, February, March, April, May, or June?\n')
-        month = input_month.lower()
-        months = ["january", "february", "march", "april", "may", "june"]
-        if month not in months:
-            print(input_month + ' is not a valid month, please try again.')
-        else:
-            break
-    return month.title()
+    if path not in report_caches:
+        reports = OrderedDict()
+        try:
+            with open(path) as f:
+                stored = json.load(f)
+            if stored.get('version') == CACHE_VERSION:
+                reports.update(stored['reports'])
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            # a missing or damaged cache is simply started again
+            pass
+        lines = 0
+        try:
+            with open(report_log_path(path)) as f:
+                for line in f:
+                    lines += 1
+                    key = line.rstrip('\n')
+                    if key in reports:
+                        reports.move_to_end(key)
+        except OSError:
+            pass
+        report_caches[path] = reports
+        report_log_lines[path] = lines
+        report_sizes[path] = {key: len(key) + len(json.dumps(report))
+                              for key, report in reports.items()}
+    return report_caches[path]
 
-def get_day():
-    '''Asks the user for a day and returns the specified day to filter the city's bikeshare dataset.
+def get_cached_report(city_file, month, day):
+    '''Returns the cached report of a query, if there is one.
 
     Args:
-        none.
+        (str) city_file - path to the city's .csv dataset
+        (str) month - name of the month to filter by, or "all"
+        (str) day - name of the day of week to filter by, or "all"
     Returns:
-        (str) specified day to filter the city's bikeshare dataset
+        (dict) report (see compute_report), or None if the query is not cached
     '''
-    # Use a loop to determine if the day specified is valid.
-    days_of_week = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday"]
-    while True:
-        input_day = input('\nWhich day? Please enter a day of the week (eg. Sunday).\n')
-        day = input_day.lower()
-        if day not in days_of_week:
-            print(input_day + ' is not a valid day, please try again.')
+    key = report_key(city_file, month, day)
+    with report_cache_lock:
+        reports = load_report_cache(report_cache_path(city_file))
+        if key not in reports:
+            return None
+        reports.move_to_end(key)
+        path = report_cache_path(city_file)
+        if report_log_lines[path] >= REPORT_CACHE_LOG_LINES:
+            # fold the log into the cache file instead of growing it further
+            save_report_cache(path)
         else:
-            break
-    return day.title()
+            try:
+                # keys hold no newlines (see report_key), so one line is one hit
+                with open(report_log_path(path), 'a') as f:
+                    f.write(key + '\n')
+                report_log_lines[path] += 1
+            except OSError:
+                # the hit is still counted for the rest of this run
+                pass
+        return reports[key]
 
-def popular_month(df):
-    '''Calculates and prints the most popular start month of travel and count of trips
-    from the filtered dataset. Uses "Start Time" column.
+def store_report(city_file, month, day, report):
+    '''Adds a report to the report cache and saves the cache.
 
     Args:
-        df - filtered city dataset containing formatted (int) month numbers
+        (str) city_file - path to the city's .csv dataset
+        (str) month - name of the month the report is filtered by, or "all"
+        (str) day - name of the day of week the report is filtered by, or "all"
+        (dict) report - statistics (see compute_report)
     Returns:
         none.
     '''
-    # The dataframe (df) has the month data returning as a number (eg. Jan = 1, Feb = 2).
-    # This converts the number index into the relevant month.
-    months = ['January', 'February', 'March', 'April', 'May', 'June']
-    months = pd.Series(months, index=np.arange(1,7,1))
+    path = report_cache_path(city_file)
+    key = report_key(city_file, month, day)
+    with report_cache_lock:
+        reports = load_report_cache(path)
+
+        # reports are stored as they read back from JSON (tuples become lists) so
+        # that a report looks the same whether it was just stored or loaded
+        text = json.dumps(report)
+        reports[key] = json.loads(text)
+        reports.move_to_end(key)
+        sizes = report_sizes[path]
+        sizes[key] = len(key) + len(text)
+        # the newest report is kept even if it is bigger than the bound alone
+        total = sum(sizes.values())
+        while len(reports) > 1 and total > REPORT_CACHE_BYTES:
+            old_key, _ = reports.popitem(last=False)
+            total -= sizes.pop(old_key)
+        save_report_cache(path)
+    return None
+
+def save_report_cache(path):
+    '''Saves a report cache read with load_report_cache, in its order of use,
+    and removes its hit log.
 
-    # Calculates the most frequently occurring start month and returns it as a number
-    popular_month = df['month'].mode()[0]
+    Args:
+        (str) path - path of the .json report cache
+    Returns:
+        none.
+    '''
+    with report_cache_lock:
+        try:
+            with atomic_file(path) as tmp_path:
+                with open(tmp_path, 'w') as f:
+                    json.dump({'version': CACHE_VERSION,
+                               'reports': list(report_caches[path].items())}, f)
+            # the saved order already includes every logged hit
+            if os.path.exists(report_log_path(path)):
+                os.remove(report_log_path(path))
+            report_log_lines[path] = 0
+        except OSError as error:
+            # the reports stay cached for the rest of this run
+            print('Could not write report cache {}: {}'.format(path, error))
+    return None
 
-    # Takes the month number and looks it up in the months pandas array so that
-    # it returns the month name.
-    popular_month = months[popular_month]
+## Report printing
+def popular_month(report):
+    '''Prints the most popular start month of travel and count of trips
+    from the report (see time_stats).
 
-    # Determines how many times the most popular start month has occurred.
-    # .value_counts() sorts the count by descending order by default for each
-    # unique occurance and then .max() will return the maximum count. this
-    # equates to the count of the mode.
-    popular_month_trips = df['month'].value_counts().max()
+    Args:
+        (dict) report - statistics containing the (int) month number and count
+    Returns:
+        none.
+    '''
+    # The report has the month data returning as a number (eg. Jan = 1, Feb = 2).
+    # Takes the month number and looks it up in the CALENDAR_MONTHS list so
+    # that it returns the month name.
+    popular_month, popular_month_trips = report['month']
+    popular_month = CALENDAR_MONTHS[popular_month - 1]
 
     # print the above statistics and format the count using the thousands
     # comma separator using {:,}.
@@ -172,22 +3424,16 @@ def popular_month(df):
          )
     return None
 
-def popular_day(df):
-    '''Calculates and prints the most popular start day of travel and count
-    of trips from the filtered dataset. Uses "Start Time" column.
+def popular_day(report):
+    '''Prints the most popular start day of travel and count of trips from
+    the report (see time_stats).
 
     Args:
-        df - filtered city dataset containing formatted (str) day names
+        (dict) report - statistics containing the (str) day name and count
     Returns:
         none.
     '''
-    # determines the most common/popular start day has occurred.
-    popular_day = df['day_of_week'].mode()[0]
-
-    # .value_counts() sorts the count by descending order by default for
-    # each unique occurance. Then .max() will return the maximum count.
-    # This equtes to the count of the mode.
-    popular_day_trips = df['day_of_week'].value_counts().max()
+    popular_day, popular_day_trips = report['day']
 
     # print the above statistics and format the count using the thousands
     # comma separator using {:,}.
@@ -197,31 +3443,24 @@ def popular_day(df):
 
     return None
 
-def popular_hour(df):
-    '''Calculates and prints the most popular start hour of the day travelled
-    and count of trips from the filtered dataset. Uses "Start Time" column.
+def popular_hour(report):
+    '''Prints the most popular start hour of the day travelled and count of
+    trips from the report (see time_stats).
 
     Args:
-        df - filtered city dataset containing formatted time data, (int) as hour
-        number
+        (dict) report - statistics containing the (int) hour number and count
     Returns:
         none.
     '''
 
     # The dataset contains the hour of day as a number and refers to each
-    # in 24 hour time (eg.23 = 11pm). The below creates a pandas array to convert
-    # the integer times into AM / PM strings.
+    # in 24 hour time (eg.23 = 11pm). The below list converts the integer
+    # times into AM / PM strings. Midnight is hour 0, which is looked up as 24.
     hours = ['1 AM', '2 AM', '3 AM', '4 AM', '5 AM', '6 AM', '7 AM', '8 AM', '9 AM', '10 AM', '11 AM', '12 PM',
             '1 PM', '2 PM', '3 PM', '4 PM', '5 PM', '6 PM', '7 PM', '8 PM', '9 PM', '10 PM', '11 PM', '12 AM']
-    hour_list = pd.Series(hours, index=np.arange(1,25,1))
 
-    # determines the most common/popular start hour.
-    popular_start_hour = df['start_hour'].mode()[0]
-
-    # .value_counts() sorts the count by descending order by default
-    # .max() will return the maximum count (ie. which equates to the mode).
-    popular_start_hour = hour_list[popular_start_hour]
-    popular_start_hour_trips = df['start_hour'].value_counts().max()
+    popular_start_hour, popular_start_hour_trips = report['hour']
+    popular_start_hour = hours[(popular_start_hour or 24) - 1]
 
     # print the above statistics and format the count using the thousands
     # comma separator using {:,}.
@@ -230,8 +3469,8 @@ def popular_hour(df):
          )
     return None
 
-def trip_info(df):
-    '''Calculates and prints the following from the filtered dataset:
+def trip_info(report):
+    '''Prints the following from the report (see trip_stats):
     - Total trip duration and total count of trips (in days, HH: MM: SS)
     - Average trip duration (in HH:MM:SS)
     - Most popular start station and count
@@ -239,40 +3478,25 @@ def trip_info(df):
     - Most popular combination of start and end stations and count
 
     Args:
-        df - filtered city dataset containing formatted time data (duration
-        in seconds).
+        (dict) report - statistics containing the trip durations (in seconds)
+        and the most popular stations
     Returns:
         none.
     '''
-    # Display total travel time in seconds
-    total_duration = df['Trip Duration'].sum()
-
     #need to convert to int(seconds) to avoid typeerror when using datetime.timedelta.
     #This will make it "days, HH:MM:SS.
-    total_duration = datetime.timedelta(seconds=int(total_duration))
+    total_duration = datetime.timedelta(seconds=int(report['duration_total']))
 
     # Display mean travel times and convert to HH:MM:SS
-    trip_avg = df['Trip Duration'].mean()
-    trip_avg = datetime.timedelta(seconds=int(trip_avg))
+    trip_avg = datetime.timedelta(seconds=int(report['duration_mean'] or 0))
 
     # Total number of trips
-    total_trips = len(df['Trip Duration'])
-
-    # Calcualte most common/popular start station
-    pop_start_station = df['Start Station'].mode()[0]
-
-    # Calculate the count of trips for the most popular station
-    count_pop_start_station = df['Start Station'].value_counts().max()
+    total_trips = report['trip_count']
 
-    # Most common/popular end station and count
-    pop_end_station = df['End Station'].mode()[0]
-    count_pop_end_station = df['End Station'].value_counts().max()
-
-    # Most common/popular trip combination and count. Need to first
-    # concatenate start and end station columns.
-    df['Combined'] = df['Start Station'] + ' to ' + df['End Station']
-    pop_trip = df['Combined'].mode()[0]
-    count_pop_trip = df['Combined'].value_counts().max()
+    pop_start_station, count_pop_start_station = report['start_station']
+    pop_end_station, count_pop_end_station = report['end_station']
+    pop_trip_start, pop_trip_end, count_pop_trip = report['route']
+    pop_trip = '{} to {}'.format(pop_trip_start, pop_trip_end)
 
     # print the above statistics and format the count using the thousands
     # comma separator using {:,}.
@@ -290,52 +3514,98 @@ def trip_info(df):
      )
     return None
 
-def usertype_info(df):
-    '''Calculates and prints the following from the filtered dataset:
-    - Number of "Customer" type users and percentage against total users.
-    - Number of "Dependent" type users and percentage against total users.
-    - Number of "Subscriber" type users and percentage against total users.
-    - Number of "Unknown/Unspecified" type users and percentage against total users.
-    All data is sourced from the "User Type" column.
+def top_stations_info(report):
+    '''Prints the top start stations, end stations and routes of an
+    approximate report (see new_sketch), with how far their counts may be off.
 
     Args:
-        df - filtered city dataset containing User Type data.
+        (dict) report - statistics containing the 'approximate' top lists
+    Returns:
+        none.
+    '''
+    for key, title in (('start_station', 'start stations'), ('end_station', 'end stations'),
+                       ('route', 'trips from start to end')):
+        top = report['approximate'][key]
+        if top['error']:
+            print('\nTop {} (approximate, each count may be up to {:,} trips too low):'
+                  .format(title, top['error']))
+        else:
+            print('\nTop {}:'.format(title))
+        for rank, (value, count) in enumerate(top['top'], 1):
+            name = '{} to {}'.format(*value) if key == 'route' else value
+            print('{:>3}. {:<70} (Trip count: {:,})'.format(rank, name, count))
+    return None
+
+def duration_info(report):
+    '''Prints the trip duration percentiles from the report (see
+    duration_stats), overall and by start hour, user type and month.
 
+    Args:
+        (dict) report - statistics containing the duration percentiles
     Returns:
         none.
     '''
-    # There are null values in the Yser Type column so need to replace the NaN
-    # entries with "Unknown".
-    df['User Type'] = df['User Type'].fillna(value = 'Unknown')
+    durations = report['durations']
+    if durations['all'] is None:
+        print('No trip durations are available for these filters.')
+        return None
+
+    def hhmmss(seconds):
+        return str(datetime.timedelta(seconds=int(round(seconds))))
+
+    names = ['p{:g}'.format(quantile * 100) for quantile in durations['quantiles']]
+    _, _, overall = durations['all']
+    print('Trip duration percentiles (HH:MM:SS):            ' +
+          ', '.join('{} {}'.format(name, hhmmss(value)) for name, value in zip(names, overall)))
 
-    # Get total types and counts of each user_type and store in a dictionary
-    total_users = df['User Type'].value_counts().to_dict()
+    # the same hour names as popular_hour
+    def hour_name(hour):
+        return '{} {}'.format(hour % 12 or 12, 'AM' if hour < 12 else 'PM')
 
-    # Store counts against a variable for each valid column.
-    unique_values = df['User Type'].unique()
+    for key, title, label in (('hour', 'By start hour', hour_name),
+                              ('user_type', 'By user type', str),
+                              ('month', 'By start month', lambda month: CALENDAR_MONTHS[month - 1])):
+        print('\n{}:'.format(title))
+        print('    {:<14}{:>10}'.format('', 'Trips') + ''.join('{:>11}'.format(name) for name in names))
+        for group, trips, values in durations[key]:
+            print('    {:<14}{:>10,}'.format(label(group), trips) +
+                  ''.join('{:>11}'.format(hhmmss(value)) for value in values))
+    return None
 
-    # Set zero as default value in case not in dictionary.
-    total_customers, total_subscribers, total_unknown = 0, 0, 0
+def usertype_info(report):
+    '''Prints the following from the report (see user_stats):
+    - Number of "Customer" type users and percentage against total users.
+    - Number of "Dependent" type users and percentage against total users.
+    - Number of "Subscriber" type users and percentage against total users.
+    - Number of "Unknown/Unspecified" type users and percentage against total users.
+    All data is sourced from the "User Type" column.
 
-    # Take on the counts in the dictionary if they exist.
-    if 'Customer' in unique_values:
-        total_customers = total_users['Customer']
+    Args:
+        (dict) report - statistics containing the count of each user type.
 
-    if 'Subscriber' in unique_values:
-        total_subscribers = total_users['Subscriber']
+    Returns:
+        none.
+    '''
+    # Total types and counts of each user_type are stored in a dictionary.
+    # There are null values in the Yser Type column so these were counted as
+    # "Unknown".
+    total_users = report['user_types']
 
-    if 'Unknown' in unique_values:
-        total_unknown = total_users['Unknown']
+    # Take on the counts in the dictionary, with zero as default value in case
+    # a type is not in it. Note that not all datasets have the "Dependent"
+    # user type.
+    total_customers = total_users.get('Customer', 0)
+    total_subscribers = total_users.get('Subscriber', 0)
+    total_dependents = total_users.get('Dependent', 0)
+    total_unknown = total_users.get('Unknown', 0)
 
-    # Note that not all datasets have the "Dependent" user type. So need to
-    # check this specifically with an if statement otherwise will get errors.
-    if 'Dependent' in unique_values:
-        total_dependents = total_users['Dependent']
-    else:
-        total_dependents = 0
+    # A city file may have other user types, which are listed after these.
+    other_types = [(name, count) for name, count in total_users.items()
+                   if name not in ('Customer', 'Subscriber', 'Dependent', 'Unknown')]
 
     # Calculate the percantages of each type against the total
-    total_usertypes = total_customers + total_subscribers + total_dependents + total_unknown
+    total_usertypes = (total_customers + total_subscribers + total_dependents + total_unknown
+                       + sum(count for _, count in other_types))
     perc_customers = total_customers / total_usertypes
     perc_subscribers = total_subscribers / total_usertypes
     perc_dependents = total_dependents / total_usertypes
@@ -343,25 +3613,29 @@ def usertype_info(df):
 
     # This should equal to 100%. If not, then there is data that needs
     # to be added.
-    perc_total = perc_customers + perc_subscribers + perc_dependents + perc_unknown
+    perc_total = (perc_customers + perc_subscribers + perc_dependents + perc_unknown
+                  + sum(count / total_usertypes for _, count in other_types))
 
     # print the above statistics and format the count using the thousands
     # comma separator using {:,}. Also format the percentages.
     print('Number of "Customer" type users:                 {:,} ({:%} of total recorded users)\n'
           'Number of "Subscriber" type users:               {:,} ({:%} of total recorded users)\n'
           'Number of "Dependent" type users:                {:,} ({:%} of total recorded users)\n'
-          'Number of "Unknown" type users:                  {:,} ({:%} of total recorded users)\n'
-          'Total number of all user types:                  {:,} ({:%} of total recorded users)'
+          'Number of "Unknown" type users:                  {:,} ({:%} of total recorded users)'
          .format(
               total_customers, perc_customers, total_subscribers, perc_subscribers,
-              total_dependents, perc_dependents, total_unknown, perc_unknown,
-              total_usertypes, perc_total
+              total_dependents, perc_dependents, total_unknown, perc_unknown
               )
          )
+    for name, count in other_types:
+        print('{:<49}{:,} ({:%} of total recorded users)'.format(
+            'Number of "{}" type users:'.format(name), count, count / total_usertypes))
+    print('Total number of all user types:                  {:,} ({:%} of total recorded users)'
+          .format(total_usertypes, perc_total))
     return None
 
-def gender_info(df):
-    '''Calculates and prints the following from the filtered dataset:
+def gender_info(report):
+    '''Prints the following from the report (see user_stats):
     - Number of Male users and percentage against total users
     - Number of Female users and percentage against against total users
     - Number of Unknown gender users and percentage against total users
@@ -369,96 +3643,88 @@ def gender_info(df):
     All data is sourced from the "Gender" column.
 
     Args:
-        df - filtered city dataset containing Gender data.
+        (dict) report - statistics containing the count of each gender.
 
     Returns:
         none.
     '''
 
-    # The Washington dataset does not have the Gender column. So need to check
-    # this first before doing any calculations.
-    if 'Gender' not in df.columns:
+    # The Washington dataset does not have the Gender column, so the report
+    # has no gender counts for it.
+    if report['genders'] is None:
         print('No gender information is available in this dataset.')
     else:
-        # There are null values in the Gender column so need to replace the NaN
-        # entries with "Unknown".
-        df['Gender'] = df['Gender'].fillna(value = 'Unknown')
-
-        # Store counts for each type in a dictionary for easy reporting
-        total_genders = df['Gender'].value_counts().to_dict()
+        # Counts for each type are stored in a dictionary for easy reporting.
+        # There are null values in the Gender column so these were counted
+        # as "Unknown".
+        total_genders = report['genders']
 
-        # Store counts against a variable for each valid column.
-        unique_values = df['Gender'].unique()
+        # Take on the counts in the dictionary, with zero as default value in
+        # case a type is not in it.
+        total_males = total_genders.get('Male', 0)
+        total_females = total_genders.get('Female', 0)
+        total_unknown = total_genders.get('Unknown', 0)
 
-        # Set zero as default value in case not in dictionary.
-        total_males, total_females, total_unknown = 0, 0, 0
-
-        # Take on the counts in the dictionary if they exist.
-        if 'Male' in unique_values:
-            total_males = total_genders['Male']
-
-        if 'Female' in unique_values:
-            total_females = total_genders['Female']
-
-        if 'Unknown' in unique_values:
-            total_unknown = total_genders['Unknown']
+        # A city file may record other genders, which are listed after these.
+        other_genders = [(name, count) for name, count in total_genders.items()
+                         if name not in ('Male', 'Female', 'Unknown')]
 
         # Calculate the percantages of each type against the total
-        total_genders = total_males + total_females + total_unknown
+        total_genders = (total_males + total_females + total_unknown
+                         + sum(count for _, count in other_genders))
         perc_males = total_males / total_genders
         perc_females = total_females / total_genders
         perc_unknown = total_unknown / total_genders
 
         # This should equal to 100%. If not, then there is data that needs
         # to be added.
-        perc_total = perc_males + perc_females + perc_unknown
+        perc_total = (perc_males + perc_females + perc_unknown
+                      + sum(count / total_genders for _, count in other_genders))
 
         # print the above statistics and format the count using the thousands
         # comma separator using {:,}. Also format the percentages.
         print('\nNumber of Male users:                            {:,} ({:%} of total recorded users)\n'
               'Number of Female users:                          {:,} ({:%} of total recorded users)\n'
-              'Number of Unknown gender users:                  {:,} ({:%} of total recorded users)\n'
-              'Total number of all gender types:                {:,} ({:%} of total recorded users)'
+              'Number of Unknown gender users:                  {:,} ({:%} of total recorded users)'
               .format(
                   total_males, perc_males,
                   total_females, perc_females,
-                  total_unknown, perc_unknown,
-                  total_genders, perc_total
+                  total_unknown, perc_unknown
                   )
              )
+        for name, count in other_genders:
+            print('{:<49}{:,} ({:%} of total recorded users)'.format(
+                'Number of {} users:'.format(name), count, count / total_genders))
+        print('Total number of all gender types:                {:,} ({:%} of total recorded users)'
+              .format(total_genders, perc_total))
         return None
 
-def birthyear_info(df):
-    '''Calculates and prints the following from the filtered dataset:
+def birthyear_info(report):
+    '''Prints the following from the report (see user_stats):
     - Youngest user based on birth year
     - Oldest user based on birth year
     - User with the most common birth year and count
     All data is sourced from the "Birth Year" column.
 
     Args:
-        df - filtered city dataset containing Birth Year data.
+        (dict) report - statistics containing the birth year information.
 
     Returns:
         none.
     '''
-    # The Washington dataset does not have the Bith Year column. So need
-    # to check this first before doing any calculations.
-
-    if 'Birth Year' not in df.columns:
+    # The Washington dataset does not have the Bith Year column, so the
+    # report has no birth year information for it. The report is also empty if
+    # none of the filtered users recorded a birth year.
+    birth_years = report['birth_years']
+    if not birth_years:
         print('No birth year information is available in this dataset.')
     else:
-        # Note that there are null values in Birth Year but its
-        # consideration is not required for the below calculations
-
-        #youngest user
-        max_birthyear = int(df['Birth Year'].max())
-
-        #oldest user
-        min_birthyear = int(df['Birth Year'].min())
-
-        #most common user
-        frequent_birthyear = int(df['Birth Year'].mode()[0])
-        count_frequent_birthyear = df['Birth Year'].value_counts().max()
+        # Note that there are null values in Birth Year but they were left
+        # out of the below statistics
+        max_birthyear = birth_years['youngest']
+        min_birthyear = birth_years['oldest']
+        frequent_birthyear = birth_years['most_common']
+        count_frequent_birthyear = birth_years['most_common_count']
 
         # print the above statistics and format the count using the thousands
         # comma separator using {:,}.
@@ -472,18 +3738,168 @@ def birthyear_info(df):
 
     return None
 
+def demographics_info(report):
+    '''Prints the number of trips by each user type and gender (one row each)
+    and birth decade (one column each) from the report (see
+    demographic_crosstab).
+
+    Args:
+        (dict) report - statistics containing the demographics cross-tab
+    Returns:
+        none.
+    '''
+    crosstab = report.get('demographics')
+    if crosstab is None:
+        print('There are no trips to tabulate.')
+        return None
+
+    counts = np.asarray(crosstab['counts'], dtype='int64').reshape(
+        len(crosstab['user_types']), len(crosstab['genders'] or [None]),
+        len(crosstab['decades'] or [None]))
+    columns = crosstab['decades'] or []
+    print('{:<32}'.format('User type' + (' / gender' if crosstab['genders'] else '')) +
+          ''.join('{:>9}'.format(column) for column in columns) + '{:>10}'.format('Total'))
+    for i, user_type in enumerate(crosstab['user_types']):
+        for j, gender in enumerate(crosstab['genders'] or [None]):
+            row = counts[i, j]
+            if row.sum() == 0:
+                continue
+            name = user_type if gender is None else '{} / {}'.format(user_type, gender)
+            print('{:<32}'.format(name) + ''.join('{:>9,}'.format(count) for count in row[:len(columns)])
+                  + '{:>10,}'.format(int(row.sum())))
+    print('{:<32}'.format('Total') + ''.join('{:>9,}'.format(count) for count in
+                                              counts.sum(axis=(0, 1))[:len(columns)])
+          + '{:>10,}'.format(int(counts.sum())))
+    return None
+
+def print_report(report, month, day, demographics=False):
+    '''Prints the report sections for a query. The most popular month (day)
+    is left out when the data was filtered by month (day).
+
+    Args:
+        (dict) report - statistics (see compute_report)
+        (str) month - name of the month filtered by, or "all"
+        (str) day - name of the day of week filtered by, or "all"
+        (bool) demographics - also print the user type, gender and birth
+        decade table
+    Returns:
+        none.
+    '''
+    if report['trip_count'] == 0:
+        print('\nNo trips match these filters.')
+        return None
+
+    print('\n----- Popular times of travel -----')
+    if month == 'all':
+        popular_month(report)
+    if day == 'all':
+        popular_day(report)
+    popular_hour(report)
+
+    print('\n----- Popular stations and trip duration -----')
+    trip_info(report)
+    if 'approximate' in report:
+        top_stations_info(report)
+
+    if 'durations' in report:
+        print('\n----- Trip duration distribution -----')
+        duration_info(report)
+
+    print('\n----- User info -----')
+    usertype_info(report)
+    gender_info(report)
+    birthyear_info(report)
+
+    if demographics:
+        print('\n----- Trips by user type, gender and birth decade -----')
+        demographics_info(report)
+    return None
+
+def iter_pages(frames, page_size=5):
+    '''Splits a sequence of DataFrames into pages of rows.
+
+    Args:
+        frames - iterable of pandas DataFrames (eg. the chunks of a .csv file)
+        (int) page_size - number of rows per page
+    Returns:
+        generator of DataFrames of page_size rows (the last page may be shorter)
+    '''
+    carry = None
+    for frame in frames:
+        # rows left over from the previous frame start the next page
+        if carry is not None and len(carry):
+            frame = pd.concat([carry, frame])
+        start = 0
+        while len(frame) - start >= page_size:
+            yield frame.iloc[start:start + page_size]
+            start += page_size
+        carry = frame.iloc[start:]
+    if carry is not None and len(carry):
+        yield carry
+
+def raw_selection(city_file, month, day):
+    '''Looks up the raw rows of a query in the city's shared dataset, without
+    building the filtered DataFrame (see raw_page).
+
+    Args:
+        (str) city_file - path to the city's .csv dataset
+        (str) month - name of the month to filter by, or "all"
+        (str) day - name of the day of week to filter by, or "all"
+    Returns:
+        (dict) 'df' - the city's dataset, 'rows' - range or array of the
+        matching row positions and 'columns' - positions of the raw columns
+    '''
+    df = get_city_data(city_file)
+    rows = calendar_rows(get_calendar_index(city_file), *calendar_filter(month, day))
+    if rows is None:
+        rows = slice(0, len(df))
+    if isinstance(rows, slice):
+        rows = range(rows.start, rows.stop)
+    columns = [i for i, column in enumerate(df.columns) if column not in DERIVED_COLUMNS]
+    return {'df': df, 'rows': rows, 'columns': columns}
+
+def raw_page(selection, page, page_size):
+    '''Picks one page of rows and the raw columns out of a selection (see
+    raw_selection), so a page costs memory in proportion to its size.
+
+    Args:
+        (dict) selection - the query's rows (see raw_selection)
+        (int) page - number of the page, from 0
+        (int) page_size - number of rows per page
+    Returns:
+        DataFrame of up to page_size rows without the derived columns
+    '''
+    rows = selection['rows'][page * page_size:(page + 1) * page_size]
+    return selection['df'].iloc[np.asarray(rows, dtype=np.int64), selection['columns']]
+
+def iter_raw_pages(city_file, month, day, page_size=5):
+    '''Pages through the raw rows of a query (see raw_page).
+
+    Args:
+        (str) city_file - path to the city's .csv dataset
+        (str) month - name of the month to filter by, or "all"
+        (str) day - name of the day of week to filter by, or "all"
+        (int) page_size - number of rows per page
+    Returns:
+        generator of DataFrames of page_size rows without the derived columns
+    '''
+    selection = raw_selection(city_file, month, day)
+    for page in range(-(-len(selection['rows']) // page_size)):
+        yield raw_page(selection, page, page_size)
+
 def display_data(df):
     '''Provides the user the option of viewing five lines of data, repeating this upon request
        until the user responds with 'no'.
     Args:
-        csv city data file.
+        filtered city dataset, or an iterable of filtered chunks or pages of
+        it (see stream_city_data and iter_raw_pages).
     Returns:
         none.
     '''
-    # remove the columns I created so that only raw data appears
-    df = df.drop(['month','day_of_week', 'start_hour', 'Combined'], axis=1)
-
-    i = 0
+    # a DataFrame can only exist once pandas has been imported
+    if 'pandas' in sys.modules and isinstance(df, pd.DataFrame):
+        df = [df]
+    pages = iter_pages(df)
 
     # ask user to see 5 lines of data
     show_data = input("\nWould you like to see five lines of code? Type 'yes' to view.\n")
@@ -491,189 +3907,561 @@ def display_data(df):
     # this will keep asking the user to see the next five lines of code until
     # they do not respond with 'yes'
     while show_data.lower() == 'yes':
-        print(df.iloc[i:i + 5])
-        i += 5
+        page = next(pages, None)
+        if page is None:
+            print('There are no more lines of data.')
+            break
+
+        # remove the columns I created so that only raw data appears
+        print(page.drop(DERIVED_COLUMNS, axis=1, errors='ignore'))
         show_data = input(
                     "\nWould you like to see five more lines of data? Type \'yes\' to view.\n"
                     )
 
-def main():
+## Batch reports
+# The batch mode writes the report for every city x month x day combination
+# without prompting. Each city is loaded once and the statistics of every
+# (month, day of week) cell are accumulated once; each combination's report is
+# then merged from the accumulators of the cells it covers.
+def batch_reports(city_file, months, days):
+    '''Calculates the report of a city for every combination of the given
+    month and day filters.
+
+    Args:
+        (str) city_file - path to the city's .csv dataset
+        (list) months - names of the months to filter by, "all" for no filter
+        (list) days - names of the days of week to filter by, "all" for no filter
+    Returns:
+        generator of (str) month, (str) day and (dict) report (see compute_report)
+    '''
+    df = get_city_data(city_file)
+    index = get_calendar_index(city_file)
+
+    cells = {}
+    for month in range(1, 13):
+        for weekday in range(7):
+            rows = calendar_rows(index, month, weekday)
+            if len(rows):
+                cells[month, weekday] = accumulate(new_accumulator(), df.iloc[rows])
+
+    for month in months:
+        for day in days:
+            yield month, day, finalise_report(merge_cells(cells, *calendar_filter(month, day)))
+
+def flatten_report(report):
+    '''Turns a report into a flat dict of values for one row of a .csv file.
+
+    Args:
+        (dict) report - statistics (see compute_report)
+    Returns:
+        (dict) one value per column
+    '''
+    row = {'trip_count': report['trip_count'],
+           'duration_total': report['duration_total'],
+           'duration_mean': report['duration_mean']}
+    for key in ('month', 'day', 'hour'):
+        row['popular_' + key], row['popular_' + key + '_count'] = report[key]
+    for key in ('start_station', 'end_station'):
+        row[key], row[key + '_count'] = report[key]
+    row['route_start'], row['route_end'], row['route_count'] = report['route']
+    for name, count in sorted(report['user_types'].items()):
+        row['user_type ' + name] = count
+    for name, count in sorted((report['genders'] or {}).items()):
+        row['gender ' + name] = count
+    for key, value in (report['birth_years'] or {}).items():
+        row['birth_year ' + key] = value
+    return row
+
+def run_batch(cities, months, days, output, output_format='json'):
+    '''Writes the reports for every combination of cities, months and days to
+    a .json or .csv file.
+
+    Args:
+        (list) cities - keys of CITY_DATA to report on
+        (list) months - names of the months to filter by, "all" for no filter
+        (list) days - names of the days of week to filter by, "all" for no filter
+        (str) output - path of the file to write
+        (str) output_format - "json" or "csv"
+    Returns:
+        none.
+    '''
+    records = []
+    for city in cities:
+        start_time = time.time()
+        for month, day, report in batch_reports(CITY_DATA[city], months, days):
+            records.append({'city': city, 'month': month, 'day': day, 'report': report})
+        print('{}: {} reports in {:.3f} seconds'.format(
+            city, len(months) * len(days), time.time() - start_time))
+
+    if output_format == 'json':
+        with open(output, 'w') as f:
+            json.dump(records, f, indent=1)
+    else:
+        rows = [dict(city=record['city'], month=record['month'], day=record['day'],
+                     **flatten_report(record['report'])) for record in records]
+        fieldnames = []
+        for row in rows:
+            fieldnames.extend(key for key in row if key not in fieldnames)
+        with open(output, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(rows)
+    print('Wrote {} reports to {}'.format(len(records), output))
+    return None
+
+## Multi-city reports
+# Comparing cities loads each city file in its own thread, so that the cold
+# load of all of them takes about as long as the slowest one (parsing the .csv
+# and reading cached columns release the GIL). Each city's statistics are kept
+# as an accumulator, so the report across all cities is their merge.
+def city_accumulator(city_file, month, day):
+    '''Loads a city's data and returns the statistics of the trips matching the
+    month and day filters as an accumulator (see new_accumulator).
+
+    Args:
+        (str) city_file - path to the city's .csv dataset
+        (str) month - name of the month to filter by, or "all"
+        (str) day - name of the day of week to filter by, or "all"
+    Returns:
+        (dict) accumulator
+    '''
+    with stage('city statistics', city=city_file, month=month, day=day):
+        return accumulate(new_accumulator(), load_data(city_file, month, day))
+
+def multi_city_reports(cities, month, day, workers=None):
+    '''Calculates the report of each city and of all of them together, loading
+    the cities concurrently.
+
+    Args:
+        (list) cities - keys of CITY_DATA to report on
+        (str) month - name of the month to filter by, or "all"
+        (str) day - name of the day of week to filter by, or "all"
+        (int) workers - number of loading threads (default: one per city)
+    Returns:
+        (dict) report of each city by key of CITY_DATA and (dict) report of
+        all the cities' trips together
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=workers or len(cities)) as pool:
+        accumulators = list(pool.map(lambda city: city_accumulator(CITY_DATA[city], month, day),
+                                     cities))
+
+    combined = new_accumulator()
+    for acc in accumulators:
+        merge_accumulators(combined, acc)
+    return ({city: finalise_report(acc) for city, acc in zip(cities, accumulators)},
+            finalise_report(combined))
+
+def print_multi_city_reports(reports, combined, month, day):
+    '''Prints the report of each city followed by the report of all of them.
+
+    Args:
+        (dict) reports - report of each city by key of CITY_DATA
+        (dict) combined - report of all the cities together
+        (str) month - name of the month filtered by, or "all"
+        (str) day - name of the day of week filtered by, or "all"
+    Returns:
+        none.
+    '''
+    for city, report in reports.items():
+        print('\n' + '=' * 20 + ' ' + city.title() + ' ' + '=' * 20)
+        print_report(report, month, day)
+
+    print('\n' + '=' * 20 + ' All cities (' + ', '.join(city.title() for city in reports) + ') '
+          + '=' * 20)
+    print_report(combined, month, day)
+
+    # Washington has no Gender or Birth Year columns, so the combined figures
+    # for them only cover the other cities.
+    for column, key in (('gender', 'genders'), ('birth year', 'birth_years')):
+        missing = [city.title() for city, report in reports.items() if report[key] is None]
+        if missing and len(missing) < len(reports):
+            print('Note: the combined {} figures leave out {} (no {} data).'
+                  .format(column, ', '.join(missing), column))
+    return None
+
+def multi_city_main(cities, workers=None):
+    '''Asks for a time period and prints the report of each of the cities and of
+    all of them together, until the user does not want to restart.
+
+    Args:
+        (list) cities - keys of CITY_DATA to report on
+        (int) workers - number of loading threads (default: one per city)
+    Returns:
+        none.
+    '''
+    while True:
+        time_period = get_time_period()
+        month = get_month() if time_period in ('month', 'both') else 'all'
+        day = get_day() if time_period in ('day', 'both') else 'all'
+
+        print('\nPARAMETERS:  CITIES = ' + ', '.join(cities) + ', MONTH = ' + month + ' , DAY = ' + day)
+        with stage('multi-city', cities=cities, month=month, day=day) as record:
+            reports, combined = multi_city_reports(cities, month, day, workers)
+        print_multi_city_reports(reports, combined, month, day)
+
+        print('\n----- Runtime Info -----')
+        print('The multi-city step took ' + str(record['seconds']) + ' seconds to run.')
+        print('-'*100)
+
+        restart = input('\nWould you like to restart? Type \'yes\' to proceed.\n')
+        if restart.lower() != 'yes':
+            break
+
+## Query service
+# serve() keeps the cities' datasets, calendar indexes and aggregate cubes
+# loaded in one long-running process and answers queries for reports and raw
+# rows as JSON over HTTP, so a dashboard pays the startup and parse cost once
+# rather than on every query. Requests are handled in a thread each; the
+# shared data is only read, and the registry and report cache take their own
+# locks. The server listens on the loopback interface only.
+SERVICE_HOST = '127.0.0.1'
+SERVICE_PORT = 8050
+SERVICE_MAX_PAGE_SIZE = 1000
+
+def query_filters(params):
+    '''Reads the city, month and day of a query from its parameters.
+
+    Args:
+        (dict) params - query string parameters (see urllib.parse.parse_qs)
+    Returns:
+        (str) city_file - path to the city's .csv dataset
+        (str) month - name of the month to filter by, or "all"
+        (str) day - name of the day of week to filter by, or "all"
+    '''
+    city = params.get('city', [''])[0].lower()
+    if city not in CITY_DATA:
+        raise ValueError('city must be one of: ' + ', '.join(CITY_DATA))
+    # the same spellings as get_month and get_day accept
+    month = params.get('month', ['all'])[0].title().replace('All', 'all')
+    if month != 'all' and month not in MONTHS:
+        raise ValueError('month must be "all" or one of: ' + ', '.join(MONTHS))
+    day = params.get('day', ['all'])[0].title().replace('All', 'all')
+    if day != 'all' and day not in DAYS_OF_WEEK:
+        raise ValueError('day must be "all" or one of: ' + ', '.join(DAYS_OF_WEEK))
+    return CITY_DATA[city], month, day
+
+def query_report(city_file, month, day, durations=False):
+    '''Returns the report of a query as main() would print it: from the report
+    cache if it is there, otherwise from the city's aggregate cube and the
+    trip statistics of the filtered rows.
+
+    Args:
+        (str) city_file - path to the city's .csv dataset
+        (str) month - name of the month to filter by, or "all"
+        (str) day - name of the day of week to filter by, or "all"
+        (bool) durations - add the trip duration percentiles (see duration_stats)
+    Returns:
+        (dict) report (see compute_report)
+    '''
+    month_number, weekday = calendar_filter(month, day)
+    report = get_cached_report(city_file, month, day)
+    if report is None:
+        cube = get_cube(city_file)
+        report = cube_time_stats(cube, month_number, weekday)
+        report.update(trip_stats(load_data(city_file, month, day)))
+        report.update(cube_user_stats(cube, month_number, weekday))
+        store_report(city_file, month, day, report)
+    if durations:
+        report = dict(report, **duration_stats(get_duration_histogram(city_file),
+                                               month_number, weekday))
+    return report
+
+def query_rows(city_file, month, day, page=0, page_size=5):
+    '''Returns one page of the raw rows of a query (see raw_page).
+
+    Args:
+        (str) city_file - path to the city's .csv dataset
+        (str) month - name of the month to filter by, or "all"
+        (str) day - name of the day of week to filter by, or "all"
+        (int) page - number of the page, from 0
+        (int) page_size - number of rows per page
+    Returns:
+        (dict) the page's rows as records, with the page number, page size
+        and the total number of matching rows
+    '''
+    selection = raw_selection(city_file, month, day)
+    records = json.loads(raw_page(selection, page, page_size).to_json(
+        orient='records', date_format='iso', date_unit='s', double_precision=15))
+    return {'page': page, 'page_size': page_size, 'total': len(selection['rows']), 'rows': records}
+
+def query_series(kind, params):
+    '''Returns a station's hourly or a route's daily counts (see get_rollups).
+
+    Args:
+        (str) kind - 'station' or 'route'
+        (dict) params - query string parameters: city and name, or start and end
+    Returns:
+        (dict) the series' times (ISO 8601) and counts
+    '''
+    city_file = query_filters(params)[0]
+    rollups = get_rollups(city_file)
+    if kind == 'station':
+        name = params.get('name', [''])[0]
+        frame = station_series(rollups, name)
+        if frame is None:
+            raise ValueError('unknown station: ' + name)
+        return {'station': name, 'hours': [str(hour) for hour in frame.index.values],
+                'departures': frame['departures'].tolist(), 'arrivals': frame['arrivals'].tolist()}
+
+    start, end = params.get('start', [''])[0], params.get('end', [''])[0]
+    series = route_series(rollups, start, end)
+    if series is None:
+        raise ValueError('unknown station: ' + (end if start in rollups['station_ids'] else start))
+    return {'start': start, 'end': end, 'days': [str(day)[:10] for day in series.index.values],
+            'trips': series.tolist()}
+
+def service_response(path):
+    '''Answers one of the query service's requests:
+
+        GET /cities                                   the cities that can be queried
+        GET /report?city=&month=&day=[&durations=1]   report (see query_report)
+        GET /rows?city=&month=&day=[&page=&page_size=]   raw rows (see query_rows)
+        GET /station?city=&name=                      hourly departures and arrivals
+        GET /route?city=&start=&end=                  daily trips (see route_series)
+
+    Args:
+        (str) path - the request's path and query string
+    Returns:
+        (int) HTTP status and (dict) the JSON body to send
+    '''
+    from urllib.parse import urlparse, parse_qs
+    url = urlparse(path)
+    params = parse_qs(url.query)
+    try:
+        with stage('service ' + url.path, query=url.query):
+            if url.path == '/cities':
+                body = {'cities': list(CITY_DATA)}
+            elif url.path == '/report':
+                durations = params.get('durations', ['0'])[0].lower() in ('1', 'true', 'yes')
+                body = query_report(*query_filters(params), durations=durations)
+            elif url.path == '/rows':
+                page = int(params.get('page', ['0'])[0])
+                page_size = int(params.get('page_size', ['5'])[0])
+                if page < 0 or not 0 < page_size <= SERVICE_MAX_PAGE_SIZE:
+                    raise ValueError('page must be 0 or more and page_size 1 to {}'
+                                     .format(SERVICE_MAX_PAGE_SIZE))
+                body = query_rows(*query_filters(params), page=page, page_size=page_size)
+            elif url.path in ('/station', '/route'):
+                body = query_series(url.path[1:], params)
+            else:
+                return 404, {'error': 'unknown path ' + url.path}
+    except ValueError as error:
+        return 400, {'error': str(error)}
+    except Exception as error:
+        return 500, {'error': '{}: {}'.format(type(error).__name__, error)}
+    return 200, body
+
+def warm_city(city_file):
+    '''Loads a city's dataset, calendar index and aggregate cube into memory.
+
+    Args:
+        (str) city_file - path to the city's .csv dataset
+    Returns:
+        (int) number of rows loaded
+    '''
+    with stage('warm', city=city_file):
+        df = get_city_data(city_file)
+        get_calendar_index(city_file)
+        get_cube(city_file)
+    return len(df)
+
+def serve(cities, host=SERVICE_HOST, port=SERVICE_PORT):
+    '''Loads the cities concurrently and answers queries about them over HTTP
+    until interrupted.
+
+    Args:
+        (list) cities - keys of CITY_DATA to load before serving (the others
+        are loaded on their first query)
+        (str) host - address to listen on
+        (int) port - port to listen on
+    Returns:
+        none.
+    '''
+    from concurrent.futures import ThreadPoolExecutor
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class ServiceHandler(BaseHTTPRequestHandler):
+        '''Sends the JSON answer (see service_response) to each GET request.'''
+
+        def do_GET(self):
+            status, body = service_response(self.path)
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    with ThreadPoolExecutor(max_workers=len(cities)) as pool:
+        for city, rows in zip(cities, pool.map(lambda city: warm_city(CITY_DATA[city]), cities)):
+            print('Loaded {} ({:,} rows)'.format(CITY_DATA[city], rows))
+
+    server = ThreadingHTTPServer((host, port), ServiceHandler)
+    print('Serving bikeshare statistics on http://{}:{}/ (press Ctrl+C to stop)'.format(
+        *server.server_address[:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return None
+
+def main(stream=False, chunksize=STREAM_CHUNKSIZE, workers=1, incremental=False, error=None,
+         top=TOP_N, durations=False, demographics=False, partition_root=None):
     '''Calculates and prints out the descriptive statistics based on the city and
     time period specified by the user. Also includes runtime information.
 
     Args:
-        none.
+        (bool) stream - read the city file in chunks instead of loading it
+        into memory (see stream_report)
+        (int) chunksize - number of .csv rows per chunk when streaming
+        (int) workers - number of worker processes to calculate the statistics
+        with (see parallel_report)
+        (bool) incremental - calculate the statistics from the accumulators
+        kept up to date by incremental ingestion (see ingest_city)
+        (float) error - with stream or workers, count stations and routes
+        approximately with this error bound (see new_sketch)
+        (int) top - number of stations and routes listed when approximate
+        (bool) durations - add the trip duration percentiles (see
+        duration_stats; not with stream)
+        (bool) demographics - print the user type, gender and birth decade
+        table (see demographic_crosstab)
+        (str) partition_root - answer queries from the partitioned dataset in
+        this directory, which may hold any months of several years (see
+        partition_city)
     Returns:
         none.
     '''
+    # the cold start, from starting the script to the first prompt, is shown
+    # with the first query's runtime info
+    startup = {'stage': 'startup', 'seconds': time.perf_counter() - script_start_time}
+    log_stage(startup)
 
     while True:
         # Determine which city file (ie. the .csv dataset) should be analysed.
         city_file = get_city()
+        if partition_root is not None:
+            entry = load_catalogue(partition_root).get(partition_name(city_file))
+            if not entry or not entry['parts']:
+                print('{} has not been partitioned into {} (see --partition)'.format(
+                    city_file, partition_root))
+                continue
 
-        # Get the time period (day, month or all), from the user
+        # Get the time period (day, month, both or none) from the user, and
+        # the month and/or day to filter by.
         time_period = get_time_period()
+        months = MONTHS if partition_root is None else CALENDAR_MONTHS
+        month = get_month(months) if time_period in ('month', 'both') else 'all'
+        day = get_day() if time_period in ('day', 'both') else 'all'
 
-        # Analyse city data with just a month filter (ie. no day filter)
-        if time_period == 'month':
-            month = get_month()
-            day = 'all'
-
-            # This creates the dataframe based on the user input city and time parameters
-            df = load_data(city_file, month, day)
-
-            # Compiling the report and adding run time information
-            print('\nPARAMETERS:  CITY DATA = ' + city_file + ', MONTH = ' + month + ' , DAY = ' + day)
-            start_time = time.time()
-            print('\n----- Popular times of travel -----')
-            popular_day(df)
-            popular_hour(df)
-            runtime_pop_travel = time.time() - start_time
-
-            start_time = time.time()
-            print('\n----- Popular stations and trip duration -----')
-            trip_info(df)
-            runtime_stations_duration = time.time() - start_time
-
-            start_time = time.time()
-            print('\n----- User Info -----')
-            usertype_info(df)
-            gender_info(df)
-            birthyear_info(df)
-            runtime_userinfo = time.time() - start_time
-
-            print('\n----- Runtime Info -----')
-            print('The Popular times of travel statistics took ' + str(runtime_pop_travel)
-             + ' seconds to run.')
-            print('The Popular statiosn and trip duration statistics took ' + str(runtime_stations_duration)
-             + ' seconds to run.')
-            print('The User info statistics took ' + str(runtime_userinfo) + ' seconds to run.' )
-            print('-'*100)
-
-            # Ask the user if they want to see 5 lines of code, repeating the request until they say no.
-            display_data(df)
-
-        # Analyse city data with just a day filter (ie. no month filter)
-        elif time_period == 'day':
-            month = 'all'
-            day = get_day()
-
-            # This creates the dataframe based on the user input city and
-            # time parameters
-            df = load_data(city_file, month, day)
-
-            # Compiling the report and adding run time information
-            print('\nPARAMETERS:  CITY DATA = ' + city_file + ', MONTH = ' + month + ' , DAY = ' + day)
-            start_time = time.time()
-            print('\n----- Popular times of travel -----')
-            popular_month(df)
-            popular_hour(df)
-            runtime_pop_travel = time.time() - start_time
-
-            start_time = time.time()
-            print('\n----- Popular stations and trip duration -----')
-            trip_info(df)
-            runtime_stations_duration = time.time() - start_time
-
-            start_time = time.time()
-            print('\n----- User info -----')
-            usertype_info(df)
-            gender_info(df)
-            birthyear_info(df)
-            runtime_userinfo = time.time() - start_time
-
-            print('\n----- Runtime Info -----')
-            print('The Popular times of travel statistics took ' + str(runtime_pop_travel)
-            + ' seconds to run.')
-            print('The Popular statiosn and trip duration statistics took ' + str(runtime_stations_duration)
-             + ' seconds to run.')
-            print('The User info statistics took ' + str(runtime_userinfo) + ' seconds to run.' )
-            print('-'*100)
-
-            # Ask the user if they want to see 5 lines of code, repeating the request until they say no.
-            display_data(df)
-
-
-        # Analyse city data with month and day filters applied
-        elif time_period == 'both':
-            month = get_month()
-            day = get_day()
-
-            # This creates the dataframe based on the user input city and
-            # time parameters
-            df = load_data(city_file, month, day)
-
-            # Compiling the report and adding run time information
-            print('\nPARAMETERS:  CITY DATA = ' + city_file + ', MONTH = ' + month + ' , DAY = ' + day)
-            start_time = time.time()
-            print('\n----- Popular times of travel -----')
-            popular_hour(df)
-            runtime_pop_travel = time.time() - start_time
-
-            start_time = time.time()
-            print('\n----- Popular stations and trip duration -----')
-            trip_info(df)
-            runtime_stations_duration = time.time() - start_time
-
-            start_time = time.time()
-            print('\n----- User info -----')
-            usertype_info(df)
-            gender_info(df)
-            birthyear_info(df)
-            runtime_userinfo = time.time() - start_time
-
-            print('\n----- Runtime Info -----')
-            print('The Popular times of travel statistics took ' + str(runtime_pop_travel)
-            + ' seconds to run.')
-            print('The Popular statiosn and trip duration statistics took ' + str(runtime_stations_duration)
-            + ' seconds to run.')
-            print('The User info statistics took ' + str(runtime_userinfo) + ' seconds to run.' )
-            print('-'*100)
-
-            # Ask the user if they want to see 5 lines of code, repeating the request until they say no.
-            display_data(df)
+        # Partitioned datasets can span several years, so also ask which one.
+        query = {'city': city_file, 'month': month, 'day': day}
+        if partition_root is not None:
+            query['year'] = get_year(sorted({part['year'] for part in entry['parts']}))
 
+        print('\nPARAMETERS:  CITY DATA = ' + city_file + ', MONTH = ' + month + ' , DAY = ' + day
+              + ('' if partition_root is None else ', YEAR = ' + str(query['year'])))
+
+        # Compiling the report and adding run time information (see stage)
+        stages = [startup] if startup is not None else []
+        startup = None
+        # approximate reports are not cached, so that they are never handed
+        # out for exact queries, and nor are reports from partitions, which
+        # are not tied to the city file
+        report = None
+        rows = None
+        if error is None and partition_root is None:
+            with stage('report cache', **query) as record:
+                report = get_cached_report(city_file, month, day)
+        cached = report is not None
+        if cached:
+            stages.append(record)
+        elif partition_root is not None:
+            # only the partitions of the chosen year, month and day are read
+            start = end = None
+            if query['year'] != 'all':
+                start, end = pd.Timestamp(query['year'], 1, 1), pd.Timestamp(query['year'] + 1, 1, 1)
+            with stage('load partitions', **query) as record:
+                df = load_partitioned(city_file, month, day, start, end, partition_root)
+            stages.append(record)
+            with stage('statistics', **query) as record:
+                report = compute_report(df)
+            stages.append(record)
+            rows = df
+        elif incremental:
+            with stage('incremental', **query) as record:
+                report = ingested_report(city_file, month, day)
+            stages.append(record)
+        elif stream:
+            with stage('streamed', **query) as record:
+                report = stream_report(city_file, month, day, chunksize, error, top)
+            stages.append(record)
+        elif workers > 1:
+            with stage('parallel', workers=workers, **query) as record:
+                report = parallel_report(city_file, month, day, workers, error, top)
+            stages.append(record)
         else:
-            # Analyse city data with no time filters
-            time_period = 'none'
-            month = 'all'
-            day = 'all'
-
-            # This creates the dataframe based on the user input city and
-            # time parameters
-            df = load_data(city_file, month, day)
-
-            # Compiling the report and adding run time information
-            print('\nPARAMETERS:  CITY DATA = ' + city_file + ', MONTH = ' + month + ' , DAY = ' + day)
-            start_time = time.time()
-            print('\n----- Popular times of travel -----')
-            popular_month(df)
-            popular_day(df)
-            popular_hour(df)
-            runtime_pop_travel = time.time() - start_time
-
-            start_time = time.time()
-            print('\n----- Popular stations and trip -----')
-            trip_info(df)
-            runtime_stations_duration = time.time() - start_time
-
-            start_time = time.time()
-            print('\n----- User info -----')
-            usertype_info(df)
-            gender_info(df)
-            birthyear_info(df)
-            runtime_userinfo = time.time() - start_time
-
-            print('\n----- Runtime Info -----')
-            print('The Popular times of travel statistics took ' + str(runtime_pop_travel) +
-            ' seconds to run.')
-            print('The Popular statiosn and trip duration statistics took ' +
-            str(runtime_stations_duration) + ' seconds to run.')
-            print('The User info statistics took ' + str(runtime_userinfo) + ' seconds to run.' )
-            print('-'*100)
-
-            # Ask the user if they want to see 5 lines of code, repeating the request until they say no.
-            display_data(df)
+            # This creates the dataframe based on the user input city and time
+            # parameters. The popular times and user info are read from the
+            # city's aggregate cube, only the trip statistics need the rows.
+            with stage('load data', **query) as record:
+                df = load_data(city_file, month, day)
+            stages.append(record)
+            with stage('load cube', **query) as record:
+                cube = get_cube(city_file)
+            stages.append(record)
+            month_number, weekday = calendar_filter(month, day)
+            report = {}
+            for label, stats in (('Popular times of travel',
+                                  lambda: cube_time_stats(cube, month_number, weekday)),
+                                 ('Popular stations and trip duration', lambda: trip_stats(df)),
+                                 ('User info', lambda: cube_user_stats(cube, month_number, weekday))):
+                with stage(label, **query) as record:
+                    report.update(stats())
+                stages.append(record)
+            rows = df
+
+        # The raw rows are read the way the mode reads its data, whether or not
+        # the report came from the cache, so --stream and --incremental never
+        # load the whole file into memory. Nothing is read unless the user asks
+        # to see rows.
+        if rows is None:
+            if stream or incremental:
+                rows = stream_city_data(city_file, month, day, chunksize)
+            else:
+                rows = iter_raw_pages(city_file, month, day)
+
+        if not cached and 'approximate' not in report and partition_root is None:
+            store_report(city_file, month, day, report)
+
+        # the percentiles are read from the city's duration histogram, which
+        # is quick enough not to need the report cache
+        if durations:
+            with stage('Trip duration distribution', **query) as record:
+                if partition_root is None:
+                    report = dict(report, **duration_stats(get_duration_histogram(city_file),
+                                                           *calendar_filter(month, day)))
+                else:
+                    # the loaded rows are already filtered
+                    hist = duration_histogram_add(new_duration_histogram(), df)
+                    report = dict(report, **duration_stats(hist))
+            stages.append(record)
+        print_report(report, month, day, demographics)
+
+        print('\n----- Runtime Info -----')
+        for record in stages:
+            print('The ' + record['stage'] + ' step took ' + str(record['seconds']) + ' seconds to run.')
+            if 'peak_memory' in record:
+                print('    peak memory: {:.1f} MB'.format(record['peak_memory'] / 1024 ** 2))
+            if record['stage'] == 'startup':
+                print('    pandas imported so far: ' + ('yes' if 'pandas' in sys.modules else
+                                                        'no (the report came from the cache)'))
+        print('-'*100)
+
+        # Ask the user if they want to see 5 lines of code, repeating the request until they say no.
+        display_data(rows)
 
         #Ask if the user wants to continue with another data query
         restart = input('\nWould you like to restart? Type \'yes\' to proceed.\n')
@@ -681,4 +4469,156 @@ def main():
             break
 
 if __name__ == "__main__":
-	main()
+    parser = argparse.ArgumentParser(description='Explore US bikeshare data.')
+    parser.add_argument('--stream', action='store_true',
+                        help='read city files in chunks instead of loading them into memory')
+    parser.add_argument('--chunksize', type=int, default=STREAM_CHUNKSIZE,
+                        help='number of rows per chunk with --stream (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes for the statistics (default: %(default)s)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='keep running statistics of each city file and read only the rows '
+                             'appended since the last query')
+    parser.add_argument('--ingest', action='store_true',
+                        help='bring the running statistics of the --cities files up to date and exit')
+    parser.add_argument('--approximate', type=float, metavar='ERROR',
+                        help='count stations and routes with a bounded-memory sketch, each count '
+                             'being at most ERROR (eg. 0.001) times the number of trips too low, and '
+                             'list the --top stations and routes (streams the file unless --workers '
+                             'is given)')
+    parser.add_argument('--top', type=int, default=TOP_N,
+                        help='number of stations and routes listed with --approximate '
+                             '(default: %(default)s)')
+    parser.add_argument('--durations', action='store_true',
+                        help='add trip duration percentiles overall and by hour, user type and '
+                             'month to the report (not with --stream)')
+    parser.add_argument('--demographics', action='store_true',
+                        help='add a table of trips by user type, gender and birth decade to the '
+                             'report')
+    parser.add_argument('--batch', action='store_true',
+                        help='write the reports for every city, month and day combination '
+                             'to a file instead of prompting')
+    parser.add_argument('--multi-city', action='store_true',
+                        help='report on each of the --cities and on all of them together, '
+                             'loading them concurrently')
+    parser.add_argument('--serve', action='store_true',
+                        help='keep the --cities loaded and answer queries as JSON over HTTP on '
+                             '--port of this machine (see ServiceHandler)')
+    parser.add_argument('--port', type=int, default=SERVICE_PORT,
+                        help='port for --serve (default: %(default)s)')
+    parser.add_argument('--cities', nargs='+', choices=list(CITY_DATA), default=list(CITY_DATA),
+                        help='cities to report on with --batch or --multi-city, or to load before '
+                             'serving with --serve (default: all)')
+    parser.add_argument('--months', nargs='+', choices=['all'] + MONTHS, default=['all'] + MONTHS,
+                        help='month filters to report on with --batch (default: all and each month)')
+    parser.add_argument('--days', nargs='+', choices=['all'] + DAYS_OF_WEEK,
+                        default=['all'] + DAYS_OF_WEEK,
+                        help='day filters to report on with --batch (default: all and each day)')
+    parser.add_argument('--partition', action='store_true',
+                        help='split the --cities files into year and month partitions under '
+                             '--partition-root and exit')
+    parser.add_argument('--partitioned', action='store_true',
+                        help='answer queries from the partitions under --partition-root, which '
+                             'may cover any months of several years')
+    parser.add_argument('--partition-root', default=PARTITION_ROOT,
+                        help='directory of the partitioned datasets (default: %(default)s)')
+    parser.add_argument('--memory-report', action='store_true',
+                        help='print the memory used by each column of the --cities datasets '
+                             'with and without the parse schemas')
+    parser.add_argument('--format', choices=['json', 'csv'], default='json',
+                        help='file format for --batch (default: %(default)s)')
+    parser.add_argument('--output', help='file to write with --batch '
+                                         '(default: bikeshare_reports.json or .csv)')
+    parser.add_argument('--rows', type=int, nargs=2, metavar=('START', 'STOP'),
+                        help='print rows START to STOP of the --cities files (0 is the first row '
+                             'after the header) without reading the rest of the file')
+    parser.add_argument('--station', metavar='NAME',
+                        help='print the hourly departures from and arrivals at a station of the '
+                             '--cities')
+    parser.add_argument('--route', nargs=2, metavar=('START', 'END'),
+                        help='print the daily trips from station START to station END in the '
+                             '--cities')
+    parser.add_argument('--profile-log', help='append a JSON record of every pipeline stage '
+                                              '(time, peak memory) to this file')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='track the peak memory of each stage with tracemalloc (slower)')
+    parser.add_argument('--cprofile', help='write cProfile statistics for the whole run to this '
+                                           'file (read them with pstats or snakeviz)')
+    args = parser.parse_args()
+    if args.durations and args.stream:
+        parser.error('--durations needs the whole dataset and cannot be used with --stream')
+    if args.partitioned and (args.stream or args.workers > 1 or args.incremental
+                             or args.approximate is not None):
+        parser.error('--partitioned cannot be combined with --stream, --workers, --incremental '
+                     'or --approximate')
+
+    if args.profile_log:
+        stage_log = open(args.profile_log, 'a')
+    if args.trace_memory:
+        import tracemalloc
+        tracemalloc.start()
+    profiler = None
+    if args.cprofile:
+        import cProfile
+        profiler = cProfile.Profile()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        if args.rows:
+            for city in args.cities:
+                print('\n{} rows {} to {}:'.format(CITY_DATA[city], *args.rows))
+                print(read_rows(CITY_DATA[city], *args.rows))
+        elif args.station or args.route:
+            for city in args.cities:
+                rollups = get_rollups(CITY_DATA[city])
+                if args.station:
+                    series = station_series(rollups, args.station)
+                    title = 'departures from and arrivals at ' + args.station + ' by hour'
+                else:
+                    series = route_series(rollups, *args.route)
+                    title = 'trips from {} to {} by day'.format(*args.route)
+                if series is None:
+                    print('\n{} has no station called {}'.format(
+                        CITY_DATA[city], args.station or ' or '.join(args.route)))
+                else:
+                    print('\n{} {}:'.format(CITY_DATA[city], title))
+                    print(series)
+                    if args.station:
+                        print('Total: {:,} departures, {:,} arrivals'.format(
+                            int(series['departures'].sum()), int(series['arrivals'].sum())))
+                    else:
+                        print('Total: {:,} trips'.format(int(series.sum())))
+        elif args.partition:
+            for city in args.cities:
+                entry = partition_city(CITY_DATA[city], args.partition_root)
+                print('{}: {:,} rows in {} parts covering {} months'.format(
+                    CITY_DATA[city], sum(part['rows'] for part in entry['parts']),
+                    len(entry['parts']), len({(part['year'], part['month']) for part in entry['parts']})))
+        elif args.ingest:
+            for city in args.cities:
+                state, new_rows = ingest_city(CITY_DATA[city], args.chunksize)
+                print('{}: read {:,} new rows ({:,} in total)'.format(
+                    CITY_DATA[city], new_rows, state['rows']))
+        elif args.memory_report:
+            for city in args.cities:
+                memory_report(CITY_DATA[city])
+        elif args.multi_city:
+            multi_city_main(args.cities)
+        elif args.serve:
+            serve(args.cities, port=args.port)
+        elif args.batch:
+            run_batch(args.cities, args.months, args.days,
+                      args.output or 'bikeshare_reports.' + args.format, args.format)
+        else:
+            # the sketches are kept by the streaming and parallel accumulators
+            stream = args.stream or (args.approximate is not None and args.workers <= 1)
+            main(stream=stream, chunksize=args.chunksize, workers=args.workers,
+                 incremental=args.incremental, error=args.approximate, top=args.top,
+                 durations=args.durations, demographics=args.demographics,
+                 partition_root=args.partition_root if args.partitioned else None)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.cprofile)
+        if stage_log is not None:
+            stage_log.close()
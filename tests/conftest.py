@@ -0,0 +1,92 @@
+'''
+Shared fixtures for the bikeshare.py tests: small synthetic city files, made
+with the benchmark's generator, in a temporary directory of each test.
+'''
+
+## import all necessary packages and functions
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark
+import bikeshare
+
+# small enough to load in a fraction of a second, big enough for every month,
+# day of week and hour to have trips
+FIXTURE_ROWS = 3000
+# month and day filters the reports are checked with
+QUERIES = [('all', 'all'), ('march', 'all'), ('all', 'friday'), ('may', 'sunday')]
+
+def expected_report(city_file, month, day):
+    '''Returns the report of the baseline path: load_data and compute_report.'''
+    return bikeshare.compute_report(bikeshare.load_data(city_file, month, day))
+
+def assert_same_report(report, expected):
+    '''Checks that a report has the statistics of the expected one. Reports
+    are compared as they read back from JSON (see store_report), and the
+    duration sums of float durations only up to rounding, since they are
+    added up in a different order.'''
+    report, expected = json.loads(json.dumps(report)), json.loads(json.dumps(expected))
+    for key in ('duration_total', 'duration_mean'):
+        assert report.pop(key) == pytest.approx(expected.pop(key), rel=1e-12)
+    for key, value in expected.items():
+        if key in report:
+            assert report[key] == value, key
+    # every mode has at least the statistics main() prints
+    assert {'month', 'day', 'hour', 'trip_count', 'start_station', 'end_station', 'route',
+            'user_types', 'genders', 'birth_years'} <= set(report)
+
+def write_city(directory, city, n_rows=FIXTURE_ROWS, seed=0):
+    '''Writes a synthetic city .csv file into directory.
+
+    Args:
+        directory - pathlib.Path to write to
+        (str) city - key of benchmark.CITY_SHAPES
+        (int) n_rows - number of trips
+        (int) seed - random seed
+    Returns:
+        (str) path of the .csv file
+    '''
+    path = str(directory / '{}.csv'.format(city.replace(' ', '_')))
+    benchmark.generate_city(path, city, n_rows, seed)
+    return path
+
+def append_rows(city_file, source_file, first, last):
+    '''Appends rows first to last (0-based, header excluded) of another .csv
+    file to a city file.'''
+    with open(source_file) as f:
+        lines = f.readlines()[1:]
+    with open(city_file, 'a') as f:
+        f.writelines(lines[first:last])
+    return None
+
+@pytest.fixture
+def chicago(tmp_path):
+    '''Path of a synthetic Chicago file (with Gender and Birth Year).'''
+    return write_city(tmp_path, 'chicago')
+
+@pytest.fixture
+def washington(tmp_path):
+    '''Path of a synthetic Washington file (no demographics, float durations).'''
+    return write_city(tmp_path, 'washington')
+
+@pytest.fixture(params=['chicago', 'washington'])
+def city_file(request, tmp_path):
+    '''Path of a synthetic file of each city shape.'''
+    return write_city(tmp_path, request.param)
+
+@pytest.fixture(autouse=True)
+def fresh_state():
+    '''Forgets the datasets, reports and ingestion parts held in memory, so
+    every test starts from what is on disk.'''
+    held = [bikeshare.dataset_registry, bikeshare.row_indexes, bikeshare.ingest_parts,
+            bikeshare.report_caches, bikeshare.report_sizes, bikeshare.report_log_lines]
+    for cache in held:
+        cache.clear()
+    yield
+    for cache in held:
+        cache.clear()
@@ -0,0 +1,127 @@
+'''
+Tests of the on-disk caches: the converted column cache and the data derived
+from it.
+'''
+
+## import all necessary packages and functions
+import json
+import os
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+import bikeshare
+from conftest import append_rows, assert_same_report, expected_report, write_city
+
+def test_ingested_cube_survives_reload(tmp_path, monkeypatch):
+    '''Rows added to the saved cube by ingest_city are still there after the
+    grown file is loaded again (which rewrites the column cache), so get_cube
+    does not rebuild it.'''
+    (tmp_path / 'full').mkdir()
+    source = write_city(tmp_path / 'full', 'chicago')
+    city_file = str(tmp_path / 'chicago.csv')
+    with open(city_file, 'w') as f:
+        f.writelines(open(source).readlines()[:2001])
+
+    bikeshare.ingest_city(city_file)
+    bikeshare.get_cube(city_file)
+    append_rows(city_file, source, 2000, 3000)
+    bikeshare.ingest_city(city_file)
+
+    bikeshare.dataset_registry.clear()
+    df = bikeshare.get_city_data(city_file)
+    expected = bikeshare.cube_add(bikeshare.new_cube(df.columns), df)
+
+    def rebuild(*args):
+        raise AssertionError('the saved cube was rebuilt')
+    monkeypatch.setattr(bikeshare, 'cube_add', rebuild)
+    cube = bikeshare.get_cube(city_file)
+    assert cube['labels'] == expected['labels']
+    np.testing.assert_array_equal(cube['counts'], expected['counts'])
+
+def test_concurrent_builds_happen_once(chicago, monkeypatch):
+    '''Threads asking for the same city at once (as the query service's do)
+    load the dataset and build each derived structure only once.'''
+    calls = Counter()
+    for name in ('read_city_data', 'build_calendar_index', 'cube_add', 'duration_histogram_add',
+                 'build_rollups'):
+        def counted(*args, _name=name, _function=getattr(bikeshare, name)):
+            calls[_name] += 1
+            return _function(*args)
+        monkeypatch.setattr(bikeshare, name, counted)
+
+    def build_all(_):
+        bikeshare.get_calendar_index(chicago)
+        bikeshare.get_cube(chicago)
+        bikeshare.get_duration_histogram(chicago)
+        bikeshare.get_rollups(chicago)
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(build_all, range(16)))
+    assert calls == {'read_city_data': 1, 'build_calendar_index': 1, 'cube_add': 1,
+                     'duration_histogram_add': 1, 'build_rollups': 1}
+
+def test_report_hit_log_is_bounded(chicago, monkeypatch):
+    '''Past REPORT_CACHE_LOG_LINES hits the log is folded into the report cache
+    file, and the order of use is kept.'''
+    monkeypatch.setattr(bikeshare, 'REPORT_CACHE_LOG_LINES', 5)
+    bikeshare.store_report(chicago, 'march', 'all', {'trip_count': 1})
+    bikeshare.store_report(chicago, 'april', 'all', {'trip_count': 2})
+    for _ in range(12):
+        assert bikeshare.get_cached_report(chicago, 'march', 'all') == {'trip_count': 1}
+
+    path = bikeshare.report_cache_path(chicago)
+    log = bikeshare.report_log_path(path)
+    assert not os.path.exists(log) or len(open(log).readlines()) <= 5
+
+    # a new run sees march as the most recently used report
+    bikeshare.report_caches.clear()
+    reports = bikeshare.load_report_cache(path)
+    assert list(reports) == [bikeshare.report_key(chicago, 'april', 'all'),
+                             bikeshare.report_key(chicago, 'march', 'all')]
+
+def edit_file(city_file, old, new, mtime_step=5):
+    '''Replaces the first occurrence of old with new in a city file and moves
+    its modification time on, as an editor saving the file would.'''
+    stat = os.stat(city_file)
+    with open(city_file) as f:
+        text = f.read()
+    assert old in text
+    with open(city_file, 'w') as f:
+        f.write(text.replace(old, new, 1))
+    os.utime(city_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + mtime_step * 10 ** 9))
+    return None
+
+@pytest.mark.parametrize('old, new', [
+    # same size, so only the modification time tells the files apart
+    ('Subscriber', 'Subscribed'),
+    # different size
+    ('Subscriber', 'Member')])
+def test_cache_invalidated_by_changed_file(chicago, old, new):
+    '''The column cache, in-memory registry, cube and report cache are not
+    used once the file's size or modification time changes.'''
+    before = bikeshare.query_report(chicago, 'all', 'all')
+    fingerprint = bikeshare.file_fingerprint(chicago)
+    assert bikeshare.read_cache(bikeshare.cache_path(chicago), fingerprint) is not None
+
+    edit_file(chicago, old, new)
+    assert bikeshare.file_fingerprint(chicago) != fingerprint
+    assert bikeshare.read_cache(bikeshare.cache_path(chicago),
+                                bikeshare.file_fingerprint(chicago)) is None
+
+    # the held dataset and report are not reused in the same run
+    assert bikeshare.get_cached_report(chicago, 'all', 'all') is None
+    assert (bikeshare.get_city_data(chicago)['User Type'] == new).sum() == 1
+    report = bikeshare.query_report(chicago, 'all', 'all')
+    assert report['user_types'] != before['user_types']
+    assert_same_report(report, expected_report(chicago, 'all', 'all'))
+
+    # a new run reads the rebuilt caches
+    for cache in (bikeshare.dataset_registry, bikeshare.report_caches):
+        cache.clear()
+    assert bikeshare.read_cache(bikeshare.cache_path(chicago),
+                                bikeshare.file_fingerprint(chicago)) is not None
+    assert bikeshare.get_cached_report(chicago, 'all', 'all') == json.loads(json.dumps(report))
+    assert_same_report(bikeshare.query_report(chicago, 'all', 'all'),
+                       expected_report(chicago, 'all', 'all'))
@@ -0,0 +1,40 @@
+'''
+Tests of incremental ingestion: reports from the ingested counts of a file
+that grew by appends match a full reload of the file.
+'''
+
+## import all necessary packages and functions
+import bikeshare
+from conftest import QUERIES, append_rows, assert_same_report, expected_report, write_city
+
+def test_appends_match_full_reload(tmp_path):
+    '''Ingesting a file after each of many appends (enough for the parts to be
+    compacted, see INGEST_MAX_PARTS) gives the report of the whole file.'''
+    (tmp_path / 'full').mkdir()
+    source = write_city(tmp_path / 'full', 'chicago')
+    city_file = str(tmp_path / 'chicago.csv')
+    with open(city_file, 'w') as f:
+        f.write(open(source).readline())
+
+    steps = bikeshare.INGEST_MAX_PARTS + 4
+    bounds = [i * 3000 // steps for i in range(steps + 1)]
+    for first, last in zip(bounds[:-1], bounds[1:]):
+        append_rows(city_file, source, first, last)
+        state, rows = bikeshare.ingest_city(city_file)
+        assert rows == last - first
+        assert state['rows'] == last
+    assert len(bikeshare.load_ingest_state(city_file)['parts']) <= bikeshare.INGEST_MAX_PARTS
+
+    # a new run reads the saved state
+    bikeshare.ingest_parts.clear()
+    for month, day in QUERIES:
+        assert_same_report(bikeshare.ingested_report(city_file, month, day),
+                           expected_report(city_file, month, day))
+
+def test_rewritten_file_is_ingested_again(tmp_path, washington):
+    '''A file that was replaced rather than appended to is read from the start.'''
+    bikeshare.ingested_report(washington, 'all', 'all')
+    write_city(tmp_path, 'washington', n_rows=2000, seed=7)
+    report = bikeshare.ingested_report(washington, 'all', 'all')
+    assert report['trip_count'] == 2000
+    assert_same_report(report, expected_report(washington, 'all', 'all'))
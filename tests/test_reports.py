@@ -0,0 +1,79 @@
+'''
+Tests that every way of calculating a report gives the same statistics as
+computing it from the data returned by load_data.
+'''
+
+## import all necessary packages and functions
+import os
+
+import pandas as pd
+import pytest
+
+import bikeshare
+from conftest import QUERIES, assert_same_report, expected_report
+
+@pytest.mark.parametrize('month, day', QUERIES)
+def test_stream_report(city_file, month, day):
+    report = bikeshare.stream_report(city_file, month, day, chunksize=700)
+    assert_same_report(report, expected_report(city_file, month, day))
+
+@pytest.mark.parametrize('month, day', QUERIES)
+def test_parallel_report(city_file, month, day, monkeypatch):
+    # start a real pool of workers however many CPUs this machine has
+    monkeypatch.setattr(os, 'cpu_count', lambda: 3)
+    report = bikeshare.parallel_report(city_file, month, day, 3)
+    assert_same_report(report, expected_report(city_file, month, day))
+
+@pytest.mark.parametrize('month, day', QUERIES)
+def test_cube_and_cached_report(city_file, month, day):
+    expected = expected_report(city_file, month, day)
+    assert bikeshare.get_cached_report(city_file, month, day) is None
+    assert_same_report(bikeshare.query_report(city_file, month, day), expected)
+
+    # the second query comes from the report cache, also in a new run
+    bikeshare.report_caches.clear()
+    assert bikeshare.get_cached_report(city_file, month, day) is not None
+    assert_same_report(bikeshare.query_report(city_file, month, day), expected)
+
+@pytest.mark.parametrize('month, day', QUERIES)
+def test_ingested_report(city_file, month, day):
+    report = bikeshare.ingested_report(city_file, month, day)
+    assert_same_report(report, expected_report(city_file, month, day))
+
+def test_batch_reports(city_file):
+    months, days = ['all', 'march', 'may'], ['all', 'friday', 'sunday']
+    reports = list(bikeshare.batch_reports(city_file, months, days))
+    assert len(reports) == len(months) * len(days)
+    for month, day, report in reports:
+        assert_same_report(report, expected_report(city_file, month, day))
+
+def test_partitioned_report(city_file, tmp_path):
+    root = str(tmp_path / 'partitions')
+    bikeshare.partition_city(city_file, root, chunksize=700)
+    for month, day in QUERIES:
+        report = bikeshare.compute_report(bikeshare.load_partitioned(city_file, month, day,
+                                                                     root=root))
+        assert_same_report(report, expected_report(city_file, month, day))
+
+def test_multi_city_reports(chicago, washington, tmp_path, monkeypatch):
+    # CITY_DATA names the files relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    reports, combined = bikeshare.multi_city_reports(['chicago', 'washington'], 'march', 'all')
+    assert_same_report(reports['chicago'], expected_report(chicago, 'march', 'all'))
+    assert_same_report(reports['washington'], expected_report(washington, 'march', 'all'))
+    assert combined['trip_count'] == (reports['chicago']['trip_count']
+                                      + reports['washington']['trip_count'])
+
+def test_missing_durations(chicago):
+    '''Trips without a duration are loaded and left out of the duration
+    statistics, in memory and when streaming.'''
+    df = pd.read_csv(chicago, dtype=str, keep_default_na=False)
+    df.loc[[3, 10, 500], 'Trip Duration'] = ''
+    df.to_csv(chicago, index=False)
+    durations = pd.read_csv(chicago)['Trip Duration']
+
+    report = bikeshare.compute_report(bikeshare.load_data(chicago, 'all', 'all'))
+    assert report['trip_count'] == len(durations)
+    assert report['duration_total'] == pytest.approx(durations.sum())
+    assert report['duration_mean'] == pytest.approx(durations.mean())
+    assert bikeshare.stream_report(chicago, 'all', 'all', chunksize=1000) == report
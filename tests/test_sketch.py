@@ -0,0 +1,76 @@
+'''
+Tests of the heavy-hitters sketches behind the approximate reports: every
+count they give is at most their error short of the true count.
+'''
+
+## import all necessary packages and functions
+import os
+from collections import Counter
+
+import numpy as np
+import pytest
+
+import bikeshare
+
+def exact_counts(city_file):
+    '''Returns the true trip count of every start station, end station and
+    route of a city file.'''
+    df = bikeshare.load_data(city_file, 'all', 'all')
+    return {'start_station': Counter(df['Start Station'].dropna()),
+            'end_station': Counter(df['End Station'].dropna()),
+            'route': Counter(bikeshare.route_counts(df))}
+
+def assert_within_bound(approximate, exact, total, error):
+    '''Checks the top lists of an approximate report against the true counts.'''
+    capacity = bikeshare.new_sketch(error)['capacity']
+    for key, listed in approximate.items():
+        assert listed['error'] <= total / (capacity + 1), key
+        for value, count in listed['top']:
+            value = tuple(value) if key == 'route' else value
+            assert count <= exact[key][value] <= count + listed['error'], (key, value)
+        # the true highest count is within the error of the first listed one
+        top = max(exact[key].values())
+        assert listed['top'][0][1] <= top <= listed['top'][0][1] + listed['error'], key
+
+def test_sketch_add_bound():
+    '''Adding many small batches keeps every count within the error bound.'''
+    rng = np.random.default_rng(0)
+    values = rng.zipf(1.3, 20000) % 5000
+    sketch = bikeshare.new_sketch(0.01, top=10)
+    for batch in np.array_split(values, 40):
+        bikeshare.sketch_add(sketch, Counter(batch.tolist()))
+    exact = Counter(values.tolist())
+
+    assert sketch['total'] == len(values)
+    assert len(sketch['counts']) <= sketch['capacity']
+    assert sketch['error'] <= len(values) / (sketch['capacity'] + 1)
+    for value, count in exact.items():
+        assert exact[value] - sketch['error'] <= sketch['counts'].get(value, 0) <= exact[value]
+
+def test_merged_sketches_bound():
+    '''Sketches of separate parts merge into one with the same guarantee.'''
+    rng = np.random.default_rng(1)
+    parts = [rng.zipf(1.5, 5000) % 2000 for _ in range(4)]
+    merged = bikeshare.new_sketch(0.02)
+    for part in parts:
+        sketch = bikeshare.sketch_add(bikeshare.new_sketch(0.02), Counter(part.tolist()))
+        bikeshare.merge_sketches(merged, sketch)
+    exact = Counter(np.concatenate(parts).tolist())
+    assert merged['error'] <= merged['total'] / (merged['capacity'] + 1)
+    for value, count in exact.items():
+        assert count - merged['error'] <= merged['counts'].get(value, 0) <= count
+
+def test_stream_report_bound(chicago):
+    report = bikeshare.stream_report(chicago, 'all', 'all', chunksize=500, error=0.01)
+    assert_within_bound(report['approximate'], exact_counts(chicago), report['trip_count'], 0.01)
+
+@pytest.mark.parametrize('cpus', [1, 3])
+def test_parallel_report_bound(chicago, cpus, monkeypatch):
+    monkeypatch.setattr(os, 'cpu_count', lambda: cpus)
+    report = bikeshare.parallel_report(chicago, 'all', 'all', 3, error=0.01)
+    assert_within_bound(report['approximate'], exact_counts(chicago), report['trip_count'], 0.01)
+    # the most common station and route agree with the top of their lists
+    for key in ('start_station', 'end_station'):
+        assert list(report[key]) == list(report['approximate'][key]['top'][0])
+    route, count = report['approximate']['route']['top'][0]
+    assert list(report['route']) == list(route) + [count]